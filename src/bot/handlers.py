@@ -7,6 +7,7 @@ from ..services.llm import MemeBrain
 from ..services.search import ImageSearcher
 from ..services.image_gen import MemeGenerator
 from ..services.face_swap import FaceSwapper
+from ..services.single_flight import SingleFlight
 import os
 import html
 import asyncio
@@ -20,6 +21,8 @@ meme_brain = MemeBrain()
 image_searcher = ImageSearcher()
 meme_generator = MemeGenerator()
 face_swapper = FaceSwapper()
+# Одинаковые одновременные триггеры (chat_id, message_id, эмодзи) делают один мем
+meme_jobs = SingleFlight()
 
 # Эмодзи, на которые реагируем, и их смысловое значение
 MEME_TRIGGERS = {
@@ -43,6 +46,26 @@ MEME_TRIGGERS = {
 }
 TEMP_OUTPUT_FILE = "temp_meme.jpg"
 
+def _format_bytes(size: int) -> str:
+    """Размер в байтах в человекочитаемом виде."""
+    for unit in ("Б", "КБ", "МБ"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ГБ"
+
+def _find_template(query: str) -> Optional[str]:
+    """Ищет шаблон и сразу скачивает его в кеш генератора (для раннего поиска по потоку LLM)."""
+    template_url = image_searcher.search_template(query + " meme template")
+    if template_url:
+        meme_generator.prefetch_template(template_url)
+    return template_url
+
+def _discard_result(task: asyncio.Future):
+    """Забирает результат ненужной фоновой задачи, чтобы ее ошибка не осталась непрочитанной."""
+    if not task.cancelled() and task.exception():
+        logging.warning(f"Ранний поиск шаблона завершился ошибкой: {task.exception()}")
+
 async def generate_and_send_meme(
     chat_id: int,
     triggered_text: str,
@@ -54,7 +77,30 @@ async def generate_and_send_meme(
 ) -> None:
     """
     Общая логика генерации и отправки мема.
+
+    Одновременные вызовы для того же сообщения и эмодзи (десять 🔥 на один пост)
+    присоединяются к уже идущей генерации: мем создается и отправляется один раз.
     """
+    if reply_to_message_id is None:
+        return await _generate_and_send_meme(
+            chat_id, triggered_text, context_messages, reaction_context, reply_to_message_id, bot_instance, trigger_emoji,
+        )
+    return await meme_jobs.run(
+        (chat_id, reply_to_message_id, trigger_emoji),
+        lambda: _generate_and_send_meme(
+            chat_id, triggered_text, context_messages, reaction_context, reply_to_message_id, bot_instance, trigger_emoji,
+        ),
+    )
+
+async def _generate_and_send_meme(
+    chat_id: int,
+    triggered_text: str,
+    context_messages: List[str],
+    reaction_context: Optional[str],
+    reply_to_message_id: Optional[int],
+    bot_instance: Optional[Bot],
+    trigger_emoji: Optional[str],
+) -> None:
     # Validate input
     if not bot_instance:
         logging.error("bot_instance is required for generate_and_send_meme")
@@ -75,8 +121,23 @@ async def generate_and_send_meme(
         logging.error(f"Не удалось отправить chat action: {e}")
 
     # 2. LLM: Генерация идеи мема
-    # ⚡ Optimization: Run blocking LLM call in a thread to avoid blocking the event loop
-    meme_idea = await asyncio.to_thread(meme_brain.generate_meme_idea, context_messages, triggered_text, reaction_context)
+    # ⚡ Optimization: Асинхронный клиент с пулом соединений — генерация не занимает поток executor'а.
+    # В потоковом режиме поиск шаблона стартует, как только готов search_query, параллельно с текстами
+    early_search = {}
+
+    def start_search(early_query: str):
+        early_search[early_query] = asyncio.ensure_future(asyncio.to_thread(_find_template, early_query))
+
+    meme_idea = await meme_brain.generate_meme_idea(
+        context_messages, triggered_text, reaction_context, on_search_query=start_search,
+    )
+    template_task = None
+    if meme_idea and meme_idea.get('is_memable'):
+        template_task = early_search.pop(meme_idea['search_query'], None)
+    for task in early_search.values():
+        # Идея не удалась или запрос в итоговом JSON другой — результат раннего поиска не нужен.
+        # Поток поиска отменить нельзя: дожидаться его не будем, но ошибку заберем, чтобы она не потерялась
+        task.add_done_callback(_discard_result)
 
     if not meme_idea:
         logging.error("❌ ОШИБКА: LLM вернула пустоту. Скорее всего, сломался JSON из-за мата или фильтров OpenAI.")
@@ -94,7 +155,10 @@ async def generate_and_send_meme(
 
     # 3. Search: Поиск шаблона
     # ⚡ Optimization: Run blocking network request in a thread
-    template_url = await asyncio.to_thread(image_searcher.search_template, query + " meme template")
+    if template_task:
+        template_url = await template_task
+    else:
+        template_url = await asyncio.to_thread(image_searcher.search_template, query + " meme template")
 
     if not template_url:
         await bot_instance.send_message(
@@ -170,13 +234,18 @@ async def reaction_handler(reaction: MessageReactionUpdated):
         logging.warning(f"Unknown trigger emoji: {trigger_emoji}")
         return
 
-    # Получаем контекст из HistoryManager
-    context_messages = history_manager.get_context(chat_id, reaction.message_id)
-    if not context_messages:
-        return
+    # Сначала ищем сообщение в кольцевом буфере (выгруженный чат загружается в потоке)
+    chat = await history_manager.get_chat_async(chat_id)
+    triggered_text = history_manager.get_message_text(chat_id, reaction.message_id) if chat is not None else ""
 
-    # Получаем текст сообщения
-    triggered_text = history_manager.get_message_text(chat_id, reaction.message_id)
+    if triggered_text:
+        context_messages = await history_manager.get_context_async(chat_id, reaction.message_id)
+    else:
+        # Сообщение уже вышло из кольцевого буфера — берем его и окно вокруг из агентской памяти.
+        # Чтение файла истории не должно блокировать цикл событий
+        triggered_text, context_messages = await asyncio.to_thread(
+            history_manager.get_deep_context, chat_id, reaction.message_id,
+        )
 
     if not triggered_text:
         try:
@@ -210,7 +279,7 @@ async def message_handler(message: Message):
     2. В личных сообщениях (private) автоматически генерирует мем.
     """
     if message.text and message.text.strip():
-        history_manager.add_message(message)
+        await history_manager.add_message_async(message)
     else:
         # Skip empty messages
         return
@@ -221,7 +290,7 @@ async def message_handler(message: Message):
         status_msg = await message.answer("🎨 Придумываю мем...")
 
         # Получаем контекст (последние сообщения, включая текущее)
-        context_messages = history_manager.get_context(message.chat.id, message.message_id)
+        context_messages = await history_manager.get_context_async(message.chat.id, message.message_id)
         
         if not context_messages:
             try:
@@ -249,6 +318,12 @@ async def message_handler(message: Message):
         except Exception:
             pass
 
+# Хендлер для отредактированных сообщений
+@router.edited_message(F.text)
+async def edited_message_handler(message: Message):
+    """Обновляет текст сообщения в истории, чтобы реакции и контекст видели правку."""
+    history_manager.edit_message(message)
+
 # Дополнительный хендлер для /help
 @router.message(Command("help"))
 async def command_help_handler(message: Message):
@@ -299,12 +374,95 @@ async def command_memory_stats_handler(message: Message):
         f"📊 <b>Статистика агентской памяти</b>\n\n"
         f"💬 <b>Чатов в памяти:</b> {stats.get('total_chats', 0)}\n"
         f"📝 <b>Всего сообщений:</b> {stats.get('total_messages', 0)}\n"
+        f"💾 <b>На диске:</b> {_format_bytes(stats.get('total_bytes', 0))}\n"
         f"🗂 <b>ID чатов:</b> {', '.join(map(str, stats.get('chat_ids', [])[:5]))}"
     )
     
     if len(stats.get('chat_ids', [])) > 5:
         stats_text += f"... (+{len(stats['chat_ids']) - 5} еще)"
     
+    writer_stats = stats.get('writer')
+    if writer_stats:
+        stats_text += (
+            f"\n\n✍️ <b>Очередь записи:</b> {writer_stats['queue_depth']}/{writer_stats['queue_max']}\n"
+            f"⏱ <b>Запись пачки:</b> {writer_stats['last_flush_ms']} мс "
+            f"(среднее {writer_stats['avg_flush_ms']}, макс {writer_stats['max_flush_ms']})"
+        )
+        if writer_stats.get('waits'):
+            stats_text += f"\n🐢 <b>Ожиданий места в очереди:</b> {writer_stats['waits']}"
+        if writer_stats['dropped']:
+            stats_text += f"\n⚠️ <b>Отброшено:</b> {writer_stats['dropped']}"
+    
+    retention_stats = stats.get('retention')
+    if retention_stats:
+        stats_text += (
+            f"\n\n🧹 <b>Очищено по лимитам:</b> {retention_stats['reclaimed_messages']} сообщений, "
+            f"{_format_bytes(retention_stats['reclaimed_bytes'])}"
+        )
+    
+    history_stats = stats.get('history')
+    if history_stats:
+        stats_text += (
+            f"\n\n🧠 <b>История в памяти процесса:</b> {history_stats['chats']} чатов, "
+            f"{_format_bytes(history_stats['bytes'])} (выгружено {history_stats['evicted_chats']}, "
+            f"загружено снова {history_stats['reloaded_chats']})"
+        )
+        if history_stats['deep_lookups']:
+            stats_text += (
+                f"\n📜 <b>Реакции на старые сообщения:</b> найдено в памяти "
+                f"{history_stats['deep_hits']} из {history_stats['deep_lookups']}"
+            )
+
+    context_stats = stats.get('context')
+    if context_stats and context_stats['context_tokens']['count']:
+        raw, assembled = context_stats['raw_tokens'], context_stats['context_tokens']
+        buckets = ", ".join(f"{bound}: {count}" for bound, count in assembled['buckets'].items() if count)
+        stats_text += (
+            f"\n\n📏 <b>Контекст промпта:</b> в среднем {assembled['avg']} токенов "
+            f"(до сжатия {raw['avg']}), макс {assembled['max']}, бюджет {context_stats['token_budget'] or '∞'}\n"
+            f"📊 <b>Размеры:</b> {buckets}; отброшено сообщений {context_stats['dropped_messages']}"
+        )
+
+    search_stats = stats.get('search')
+    if search_stats:
+        stats_text += (
+            f"\n\n🔎 <b>Поиск по памяти:</b> {search_stats['queries']} запросов, "
+            f"p95 {search_stats['p95_ms']} мс (среднее {search_stats['avg_ms']})"
+        )
+    
+    await message.answer(stats_text, parse_mode='HTML')
+
+
+# Команда для просмотра статистики запросов к LLM
+@router.message(Command("llm_stats"))
+async def command_llm_stats_handler(message: Message):
+    """Показывает счетчики кеша идей мемов, хеджирования и объединения одинаковых триггеров."""
+    stats = meme_brain.get_statistics()
+    cache_stats = stats['cache']
+    hedge_stats = stats['hedging']
+    jobs_stats = meme_jobs.get_statistics()
+
+    stats_text = "🤖 <b>Статистика запросов к LLM</b>\n\n"
+    if cache_stats['max_entries']:
+        stats_text += (
+            f"🗃 <b>Кеш идей:</b> {cache_stats['entries']}/{cache_stats['max_entries']} записей\n"
+            f"🎯 <b>Попадания:</b> {cache_stats['hits']} из {cache_stats['hits'] + cache_stats['misses']} "
+            f"({cache_stats['hit_rate'] * 100:.0f}%), устарело {cache_stats['expired']}"
+        )
+    else:
+        stats_text += "🗃 <b>Кеш идей отключен</b>"
+    stats_text += (
+        f"\n\n🔥 <b>Генераций:</b> {jobs_stats['started']} (сейчас {jobs_stats['in_flight']}), "
+        f"присоединено повторных триггеров {jobs_stats['coalesced']}"
+    )
+    if meme_brain.fallback_model:
+        stats_text += (
+            f"\n\n🪁 <b>Хеджирование:</b> {hedge_stats['hedged']} из {hedge_stats['requests']} запросов "
+            f"({hedge_stats['hedge_rate'] * 100:.0f}%), запасная модель победила в "
+            f"{hedge_stats['fallback_wins']} ({hedge_stats['win_rate'] * 100:.0f}%)\n"
+            f"⏱ <b>Порог:</b> {hedge_stats['delay_s']} с по {hedge_stats['samples']} замерам"
+        )
+
     await message.answer(stats_text, parse_mode='HTML')
 
 
@@ -314,8 +472,8 @@ async def command_clear_memory_handler(message: Message):
     """Очищает историю текущего чата из памяти."""
     chat_id = message.chat.id
     
-    # Проверяем, есть ли что очищать
-    if chat_id not in history_manager.history or len(history_manager.history[chat_id]) == 0:
+    # Проверяем, есть ли что очищать (выгруженный чат подгрузится из памяти)
+    if not await history_manager.get_chat_async(chat_id):
         await message.answer(
             "🤷‍♂️ <b>История пуста</b>\n\n"
             "В этом чате нет сохраненных сообщений.",
@@ -324,12 +482,11 @@ async def command_clear_memory_handler(message: Message):
         return
     
     # Очищаем in-memory историю
-    message_count = len(history_manager.history[chat_id])
-    history_manager.history[chat_id].clear()
+    message_count = history_manager.clear_chat(chat_id)
     
     # Очищаем markdown файлы если память включена
     if history_manager.memory_enabled:
-        from .services.agent_memory import agent_memory
+        from ..services.agent_memory import agent_memory
         agent_memory.clear_chat(chat_id)
     
     await message.answer(
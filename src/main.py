@@ -1,12 +1,52 @@
 import asyncio
 import logging
+from pathlib import Path
 from aiogram import Bot, Dispatcher
 from .services.config import config
-from .bot.handlers import router as meme_router
+from .services.agent_memory import agent_memory
+from .services.memory_writer import memory_writer
+from .services.memory_retention import retention_sweeper
+from .services.history import history_manager
+from .services.history_snapshot import SNAPSHOT_FILE, restore_history, save_history
+from .bot.handlers import router as meme_router, meme_brain
 
 # Устанавливаем базовый уровень логирования
 logging.basicConfig(level=logging.INFO)
 
+async def flush_memory_periodically():
+    """Периодически сбрасывает кеш метаданных агентской памяти на диск."""
+    while True:
+        await asyncio.sleep(config.MEMORY_META_FLUSH_INTERVAL)
+        await asyncio.to_thread(agent_memory.flush_metadata)
+
+async def sweep_memory_periodically():
+    """Фоновая очистка памяти по лимитам хранения с низким приоритетом."""
+    while True:
+        await asyncio.sleep(config.MEMORY_RETENTION_SWEEP_INTERVAL)
+        # Пока писатель разбирает очередь, очистка уступает ему диск
+        if memory_writer.get_statistics()["queue_depth"]:
+            continue
+        try:
+            await asyncio.to_thread(retention_sweeper.sweep_step)
+        except Exception as e:
+            logging.error(f"Retention sweep failed: {e}")
+
+async def hydrate_history(snapshot_path: Path):
+    """Фоново восстанавливает историю из снимка, затем прогревает недавние чаты."""
+    if config.HISTORY_SNAPSHOT_ENABLED:
+        await restore_history(history_manager, snapshot_path, agent_memory)
+    if config.HISTORY_PREWARM_CHATS:
+        await history_manager.prewarm(config.HISTORY_PREWARM_CHATS)
+
+async def snapshot_history_periodically(snapshot_path: Path):
+    """Периодически пишет снимок истории, чтобы он пережил и аварийный перезапуск."""
+    while True:
+        await asyncio.sleep(config.HISTORY_SNAPSHOT_INTERVAL)
+        try:
+            await save_history(history_manager, snapshot_path)
+        except Exception as e:
+            logging.error(f"History snapshot failed: {e}")
+
 async def main():
     # Инициализация бота и диспетчера
     bot = Bot(token=config.TELEGRAM_BOT_TOKEN)
@@ -15,6 +55,20 @@ async def main():
     # Подключение роутера с обработчиками
     dp.include_router(meme_router)
     
+    # Фоновый сброс метаданных памяти
+    flush_task = asyncio.create_task(flush_memory_periodically())
+    sweep_task = asyncio.create_task(sweep_memory_periodically()) if retention_sweeper.enabled else None
+    # История чатов грузится по обращению; снимок и недавно активные чаты подгружаются в фоне
+    snapshot_path = Path(config.MEMORY_DIR) / SNAPSHOT_FILE
+    snapshots = history_manager.memory_enabled and config.HISTORY_SNAPSHOT_ENABLED
+    hydrate_task = None
+    if history_manager.memory_enabled and (config.HISTORY_SNAPSHOT_ENABLED or config.HISTORY_PREWARM_CHATS):
+        hydrate_task = asyncio.create_task(hydrate_history(snapshot_path))
+    snapshot_task = asyncio.create_task(snapshot_history_periodically(snapshot_path)) if snapshots else None
+    # Кеш идей мемов с прошлого запуска (файл небольшой, читается до старта поллинга)
+    if meme_brain.cache.path:
+        await asyncio.to_thread(meme_brain.cache.load)
+    
     # Запуск процесса поллинга
     try:
         logging.info("Starting meme-generator bot...")
@@ -23,6 +77,28 @@ async def main():
         logging.error(f"Error while running bot: {e}")
     finally:
         logging.info("Shutting down bot...")
+        flush_task.cancel()
+        if sweep_task:
+            sweep_task.cancel()
+        if hydrate_task:
+            hydrate_task.cancel()
+        if snapshot_task:
+            snapshot_task.cancel()
+        # Polling останавливается по SIGTERM, после чего снимок пишется последним
+        if snapshots:
+            try:
+                await save_history(history_manager, snapshot_path)
+            except Exception as e:
+                logging.error(f"History snapshot failed: {e}")
+        if meme_brain.cache.path:
+            try:
+                await asyncio.to_thread(meme_brain.cache.save)
+            except Exception as e:
+                logging.error(f"LLM cache save failed: {e}")
+        # Сначала дописываем очередь фонового писателя, затем сбрасываем метаданные
+        await asyncio.to_thread(memory_writer.stop)
+        agent_memory.close()
+        await meme_brain.close()
         await bot.session.close()
 
 if __name__ == "__main__":
@@ -1,34 +1,435 @@
 import os
+import re
 import json
+import time
+import heapq
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
 from pathlib import Path
 import logging
 
+from .config import config
+from .memory_search import MemorySearchIndex
+from .segment_log import (
+    COLD_SEGMENT_SUFFIX,
+    INDEX_ENTRY,
+    SPARSE_BY_MESSAGE_ID,
+    SPARSE_BY_TIMESTAMP,
+    AppendHandleCache,
+    Record,
+    SegmentLog,
+    SparseIndex,
+    encode_record,
+    iter_sealed_segment,
+    write_sealed_segment,
+)
+
+# Форматы хранения истории
+STORAGE_MARKDOWN = "markdown"  # markdown файл — и формат записи, и формат чтения
+STORAGE_SEGMENTS = "segments"  # append-only сегмент с индексом, markdown — опциональный экспорт
+STORAGE_FORMATS = (STORAGE_MARKDOWN, STORAGE_SEGMENTS)
+
+# Манифест: список всех чатов с их счетчиками и общие итоги в одном файле
+MANIFEST_FILE = "manifest.json"
+# Журнал созданий/удалений чатов между сбросами манифеста
+MANIFEST_JOURNAL_FILE = "manifest.journal"
+CHAT_FILE_PATTERN = re.compile(r"^chat_(-?\d+)(_meta\.json|\.[a-z0-9.]+)$")
+
+# Раскладка файлов чатов в директории памяти
+LAYOUT_FLAT = "flat"  # все файлы в одной директории
+LAYOUT_SHARDED = "sharded"  # memory/ab/cd/chat_<id>.* по хешу ID чата
+LAYOUTS = (LAYOUT_FLAT, LAYOUT_SHARDED)
+# Все файлы, которые AgentMemory заводит на чат
+CHAT_FILE_SUFFIXES = (".md", "_meta.json", ".log", ".idx", ".log.sparse", ".md.sparse")
+# Число замков, между которыми распределяются чаты при обновлении поискового индекса
+SEARCH_LOCK_STRIPES = 64
+# Сколько раз читатель в режиме read_only перечитывает сегмент, который переписывает писатель
+READ_RETRIES = 5
+READ_RETRY_DELAY = 0.02  # сек
+
+
+def _atomic_write_json(path: Path, data: Dict):
+    """Записывает JSON через временный файл и os.replace, чтобы читатель не увидел половину файла."""
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+MESSAGE_HEADING = '### Сообщение #'
+
+
+def iter_markdown_messages(path: Path, offset: int = 0) -> Iterator[Tuple[int, int, Optional[datetime], str]]:
+    """
+    Построчно разбирает markdown файл истории, не загружая его целиком.
+    
+    Args:
+        path: Путь к markdown файлу
+        offset: Байтовое смещение заголовка сообщения, с которого начать чтение
+    
+    Yields:
+        Кортежи (message_id, user_id, timestamp, text); timestamp — None,
+        если строку времени не удалось разобрать
+    """
+    for _, message_id, user_id, timestamp, text in _iter_markdown_blocks(path, offset):
+        yield message_id, user_id, timestamp, text
+
+
+def _iter_markdown_blocks(path: Path, offset: int = 0) -> Iterator[Tuple[int, int, int, Optional[datetime], str]]:
+    """То же, что iter_markdown_messages, но с байтовым смещением заголовка каждого сообщения."""
+    message_id = None
+    message_offset = 0
+    user_id = None
+    timestamp = None
+    text_lines: Optional[List[str]] = None
+    
+    # Читаем в бинарном режиме, чтобы знать байтовые смещения строк
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        position = offset
+        for raw_line in f:
+            line_offset = position
+            position += len(raw_line)
+            line = raw_line.decode('utf-8', errors='replace').rstrip('\n')
+            
+            if text_lines is not None:
+                # Внутри блока текста до закрывающих тройных кавычек
+                if line.strip() != '```':
+                    text_lines.append(line)
+                    continue
+                if message_id is not None and user_id is not None:
+                    # Убираем экранирование
+                    yield message_offset, message_id, user_id, timestamp, '\n'.join(text_lines).replace('\\`', '`')
+                message_id = None
+                text_lines = None
+                continue
+            
+            if line.startswith(MESSAGE_HEADING):
+                message_offset = line_offset
+                user_id = None
+                timestamp = None
+                try:
+                    message_id = int(line[len(MESSAGE_HEADING):].strip())
+                except ValueError as e:
+                    logging.warning(f"AgentMemory: Не удалось распарсить блок сообщения: {e}")
+                    message_id = None
+            elif message_id is None:
+                continue
+            elif line.startswith('**Пользователь:**'):
+                try:
+                    user_id = int(line.split('User ')[1].strip())
+                except (IndexError, ValueError) as e:
+                    logging.warning(f"AgentMemory: Не удалось распарсить блок сообщения: {e}")
+                    message_id = None
+            elif line.startswith('**Время:**'):
+                try:
+                    timestamp = datetime.strptime(line[len('**Время:**'):].strip(), '%Y-%m-%d %H:%M:%S')
+                except ValueError:
+                    timestamp = None
+            elif line.strip() == '```':
+                text_lines = []
+
+
+class _RetentionBudget:
+    """Лимиты хранения, которые заполняются от новых сообщений к старым."""
+
+    def __init__(self, max_messages: int, max_bytes: int, cutoff: Optional[float]):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.cutoff = cutoff
+        self.messages = 0
+        self.bytes = 0
+
+    def take(self, timestamp: float, size: float, count: int = 1) -> bool:
+        """Резервирует место под сообщения; False — они уже за пределами лимитов."""
+        if self.cutoff is not None and timestamp < self.cutoff:
+            return False
+        if self.max_messages and self.messages + count > self.max_messages:
+            return False
+        if self.max_bytes and self.bytes + size > self.max_bytes:
+            return False
+        self.messages += count
+        self.bytes += size
+        return True
+
+
 class AgentMemory:
     """
     Класс для хранения агентской памяти в markdown файлах.
     Сохраняет историю сообщений чатов в структурированном формате.
     """
     
-    def __init__(self, memory_dir: str = "memory"):
+    def __init__(
+        self,
+        memory_dir: str = "memory",
+        storage_format: str = STORAGE_MARKDOWN,
+        markdown_export: bool = False,
+        metadata_flush_interval: float = 5.0,
+        max_open_files: int = 256,
+        layout: str = LAYOUT_FLAT,
+        segment_max_bytes: int = 8 * 1024 * 1024,
+        segment_max_age: float = 0,
+        segment_tail_keep: int = 100,
+        track_manifest: bool = True,
+        search_index: Optional[MemorySearchIndex] = None,
+        read_only: bool = False,
+    ):
         """
         Инициализирует систему агентской памяти.
         
         Args:
             memory_dir: Директория для хранения markdown файлов
+            storage_format: Формат хранения: "markdown" или "segments"
+            markdown_export: В режиме "segments" дополнительно вести markdown как экспорт
+            metadata_flush_interval: Как часто (в секундах) сбрасывать измененные метаданные на диск
+            max_open_files: Сколько файлов держать открытыми на дозапись
+            layout: Раскладка файлов: "flat" или "sharded"
+            segment_max_bytes: Размер горячего сегмента, после которого он запечатывается (0 — без ограничения)
+            segment_max_age: Возраст горячего сегмента в секундах, после которого он запечатывается (0 — без ограничения)
+            segment_tail_keep: Сколько последних сообщений оставлять в горячем сегменте при ротации
+            track_manifest: Вести манифест; False — для параллельных процессов миграции,
+                после которых манифест перестраивается один раз
+            search_index: Инвертированный индекс для поиска по истории (None — без поиска)
+            read_only: Только читать файлы, которыми владеет другой процесс (демон-писатель):
+                метаданные не кешируются, а восстановление и перенос файлов не выполняются
         """
+        if storage_format not in STORAGE_FORMATS:
+            raise ValueError(f"Неизвестный формат хранения памяти: {storage_format}")
+        if layout not in LAYOUTS:
+            raise ValueError(f"Неизвестная раскладка памяти: {layout}")
+
         self.memory_dir = Path(memory_dir)
         self.memory_dir.mkdir(exist_ok=True)
-        logging.info(f"AgentMemory: Инициализирована с директорией {self.memory_dir}")
+        self.storage_format = storage_format
+        self.markdown_export = markdown_export
+        self.layout = layout
+        # Чаты, чьи файлы уже лежат в своей шард-директории
+        self._placed_chats: set[int] = set()
+        self._placement_lock = threading.Lock()
+        # Сегменты, для которых уже выполнено восстановление индекса
+        self._segment_logs: Dict[int, SegmentLog] = {}
+        # Разреженные индексы markdown файлов (загружаются лениво)
+        self._markdown_sparse: Dict[int, SparseIndex] = {}
+        self.segment_max_bytes = segment_max_bytes
+        self.segment_max_age = segment_max_age
+        self.segment_tail_keep = segment_tail_keep
+        self._handles = AppendHandleCache(max_open_files)
+        self._write_lock = threading.Lock()
+        # Write-behind кеш метаданных: изменения копятся в памяти и сбрасываются пачкой
+        self.metadata_flush_interval = metadata_flush_interval
+        self._metadata: Dict[int, Dict] = {}
+        self._dirty_metadata: set[int] = set()
+        self._last_metadata_flush = time.monotonic()
+        self._metadata_lock = threading.RLock()
+        # Манифест загружается лениво при первом обращении
+        self._manifest_path = self.memory_dir / MANIFEST_FILE
+        self._journal_path = self.memory_dir / MANIFEST_JOURNAL_FILE
+        self._manifest: Optional[Dict[int, Dict]] = None
+        self._total_messages = 0
+        self._total_bytes = 0
+        self._manifest_dirty = False
+        # (inode, mtime) файла манифеста после нашего последнего чтения или записи:
+        # другое значение означает, что манифест переписал другой процесс (например, импорт из CLI)
+        self._manifest_stat: Optional[Tuple[int, int]] = None
+        self.track_manifest = track_manifest
+        self.read_only = read_only
+        self.search_index = search_index
+        # Чаты, чей поисковый индекс уже сверен с историей в этом процессе
+        self._search_synced: set[int] = set()
+        # Догон индекса и дописывание в него сериализуются по чату (полосы замков по chat_id)
+        self._search_locks = [threading.RLock() for _ in range(SEARCH_LOCK_STRIPES)]
+        logging.info(f"AgentMemory: Инициализирована с директорией {self.memory_dir} (формат: {self.storage_format})")
     
+    def _chat_path(self, chat_id: int, suffix: str) -> Path:
+        """Возвращает путь к файлу чата с заданным суффиксом."""
+        flat_path = self.memory_dir / f"chat_{chat_id}{suffix}"
+        if self.layout == LAYOUT_SHARDED:
+            if self.read_only:
+                # Файлы переносит владелец директории; пока он этого не сделал, читаем из корня
+                shard_path = self._shard_dir(chat_id) / flat_path.name
+                return flat_path if flat_path.exists() and not shard_path.exists() else shard_path
+            return self._ensure_chat_placed(chat_id) / flat_path.name
+        return flat_path
+
+    def _shard_dir(self, chat_id: int) -> Path:
+        """Шард-директория чата: memory/ab/cd по первым байтам SHA-1 от ID."""
+        digest = hashlib.sha1(str(chat_id).encode()).hexdigest()
+        return self.memory_dir / digest[:2] / digest[2:4]
+
+    def _ensure_chat_placed(self, chat_id: int) -> Path:
+        """
+        Возвращает шард-директорию чата, при первом обращении создавая ее
+        и перенося туда файлы чата из плоской раскладки (онлайн-миграция).
+        """
+        shard_dir = self._shard_dir(chat_id)
+        if chat_id in self._placed_chats:
+            return shard_dir
+        
+        with self._placement_lock:
+            if chat_id not in self._placed_chats:
+                shard_dir.mkdir(parents=True, exist_ok=True)
+                for suffix in CHAT_FILE_SUFFIXES:
+                    self._move_to_shard(self.memory_dir / f"chat_{chat_id}{suffix}", shard_dir)
+                # Холодные сегменты перечислены в метаданных, которые уже лежат в шарде
+                meta_path = shard_dir / f"chat_{chat_id}_meta.json"
+                try:
+                    with open(meta_path, 'r', encoding='utf-8') as f:
+                        segments = json.load(f).get("segments", [])
+                except (OSError, ValueError):
+                    segments = []
+                for segment in segments:
+                    self._move_to_shard(self.memory_dir / segment["file"], shard_dir)
+                self._placed_chats.add(chat_id)
+        return shard_dir
+
+    @staticmethod
+    def _move_to_shard(flat_path: Path, shard_dir: Path) -> bool:
+        """Атомарно переносит файл в шард, если там еще нет своей копии."""
+        target = shard_dir / flat_path.name
+        if target.exists():
+            return False
+        try:
+            os.replace(flat_path, target)
+            return True
+        except FileNotFoundError:
+            # Файла нет или его уже перенес другой процесс
+            return False
+
     def _get_chat_file_path(self, chat_id: int) -> Path:
         """Возвращает путь к markdown файлу для конкретного чата."""
-        return self.memory_dir / f"chat_{chat_id}.md"
+        return self._chat_path(chat_id, ".md")
     
     def _get_metadata_file_path(self, chat_id: int) -> Path:
         """Возвращает путь к JSON файлу с метаданными чата."""
-        return self.memory_dir / f"chat_{chat_id}_meta.json"
+        return self._chat_path(chat_id, "_meta.json")
+
+    def _get_segment_log(self, chat_id: int) -> SegmentLog:
+        """Возвращает сегмент чата, восстанавливая индекс при первом обращении."""
+        segment_log = self._segment_logs.get(chat_id)
+        if segment_log is None:
+            segment_log = SegmentLog(self._chat_path(chat_id, ".log"), self._chat_path(chat_id, ".idx"), self._handles)
+            if not self.read_only:
+                segment_log.recover()
+                self._recover_rotation(chat_id, segment_log)
+            self._segment_logs[chat_id] = segment_log
+        return segment_log
+
+    def _cold_segment_path(self, chat_id: int, seq: int) -> Path:
+        return self._chat_path(chat_id, f".{seq:06d}{COLD_SEGMENT_SUFFIX}")
+
+    def _cold_file_path(self, chat_id: int, segment: Dict) -> Path:
+        return self._chat_path(chat_id, segment["file"][len(f"chat_{chat_id}"):])
+
+    def _cold_segments(self, chat_id: int) -> List[Dict]:
+        """Описания запечатанных сегментов чата, от старых к новым."""
+        metadata = self._load_metadata(chat_id)
+        return list(metadata.get("segments", [])) if metadata else []
+
+    def _maybe_rotate(self, chat_id: int, segment_log: SegmentLog):
+        """Запечатывает горячий сегмент, если он превысил лимит размера или возраста."""
+        if segment_log.count() <= self.segment_tail_keep:
+            return
+        
+        rotate = bool(self.segment_max_bytes) and segment_log.size() >= self.segment_max_bytes
+        if not rotate and self.segment_max_age:
+            metadata = self._load_metadata(chat_id) or {}
+            started_at = metadata.get("hot_started_at") or segment_log.first_timestamp()
+            rotate = started_at is not None and time.time() - started_at >= self.segment_max_age
+        
+        if rotate:
+            self._rotate_segment(chat_id, segment_log)
+
+    def _rotate_segment(self, chat_id: int, segment_log: SegmentLog):
+        """
+        Переносит горячий сегмент в сжатый холодный, оставляя в горячем
+        последние segment_tail_keep сообщений — их хватает для контекста LLM,
+        поэтому чтение хвоста не трогает холодные сегменты.
+        
+        Порядок шагов: холодный сегмент → новый горячий → метаданные.
+        Если упасть между шагами, _recover_rotation доведет ротацию до конца.
+        """
+        records = list(segment_log.iter_records())
+        split = len(records) - self.segment_tail_keep
+        to_seal, tail = records[:split], records[split:]
+        if not to_seal:
+            return
+        
+        metadata = self._load_metadata(chat_id)
+        seq = metadata.get("next_segment_seq", 0) if metadata else 0
+        info = write_sealed_segment(self._cold_segment_path(chat_id, seq), to_seal)
+        info["seq"] = seq
+        segment_log.rewrite(tail)
+        self._register_cold_segment(chat_id, info)
+        
+        logging.info(
+            f"AgentMemory: Чат {chat_id}: запечатан сегмент #{seq} ({info['count']} сообщений, "
+            f"{info['raw_bytes']} → {info['bytes']} байт, повторов: {info['deduplicated']})"
+        )
+
+    def _register_cold_segment(self, chat_id: int, info: Dict):
+        """Добавляет холодный сегмент в метаданные и сразу сохраняет их на диск."""
+        with self._metadata_lock:
+            metadata = self._load_metadata(chat_id)
+            if metadata is None:
+                return
+            metadata.setdefault("segments", []).append(info)
+            metadata["next_segment_seq"] = info["seq"] + 1
+            metadata["hot_started_at"] = time.time()
+            # Сжатие меняет размер чата на диске — пересчитываем по файлам
+            metadata["bytes"] = self._measure_chat_bytes(chat_id, metadata)
+            self._sync_manifest_entry(chat_id, metadata)
+            snapshot = dict(metadata)
+            self._dirty_metadata.discard(chat_id)
+        # Список холодных сегментов не может ждать write-behind сброса
+        _atomic_write_json(self._get_metadata_file_path(chat_id), snapshot)
+
+    def _recover_rotation(self, chat_id: int, segment_log: SegmentLog):
+        """Доводит до конца ротацию, прерванную аварийным завершением."""
+        metadata = self._load_metadata(chat_id)
+        if not metadata:
+            return
+        seq = metadata.get("next_segment_seq", 0)
+        path = self._cold_segment_path(chat_id, seq)
+        if not path.exists():
+            return
+        
+        sealed = list(iter_sealed_segment(path))
+        if not sealed:
+            return
+        info = {
+            "file": path.name,
+            "seq": seq,
+            "count": len(sealed),
+            "first_message_id": sealed[0][0],
+            "last_message_id": sealed[-1][0],
+            "first_ts": sealed[0][2],
+            "last_ts": sealed[-1][2],
+            "bytes": path.stat().st_size,
+            "raw_bytes": sum(len(record[3].encode('utf-8')) for record in sealed),
+            "deduplicated": 0,
+        }
+        
+        # Если горячий сегмент еще не переписан, он начинается с запечатанных записей
+        hot = list(segment_log.iter_records())
+        if hot[:1] == sealed[:1]:
+            segment_log.rewrite(hot[len(sealed):])
+        
+        self._register_cold_segment(chat_id, info)
+        logging.warning(f"AgentMemory: Чат {chat_id}: восстановлена прерванная ротация сегмента #{seq}")
+
+    def _iter_all_records(self, chat_id: int, segment_log: SegmentLog):
+        """Все записи чата по порядку: холодные сегменты, затем горячий."""
+        for segment in self._cold_segments(chat_id):
+            yield from iter_sealed_segment(self._cold_file_path(chat_id, segment))
+        yield from segment_log.iter_records()
+
+    @property
+    def _writes_markdown(self) -> bool:
+        return self.storage_format == STORAGE_MARKDOWN or self.markdown_export
     
     def save_message(self, chat_id: int, message_id: int, user_id: int, text: str, timestamp: Optional[datetime] = None):
         """
@@ -44,27 +445,113 @@ class AgentMemory:
         if timestamp is None:
             timestamp = datetime.now()
         
+        self.save_messages(chat_id, [(message_id, user_id, text, timestamp)])
+
+    def save_messages(self, chat_id: int, messages: List[Tuple[int, int, str, datetime]]):
+        """
+        Сохраняет пачку сообщений одного чата одной записью (group commit).
+        
+        Args:
+            chat_id: ID чата
+            messages: Список кортежей (message_id, user_id, text, timestamp)
+        """
+        if not messages:
+            return
+        
+        bytes_written = 0
+        with self._write_lock:
+            if self.storage_format == STORAGE_SEGMENTS:
+                segment_log = self._get_segment_log(chat_id)
+                bytes_written += segment_log.append([
+                    (message_id, user_id, timestamp.timestamp(), text)
+                    for message_id, user_id, text, timestamp in messages
+                ])
+                bytes_written += len(messages) * INDEX_ENTRY.size
+
+            if self._writes_markdown:
+                bytes_written += self._append_markdown(chat_id, messages)
+        
+        # Обновляем метаданные
+        last_message_id, last_timestamp = messages[-1][0], messages[-1][3]
+        self._update_metadata(
+            chat_id, last_message_id, last_timestamp, len(messages),
+            bytes_written=bytes_written, first_timestamp=messages[0][3],
+        )
+        
+        if self.storage_format == STORAGE_SEGMENTS:
+            with self._write_lock:
+                self._maybe_rotate(chat_id, segment_log)
+        
+        if self.search_index is not None:
+            # Индекс можно догнать позже, поэтому его ошибки не мешают сохранению истории
+            try:
+                with self._search_lock(chat_id):
+                    if chat_id in self._search_synced:
+                        self.search_index.add(chat_id, ((message_id, text) for message_id, _, text, _ in messages))
+                    else:
+                        self._catch_up_search_index(chat_id)
+            except Exception as e:
+                logging.error(f"AgentMemory: Ошибка обновления поискового индекса чата {chat_id}: {e}")
+                self._search_synced.discard(chat_id)
+    
+    def _append_markdown(self, chat_id: int, messages: List[Tuple[int, int, str, datetime]]) -> int:
+        """Дописывает сообщения в markdown файл чата и возвращает число записанных байт."""
         file_path = self._get_chat_file_path(chat_id)
+        header_bytes = 0
         
         # Создаем файл если его нет
         if not file_path.exists():
-            self._create_chat_file(chat_id)
+            header_bytes = self._create_chat_file(chat_id)
         
-        # Форматируем сообщение в markdown
-        formatted_message = self._format_message(message_id, user_id, text, timestamp)
+        # Форматируем сообщения в markdown и добавляем в файл одной записью
+        blocks = [
+            (self._format_message(message_id, user_id, text, timestamp) + "\n\n").encode('utf-8')
+            for message_id, user_id, text, timestamp in messages
+        ]
+        data = b"".join(blocks)
+        offset = self._handles.write(file_path, data)
         
-        # Добавляем сообщение в файл
-        with open(file_path, 'a', encoding='utf-8') as f:
-            f.write(formatted_message + "\n\n")
-        
-        # Обновляем метаданные
-        self._update_metadata(chat_id, message_id, timestamp)
-    
-    def _create_chat_file(self, chat_id: int):
-        """Создает новый markdown файл для чата с заголовком."""
+        positions = []
+        for (message_id, _, _, timestamp), block in zip(messages, blocks):
+            positions.append((timestamp.timestamp(), message_id, offset))
+            offset += len(block)
+        self._get_markdown_sparse(chat_id).add(positions)
+        return header_bytes + len(data)
+
+    def _get_markdown_sparse(self, chat_id: int) -> SparseIndex:
+        """Разреженный индекс markdown файла чата; для файлов без индекса строится один раз."""
+        sparse = self._markdown_sparse.get(chat_id)
+        if sparse is None:
+            sparse = SparseIndex(self._chat_path(chat_id, ".md.sparse"))
+            file_path = self._get_chat_file_path(chat_id)
+            if not self.read_only and not sparse.exists() and file_path.exists() and file_path.stat().st_size > sparse.interval:
+                self._rebuild_markdown_sparse(file_path, sparse)
+            self._markdown_sparse[chat_id] = sparse
+        elif self.read_only:
+            sparse.refresh()
+        return sparse
+
+    @staticmethod
+    def _rebuild_markdown_sparse(file_path: Path, sparse: SparseIndex):
+        sparse.rebuild(
+            (timestamp.timestamp() if timestamp else 0.0, message_id, offset)
+            for offset, message_id, _, timestamp, _ in _iter_markdown_blocks(file_path)
+        )
+
+    def _create_chat_file(self, chat_id: int) -> int:
+        """Создает новый markdown файл для чата с заголовком и возвращает его размер."""
         file_path = self._get_chat_file_path(chat_id)
+        header = self._render_header(chat_id).encode('utf-8')
+        
+        with open(file_path, 'wb') as f:
+            f.write(header)
         
-        header = f"""# История чата {chat_id}
+        logging.info(f"AgentMemory: Создан новый файл для чата {chat_id}")
+        return len(header)
+    
+    def _render_header(self, chat_id: int) -> str:
+        """Возвращает заголовок markdown файла чата."""
+        return f"""# История чата {chat_id}
 
 > Автоматически сгенерированная история сообщений
 > Создано: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
@@ -72,11 +559,7 @@ class AgentMemory:
 ---
 
 """
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.write(header)
-        
-        logging.info(f"AgentMemory: Создан новый файл для чата {chat_id}")
-    
+
     def _format_message(self, message_id: int, user_id: int, text: str, timestamp: datetime) -> str:
         """
         Форматирует сообщение в markdown.
@@ -99,31 +582,401 @@ class AgentMemory:
         
         return formatted
     
-    def _update_metadata(self, chat_id: int, message_id: int, timestamp: datetime):
-        """Обновляет метаданные чата."""
-        meta_path = self._get_metadata_file_path(chat_id)
+    def _update_metadata(
+        self,
+        chat_id: int,
+        message_id: int,
+        timestamp: datetime,
+        count: int = 1,
+        bytes_written: int = 0,
+        first_timestamp: Optional[datetime] = None,
+    ):
+        """
+        Обновляет метаданные чата в кеше.
+        
+        ⚡ Optimization: Файл метаданных пишется сразу только при создании чата,
+        дальнейшие изменения сбрасываются на диск раз в metadata_flush_interval секунд.
+        """
+        with self._metadata_lock:
+            metadata = self._load_metadata(chat_id)
+            is_new = metadata is None
+            
+            if is_new:
+                metadata = {
+                    "chat_id": chat_id,
+                    "created_at": datetime.now().isoformat(),
+                    "message_count": 0,
+                    "last_message_id": 0,
+                    "last_update": None,
+                    "bytes": 0,
+                    "first_ts": (first_timestamp or timestamp).timestamp(),
+                }
+                self._metadata[chat_id] = metadata
+            
+            # Обновляем метаданные
+            metadata["message_count"] += count
+            metadata["last_message_id"] = message_id
+            metadata["last_update"] = timestamp.isoformat()
+            metadata["bytes"] = metadata.get("bytes", 0) + bytes_written
+            
+            # Инкрементально обновляем манифест и общие итоги
+            if self.track_manifest and chat_id not in self._get_manifest():
+                self._append_journal({"op": "create", "chat_id": chat_id})
+            self._sync_manifest_entry(chat_id, metadata)
+            
+            if is_new:
+                # Новый чат сразу появляется на диске
+                _atomic_write_json(self._get_metadata_file_path(chat_id), metadata)
+                return
+            
+            self._dirty_metadata.add(chat_id)
+            flush_due = time.monotonic() - self._last_metadata_flush >= self.metadata_flush_interval
+        
+        if flush_due:
+            self.flush_metadata()
+
+    def _load_metadata(self, chat_id: int) -> Optional[Dict]:
+        """Возвращает метаданные чата из кеша, при промахе читая файл один раз."""
+        if self.read_only:
+            # Метаданные меняет другой процесс — всегда читаем актуальный файл
+            return self._read_metadata_file(chat_id)
+        metadata = self._metadata.get(chat_id)
+        if metadata is not None:
+            return metadata
+        
+        metadata = self._read_metadata_file(chat_id)
+        if metadata is None:
+            return None
+        if "bytes" not in metadata:
+            # Метаданные из версии без учета места на диске — меряем один раз
+            metadata["bytes"] = self._measure_chat_bytes(chat_id, metadata)
+        
+        with self._metadata_lock:
+            return self._metadata.setdefault(chat_id, metadata)
+
+    def _measure_chat_bytes(self, chat_id: int, metadata: Optional[Dict] = None) -> int:
+        """Суммарный размер файлов истории чата на диске."""
+        paths = [self._get_chat_file_path(chat_id), self._chat_path(chat_id, ".log"), self._chat_path(chat_id, ".idx")]
+        for segment in (metadata or {}).get("segments", []):
+            paths.append(self._cold_file_path(chat_id, segment))
+        
+        total = 0
+        for path in paths:
+            try:
+                total += path.stat().st_size
+            except FileNotFoundError:
+                pass
+        return total
+
+    def flush_metadata(self):
+        """Сбрасывает измененные метаданные на диск атомарной записью."""
+        # Снимок делаем под блокировкой, а пишем файлы уже без нее
+        with self._metadata_lock:
+            snapshot = {
+                chat_id: dict(self._metadata[chat_id])
+                for chat_id in self._dirty_metadata
+                if chat_id in self._metadata
+            }
+            self._dirty_metadata = set()
+            self._last_metadata_flush = time.monotonic()
+        
+        self._flush_manifest()
+        
+        for chat_id, metadata in snapshot.items():
+            if chat_id not in self._metadata:
+                # Чат очищен, пока мы готовили снимок
+                continue
+            try:
+                _atomic_write_json(self._get_metadata_file_path(chat_id), metadata)
+            except Exception as e:
+                logging.error(f"AgentMemory: Не удалось сохранить метаданные чата {chat_id}: {e}")
+                with self._metadata_lock:
+                    self._dirty_metadata.add(chat_id)
+
+    @staticmethod
+    def _manifest_entry(metadata: Dict) -> Dict:
+        return {
+            "message_count": metadata.get("message_count", 0),
+            "last_message_id": metadata.get("last_message_id", 0),
+            "last_update": metadata.get("last_update"),
+            "bytes": metadata.get("bytes", 0),
+        }
+
+    def _sync_manifest_entry(self, chat_id: int, metadata: Dict):
+        """Переносит метаданные чата в манифест, сдвигая общие итоги на разницу (под _metadata_lock)."""
+        if not self.track_manifest:
+            return
+        manifest = self._get_manifest()
+        previous = manifest.get(chat_id)
+        entry = self._manifest_entry(metadata)
+        manifest[chat_id] = entry
+        if previous is not None:
+            self._total_messages -= previous["message_count"]
+            self._total_bytes -= previous.get("bytes", 0)
+        self._total_messages += entry["message_count"]
+        self._total_bytes += entry["bytes"]
+        self._manifest_dirty = True
+
+    def _get_manifest(self) -> Dict[int, Dict]:
+        """Возвращает манифест, загружая его с диска при первом обращении."""
+        if self._manifest is None:
+            with self._metadata_lock:
+                if self._manifest is None:
+                    self._load_manifest()
+        return self._manifest
+
+    def _load_manifest(self):
+        """Читает снимок манифеста и доигрывает журнал. Без манифеста строит его сканированием."""
+        if not self._manifest_path.exists():
+            logging.info(f"AgentMemory: Манифест не найден, строим по содержимому {self.memory_dir}")
+            self.rebuild_manifest()
+            return
+        
+        try:
+            with open(self._manifest_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            manifest = {int(chat_id): entry for chat_id, entry in data.get("chats", {}).items()}
+            total_messages = data.get("total_messages", 0)
+            total_bytes = data["total_bytes"]
+        except KeyError:
+            logging.info("AgentMemory: Манифест без учета места на диске, перестраиваем")
+            self.rebuild_manifest()
+            return
+        except Exception as e:
+            logging.error(f"AgentMemory: Манифест поврежден ({e}), перестраиваем")
+            self.rebuild_manifest()
+            return
         
-        # Загружаем существующие метаданные или создаем новые
-        if meta_path.exists():
+        # Чаты, созданные или удаленные после последнего сброса снимка
+        if self._journal_path.exists():
+            with open(self._journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # оборванная последняя строка
+                    chat_id = event["chat_id"]
+                    if event["op"] == "create" and chat_id not in manifest:
+                        manifest[chat_id] = self._scan_chat(chat_id)
+                        total_messages += manifest[chat_id]["message_count"]
+                        total_bytes += manifest[chat_id]["bytes"]
+                    elif event["op"] == "clear" and chat_id in manifest:
+                        entry = manifest.pop(chat_id)
+                        total_messages -= entry["message_count"]
+                        total_bytes -= entry.get("bytes", 0)
+        
+        self._manifest = manifest
+        self._total_messages = total_messages
+        self._total_bytes = total_bytes
+        self._manifest_stat = self._stat_manifest()
+
+    def _append_journal(self, event: Dict):
+        with open(self._journal_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(event) + "\n")
+
+    def _flush_manifest(self):
+        """Записывает снимок манифеста атомарно и обнуляет журнал."""
+        with self._metadata_lock:
+            if not self._manifest_dirty or self._manifest is None:
+                return
+            self._adopt_external_chats()
+            data = {
+                "total_messages": self._total_messages,
+                "total_bytes": self._total_bytes,
+                "chats": {str(chat_id): dict(entry) for chat_id, entry in self._manifest.items()},
+            }
+            self._manifest_dirty = False
+            # Снимок уже включает все события журнала — дальше журнал копится заново
+            _atomic_write_json(self._manifest_path, data)
+            self._manifest_stat = self._stat_manifest()
+            if self._journal_path.exists():
+                self._journal_path.unlink()
+
+    def _stat_manifest(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = self._manifest_path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _adopt_external_chats(self):
+        """
+        Если манифест на диске переписал другой процесс, добавляет в манифест в памяти
+        чаты, которые появились там (под _metadata_lock). Иначе наш снимок затер бы их.
+        """
+        if self._manifest_stat is None or self._stat_manifest() in (None, self._manifest_stat):
+            return
+        try:
+            with open(self._manifest_path, 'r', encoding='utf-8') as f:
+                external = json.load(f).get("chats", {})
+        except Exception as e:
+            logging.warning(f"AgentMemory: Не удалось прочитать манифест, измененный другим процессом: {e}")
+            return
+        adopted = 0
+        for key, entry in external.items():
+            chat_id = int(key)
+            # Чат, очищенный в этом процессе, не воскрешаем: его файлов уже нет
+            if chat_id in self._manifest or not self._get_metadata_file_path(chat_id).exists():
+                continue
+            self._manifest[chat_id] = entry
+            self._total_messages += entry.get("message_count", 0)
+            self._total_bytes += entry.get("bytes", 0)
+            adopted += 1
+        if adopted:
+            logging.info(f"AgentMemory: В манифест добавлено {adopted} чатов, записанных другим процессом")
+
+    def _read_metadata_file(self, chat_id: int) -> Optional[Dict]:
+        meta_path = self._get_metadata_file_path(chat_id)
+        if not meta_path.exists():
+            return None
+        try:
             with open(meta_path, 'r', encoding='utf-8') as f:
-                metadata = json.load(f)
+                return json.load(f)
+        except Exception as e:
+            logging.error(f"AgentMemory: Ошибка при загрузке метаданных чата {chat_id}: {e}")
+            return None
+
+    def _scan_chat(self, chat_id: int) -> Dict:
+        """Восстанавливает запись манифеста по файлам чата."""
+        metadata = self._read_metadata_file(chat_id)
+        if metadata is not None:
+            if "bytes" not in metadata:
+                metadata["bytes"] = self._measure_chat_bytes(chat_id, metadata)
+            return self._manifest_entry(metadata)
+        
+        # Метаданных нет — считаем сообщения по самим файлам истории
+        segment_log = SegmentLog(self._chat_path(chat_id, ".log"), self._chat_path(chat_id, ".idx"))
+        if segment_log.exists():
+            count = segment_log.count()
         else:
-            metadata = {
-                "chat_id": chat_id,
-                "created_at": datetime.now().isoformat(),
-                "message_count": 0,
-                "last_message_id": 0,
-                "last_update": None
-            }
+            count = 0
+            md_path = self._get_chat_file_path(chat_id)
+            if md_path.exists():
+                with open(md_path, 'r', encoding='utf-8') as f:
+                    count = sum(1 for line in f if line.startswith('### Сообщение #'))
+        return {"message_count": count, "last_message_id": 0, "last_update": None, "bytes": self._measure_chat_bytes(chat_id)}
+
+    def _iter_chat_files(self):
+        """Итерирует (chat_id, путь) по всем файлам чатов: в корне и в шард-директориях."""
+        stack = [self.memory_dir]
+        while stack:
+            directory = stack.pop()
+            for entry in os.scandir(directory):
+                if entry.is_dir():
+                    stack.append(Path(entry.path))
+                    continue
+                match = CHAT_FILE_PATTERN.match(entry.name)
+                if match:
+                    yield int(match.group(1)), Path(entry.path)
+
+    def _iter_chat_ids_on_disk(self) -> List[int]:
+        return sorted({chat_id for chat_id, _ in self._iter_chat_files()})
+
+    def migrate_layout(self, workers: int = 8, progress=None) -> Dict:
+        """
+        Переносит файлы чатов из плоской директории в шарды.
         
-        # Обновляем метаданные
-        metadata["message_count"] += 1
-        metadata["last_message_id"] = message_id
-        metadata["last_update"] = timestamp.isoformat()
+        Безопасно запускать рядом с работающим ботом в режиме "sharded":
+        файлы переносятся атомарным os.replace, а чат, к которому бот
+        обратился раньше утилиты, бот переносит сам при первом обращении.
+        
+        Args:
+            workers: Число потоков для переноса
+            progress: Необязательный callback(done, total) для вывода прогресса
+        
+        Returns:
+            Статистика: число чатов и перенесенных файлов
+        """
+        if self.layout != LAYOUT_SHARDED:
+            raise ValueError("Миграция раскладки доступна только для layout='sharded'")
+        
+        started = time.perf_counter()
+        flat_chats: Dict[int, List[Path]] = {}
+        for entry in os.scandir(self.memory_dir):
+            match = CHAT_FILE_PATTERN.match(entry.name)
+            if match and entry.is_file():
+                flat_chats.setdefault(int(match.group(1)), []).append(Path(entry.path))
+        
+        def migrate_chat(item) -> int:
+            chat_id, paths = item
+            shard_dir = self._shard_dir(chat_id)
+            shard_dir.mkdir(parents=True, exist_ok=True)
+            moved = sum(1 for path in paths if self._move_to_shard(path, shard_dir))
+            with self._placement_lock:
+                self._placed_chats.add(chat_id)
+            return moved
+        
+        moved_files = 0
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for done, moved in enumerate(executor.map(migrate_chat, flat_chats.items()), start=1):
+                moved_files += moved
+                if progress:
+                    progress(done, len(flat_chats))
+        
+        elapsed = time.perf_counter() - started
+        logging.info(f"AgentMemory: В шарды перенесено {moved_files} файлов {len(flat_chats)} чатов за {elapsed:.2f} с")
+        return {
+            "chats": len(flat_chats),
+            "moved_files": moved_files,
+            "elapsed_seconds": round(elapsed, 3),
+        }
+
+    def rebuild_manifest(self, workers: int = 8) -> Dict:
+        """
+        Перестраивает манифест по файлам на диске (команда восстановления).
         
-        # Сохраняем метаданные
-        with open(meta_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
+        Файлы чатов читаются параллельно в пуле потоков.
+        
+        Returns:
+            Статистика: число чатов, сообщений и время перестроения
+        """
+        started = time.perf_counter()
+        chat_ids = self._iter_chat_ids_on_disk()
+        
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            entries = list(executor.map(self._scan_chat, chat_ids))
+        
+        with self._metadata_lock:
+            manifest = dict(zip(chat_ids, entries))
+            # Метаданные из кеша свежее файлов, которые еще не сброшены
+            for chat_id, metadata in self._metadata.items():
+                manifest[chat_id] = self._manifest_entry(metadata)
+            self._manifest = manifest
+            self._total_messages = sum(entry["message_count"] for entry in manifest.values())
+            self._total_bytes = sum(entry.get("bytes", 0) for entry in manifest.values())
+            self._manifest_dirty = True
+            self._flush_manifest()
+        
+        elapsed = time.perf_counter() - started
+        logging.info(f"AgentMemory: Манифест перестроен: {len(manifest)} чатов за {elapsed:.2f} с")
+        return {
+            "total_chats": len(manifest),
+            "total_messages": self._total_messages,
+            "elapsed_seconds": round(elapsed, 3),
+        }
+
+    def close(self):
+        """Сбрасывает накопленные изменения на диск. Вызывается при остановке бота."""
+        self.flush_metadata()
+        self._handles.close_all()
+        if self.search_index is not None:
+            self.search_index.close()
+
+    def release_chat(self, chat_id: int):
+        """Сбрасывает изменения чата на диск и выгружает его из кешей и открытых файлов."""
+        self.flush_metadata()
+        with self._write_lock:
+            self._segment_logs.pop(chat_id, None)
+            for suffix in (".md", ".log", ".idx"):
+                self._handles.close(self._chat_path(chat_id, suffix))
+            self._markdown_sparse.pop(chat_id, None)
+        if self.search_index is not None:
+            with self._search_lock(chat_id):
+                self.search_index.release_chat(chat_id)
+                self._search_synced.discard(chat_id)
+        with self._metadata_lock:
+            if chat_id not in self._dirty_metadata:
+                self._metadata.pop(chat_id, None)
     
     def load_chat_history(self, chat_id: int, limit: Optional[int] = None) -> List[Tuple[int, int, str]]:
         """
@@ -136,121 +989,589 @@ class AgentMemory:
         Returns:
             Список кортежей (message_id, user_id, text)
         """
+        if self.storage_format == STORAGE_SEGMENTS:
+            segment_log = self._get_segment_log(chat_id)
+            # Чаты, сохраненные до перехода на сегменты, читаем из markdown
+            if segment_log.exists() or not self._get_chat_file_path(chat_id).exists():
+                return self._load_from_segments(chat_id, segment_log, limit)
+
+        return self._load_from_markdown(chat_id, limit)
+
+    def _load_from_segments(self, chat_id: int, segment_log: SegmentLog, limit: Optional[int]) -> List[Tuple[int, int, str]]:
+        """Читает последние сообщения из горячего сегмента с seek по индексу."""
+        def read() -> List[Record]:
+            if not limit:
+                return list(self._iter_all_records(chat_id, segment_log))
+            records = segment_log.tail(limit)
+            if len(records) < limit:
+                # Горячий сегмент короче лимита — добираем из холодных, начиная с новых
+                for segment in reversed(self._cold_segments(chat_id)):
+                    records = list(iter_sealed_segment(self._cold_file_path(chat_id, segment)))[-(limit - len(records)):] + records
+                    if len(records) >= limit:
+                        break
+            return records
+
+        try:
+            # Блокировка записи: не читаем сегмент посреди ротации
+            with self._write_lock:
+                records = self._read_consistent(chat_id, segment_log, read)
+            return [(message_id, user_id, text) for message_id, user_id, _, text in records]
+        except Exception as e:
+            logging.error(f"AgentMemory: Ошибка при чтении сегмента {segment_log.log_path}: {e}")
+            return []
+
+    def _load_from_markdown(self, chat_id: int, limit: Optional[int]) -> List[Tuple[int, int, str]]:
+        """Разбирает markdown файл чата построчно."""
         file_path = self._get_chat_file_path(chat_id)
         
         if not file_path.exists():
             return []
         
-        messages = []
+        # Для лимита держим только последние N сообщений, а не весь файл
+        messages = deque(maxlen=limit) if limit else []
         
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            
-            # Парсим markdown файл
-            # Разбиваем по заголовкам сообщений
-            message_blocks = content.split('### Сообщение #')[1:]  # Пропускаем заголовок файла
-            
-            for block in message_blocks:
-                try:
-                    lines = block.strip().split('\n')
-                    
-                    # Извлекаем message_id из первой строки
-                    message_id = int(lines[0].strip())
-                    
-                    # Извлекаем user_id
-                    user_line = [l for l in lines if l.startswith('**Пользователь:**')][0]
-                    user_id = int(user_line.split('User ')[1].strip())
-                    
-                    # Извлекаем текст сообщения (между тройными обратными кавычками)
-                    text_start = None
-                    text_end = None
-                    
-                    for i, line in enumerate(lines):
-                        if line.strip() == '```' and text_start is None:
-                            text_start = i + 1
-                        elif line.strip() == '```' and text_start is not None:
-                            text_end = i
-                            break
-                    
-                    if text_start is not None and text_end is not None:
-                        text = '\n'.join(lines[text_start:text_end])
-                        # Убираем экранирование
-                        text = text.replace('\\`', '`')
-                        messages.append((message_id, user_id, text))
-                
-                except (IndexError, ValueError) as e:
-                    logging.warning(f"AgentMemory: Не удалось распарсить блок сообщения: {e}")
-                    continue
-        
+            for message_id, user_id, _, text in iter_markdown_messages(file_path):
+                messages.append((message_id, user_id, text))
         except Exception as e:
             logging.error(f"AgentMemory: Ошибка при загрузке истории чата {chat_id}: {e}")
             return []
         
-        # Применяем лимит если указан
-        if limit and len(messages) > limit:
-            messages = messages[-limit:]
+        return list(messages)
+    
+    def iter_messages(self, chat_id: int, after_message_id: int = 0) -> Iterator[Tuple[int, int, str]]:
+        """
+        Итерирует сообщения чата, начиная со следующего за after_message_id.
         
-        return messages
+        Чтение начинается с ближайшей точки разреженного индекса, а холодные
+        сегменты, целиком лежащие до after_message_id, пропускаются.
+        
+        Args:
+            chat_id: ID чата
+            after_message_id: ID сообщения, после которого начинать (0 — с начала)
+        
+        Yields:
+            Кортежи (message_id, user_id, text)
+        """
+        for message_id, user_id, _, text in self._iter_records_from(chat_id, SPARSE_BY_MESSAGE_ID, after_message_id + 1):
+            if message_id > after_message_id:
+                yield message_id, user_id, text
+
+    def load_chat_range(self, chat_id: int, since: datetime, until: datetime) -> Iterator[Tuple[int, int, str]]:
+        """
+        Итерирует сообщения чата за период [since, until].
+        
+        Args:
+            chat_id: ID чата
+            since: Начало периода (включительно)
+            until: Конец периода (включительно)
+        
+        Yields:
+            Кортежи (message_id, user_id, text)
+        """
+        since_ts, until_ts = since.timestamp(), until.timestamp()
+        for message_id, user_id, timestamp, text in self._iter_records_from(chat_id, SPARSE_BY_TIMESTAMP, since_ts):
+            if timestamp > until_ts:
+                return
+            if timestamp >= since_ts:
+                yield message_id, user_id, text
+
+    def _iter_records_from(self, chat_id: int, field: int, value: float) -> Iterator[Record]:
+        """
+        Записи чата начиная с места, где поле field (время или ID сообщения)
+        впервые достигает value. Записи до этого места могут попасться —
+        вызывающий код их отсеивает.
+        """
+        if self.storage_format == STORAGE_SEGMENTS:
+            # Блокировка записи: снимок холодных сегментов и открытие горячего
+            # должны произойти между ротациями
+            with self._write_lock:
+                segment_log = self._get_segment_log(chat_id)
+                if segment_log.exists() or not self._get_chat_file_path(chat_id).exists():
+                    def snapshot():
+                        cold_segments = self._cold_segments(chat_id)
+                        if self.read_only:
+                            segment_log.sparse.refresh()
+                        hot_file = segment_log.open_reader()
+                        return cold_segments, hot_file, segment_log.sparse.floor(field, value)
+
+                    def discard(stale):
+                        if stale[1] is not None:
+                            stale[1].close()
+
+                    cold_segments, hot_file, offset = self._read_consistent(chat_id, segment_log, snapshot, discard)
+                    return self._iter_segments_from(chat_id, cold_segments, segment_log, hot_file, offset, field, value)
+
+        file_path = self._get_chat_file_path(chat_id)
+        if not file_path.exists():
+            return iter(())
+        with self._write_lock:
+            offset = self._get_markdown_sparse(chat_id).floor(field, value)
+        return (
+            (message_id, user_id, timestamp.timestamp() if timestamp else 0.0, text)
+            for message_id, user_id, timestamp, text in iter_markdown_messages(file_path, offset)
+        )
+
+    def _read_consistent(self, chat_id: int, segment_log: SegmentLog, read, discard=None):
+        """
+        Выполняет read() так, чтобы лог, индексы и список холодных сегментов
+        оказались из одной версии чата.
+
+        Писатель в своем процессе держит _write_lock, а читатель в режиме
+        read_only живет в другом процессе и может попасть на ротацию или очистку
+        по лимитам: прочитать смещение из старого индекса и данные из нового лога
+        или список холодных сегментов до того, как в него попал только что
+        запечатанный. Поэтому поколение сегмента сверяется до и после чтения,
+        а при перезаписи, идущей прямо сейчас, чтение повторяется.
+
+        Args:
+            read: Чтение, результат которого нужно вернуть
+            discard: Освобождает результат отброшенной попытки (например, закрывает файл)
+        """
+        if not self.read_only:
+            return read()
+
+        for _ in range(READ_RETRIES):
+            generation = segment_log.generation()
+            if generation is not None and not self._rotation_pending(chat_id):
+                try:
+                    result = read()
+                except Exception:
+                    # Файл исчез или запись оборвалась из-за перезаписи — повторяем
+                    if segment_log.generation() == generation:
+                        raise
+                else:
+                    if segment_log.generation() == generation:
+                        return result
+                    if discard is not None:
+                        discard(result)
+            time.sleep(READ_RETRY_DELAY)
+
+        logging.warning(f"AgentMemory: Чат {chat_id}: сегмент переписывается дольше ожидаемого, читаем как есть")
+        return read()
+
+    def _rotation_pending(self, chat_id: int) -> bool:
+        """
+        Ротация записала холодный сегмент, но еще не внесла его в метаданные
+        (тот же признак, по которому _recover_rotation находит прерванную ротацию).
+        """
+        metadata = self._load_metadata(chat_id)
+        seq = metadata.get("next_segment_seq", 0) if metadata else 0
+        return self._cold_segment_path(chat_id, seq).exists()
+
+    def _iter_segments_from(
+        self, chat_id: int, cold_segments: List[Dict], segment_log: SegmentLog,
+        hot_file, offset: int, field: int, value: float,
+    ) -> Iterator[Record]:
+        try:
+            last_key = "last_ts" if field == SPARSE_BY_TIMESTAMP else "last_message_id"
+            for segment in cold_segments:
+                if segment[last_key] < value:
+                    continue
+                try:
+                    yield from iter_sealed_segment(self._cold_file_path(chat_id, segment))
+                except FileNotFoundError:
+                    # Сегмент успела удалить очистка по лимитам
+                    continue
+            if hot_file is not None:
+                yield from segment_log.iter_file(hot_file, offset)
+        finally:
+            if hot_file is not None:
+                hot_file.close()
     
-    def get_metadata(self, chat_id: int) -> Optional[Dict]:
-        """Возвращает метаданные чата."""
-        meta_path = self._get_metadata_file_path(chat_id)
+    def search_messages(
+        self, chat_id: int, text: str, limit: int = 5, before_message_id: Optional[int] = None,
+    ) -> List[Tuple[int, int, str]]:
+        """
+        Находит в истории чата сообщения, лексически близкие к тексту.
         
-        if not meta_path.exists():
-            return None
+        Args:
+            chat_id: ID чата
+            text: Текст запроса (обычно сообщение, на которое отреагировали)
+            limit: Сколько сообщений вернуть
+            before_message_id: Искать только среди сообщений старше этого
+        
+        Returns:
+            Список кортежей (message_id, user_id, text) в хронологическом порядке
+        """
+        if self.search_index is None:
+            return []
         
+        started = time.perf_counter()
         try:
-            with open(meta_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            self._catch_up_search_index(chat_id)
+            found = sorted(self.search_index.search(chat_id, text, limit, before_message_id))
+            messages = []
+            for message_id in found:
+                # Текст берем из истории с seek по разреженному индексу;
+                # сообщения, удаленные очисткой по лимитам, просто не находятся
+                iterator = self.iter_messages(chat_id, after_message_id=message_id - 1)
+                message = next(iterator, None)
+                iterator.close()
+                if message is not None and message[0] == message_id:
+                    messages.append(message)
         except Exception as e:
-            logging.error(f"AgentMemory: Ошибка при загрузке метаданных чата {chat_id}: {e}")
-            return None
+            logging.error(f"AgentMemory: Ошибка поиска по истории чата {chat_id}: {e}")
+            return []
+        self.search_index.record_latency((time.perf_counter() - started) * 1000)
+        return messages
+
+    def _catch_up_search_index(self, chat_id: int):
+        """
+        При первом обращении к чату доиндексирует сообщения, сохраненные
+        до включения поиска или потерянные из буфера индекса при сбое.
+        """
+        if chat_id in self._search_synced:
+            return
+        # Пока идет догон, писатель ждет замок: иначе его add сдвинул бы indexed_through
+        # вперед и пачки догона со старыми ID были бы пропущены
+        with self._search_lock(chat_id):
+            if chat_id in self._search_synced:
+                return
+            indexed_through = self.search_index.indexed_through(chat_id)
+            metadata = self._load_metadata(chat_id)
+            if metadata and metadata.get("last_message_id", 0) > indexed_through:
+                batch = []
+                for message_id, _, text in self.iter_messages(chat_id, after_message_id=indexed_through):
+                    batch.append((message_id, text))
+                    if len(batch) >= self.search_index.flush_messages:
+                        self.search_index.add(chat_id, batch)
+                        batch = []
+                self.search_index.add(chat_id, batch)
+                logging.info(f"AgentMemory: Чат {chat_id}: поисковый индекс догнал историю")
+            # Отмечаем только после догона: при ошибке он повторится при следующем обращении
+            self._search_synced.add(chat_id)
+
+    def _search_lock(self, chat_id: int) -> threading.RLock:
+        return self._search_locks[chat_id % SEARCH_LOCK_STRIPES]
     
-    def list_chats(self) -> List[int]:
-        """Возвращает список ID всех чатов в памяти."""
-        chat_ids = []
+    def export_markdown(self, chat_id: int, output_path: Optional[Path] = None) -> Optional[Path]:
+        """
+        Выгружает историю чата из сегмента в markdown (представление для чтения людьми).
         
-        for file_path in self.memory_dir.glob("chat_*_meta.json"):
-            try:
-                # Извлекаем chat_id из имени файла
-                filename = file_path.stem  # chat_123_meta
-                chat_id = int(filename.split('_')[1])
-                chat_ids.append(chat_id)
-            except (IndexError, ValueError):
-                continue
+        Args:
+            chat_id: ID чата
+            output_path: Куда записать файл (по умолчанию — стандартный markdown файл чата)
         
-        return sorted(chat_ids)
+        Returns:
+            Путь к созданному файлу или None, если сегмента нет
+        """
+        segment_log = self._get_segment_log(chat_id)
+        if not segment_log.exists():
+            return None
+
+        output_path = Path(output_path) if output_path else self._get_chat_file_path(chat_id)
+        self._handles.close(output_path)
+        with open(output_path, 'w', encoding='utf-8') as f:
+            f.write(self._render_header(chat_id))
+            for message_id, user_id, timestamp, text in self._iter_all_records(chat_id, segment_log):
+                f.write(self._format_message(message_id, user_id, text, datetime.fromtimestamp(timestamp)) + "\n\n")
+        if output_path == self._get_chat_file_path(chat_id):
+            self._rebuild_markdown_sparse(output_path, self._get_markdown_sparse(chat_id))
+
+        logging.info(f"AgentMemory: История чата {chat_id} экспортирована в {output_path}")
+        return output_path
+
+    def get_metadata(self, chat_id: int) -> Optional[Dict]:
+        """Возвращает метаданные чата."""
+        metadata = self._load_metadata(chat_id)
+        return dict(metadata) if metadata is not None else None
+    
+    def list_chats(self) -> List[int]:
+        """Возвращает список ID всех чатов в памяти (из манифеста, без обхода директории)."""
+        return sorted(self._get_manifest())
     
     def clear_chat(self, chat_id: int):
         """Очищает историю конкретного чата."""
-        file_path = self._get_chat_file_path(chat_id)
-        meta_path = self._get_metadata_file_path(chat_id)
+        cold_segments = self._cold_segments(chat_id)
         
-        if file_path.exists():
-            file_path.unlink()
-            logging.info(f"AgentMemory: Удален файл истории чата {chat_id}")
+        with self._metadata_lock:
+            self._metadata.pop(chat_id, None)
+            self._dirty_metadata.discard(chat_id)
+            entry = self._get_manifest().pop(chat_id, None) if self.track_manifest else None
+            if entry is not None:
+                self._total_messages -= entry["message_count"]
+                self._total_bytes -= entry.get("bytes", 0)
+                self._manifest_dirty = True
+                self._append_journal({"op": "clear", "chat_id": chat_id})
         
-        if meta_path.exists():
-            meta_path.unlink()
-            logging.info(f"AgentMemory: Удалены метаданные чата {chat_id}")
+        with self._write_lock:
+            file_path = self._get_chat_file_path(chat_id)
+            meta_path = self._get_metadata_file_path(chat_id)
+            
+            self._handles.close(file_path)
+            if file_path.exists():
+                file_path.unlink()
+                logging.info(f"AgentMemory: Удален файл истории чата {chat_id}")
+            self._markdown_sparse.pop(chat_id, None)
+            self._chat_path(chat_id, ".md.sparse").unlink(missing_ok=True)
+            
+            if meta_path.exists():
+                meta_path.unlink()
+                logging.info(f"AgentMemory: Удалены метаданные чата {chat_id}")
+            
+            segment_log = self._segment_logs.pop(chat_id, None) or SegmentLog(
+                self._chat_path(chat_id, ".log"), self._chat_path(chat_id, ".idx"), self._handles
+            )
+            if segment_log.exists():
+                segment_log.delete()
+                logging.info(f"AgentMemory: Удален сегмент истории чата {chat_id}")
+            
+            for segment in cold_segments:
+                cold_path = self._cold_file_path(chat_id, segment)
+                if cold_path.exists():
+                    cold_path.unlink()
+            if cold_segments:
+                logging.info(f"AgentMemory: Удалено {len(cold_segments)} холодных сегментов чата {chat_id}")
+        
+        if self.search_index is not None:
+            with self._search_lock(chat_id):
+                self.search_index.drop_chat(chat_id)
+                self._search_synced.discard(chat_id)
     
     def get_statistics(self) -> Dict:
-        """Возвращает статистику по всей памяти."""
+        """Возвращает статистику по всей памяти (по текущим итогам манифеста)."""
         chats = self.list_chats()
-        total_messages = 0
-        
-        for chat_id in chats:
-            metadata = self.get_metadata(chat_id)
-            if metadata:
-                total_messages += metadata.get('message_count', 0)
         
-        return {
+        stats = {
             "total_chats": len(chats),
-            "total_messages": total_messages,
+            "total_messages": self._total_messages,
+            "total_bytes": self._total_bytes,
             "chat_ids": chats
         }
+        if self.search_index is not None:
+            stats["search"] = self.search_index.get_statistics()
+        return stats
+
+    def chat_usage(self) -> Dict[int, Dict]:
+        """Текущие счетчики всех чатов из манифеста: сообщения, байты, время обновления."""
+        with self._metadata_lock:
+            return {chat_id: dict(entry) for chat_id, entry in self._get_manifest().items()}
+
+    def recent_chats(self, limit: int) -> List[int]:
+        """ID не больше limit чатов, от недавно обновленных к давним (по манифесту)."""
+        usage = self.chat_usage()
+        return heapq.nlargest(limit, usage, key=lambda chat_id: usage[chat_id].get("last_update") or "")
+
+    def apply_retention(
+        self,
+        chat_id: int,
+        max_messages: int = 0,
+        max_bytes: int = 0,
+        max_age: float = 0,
+    ) -> Dict:
+        """
+        Удаляет самые старые сообщения чата, выходящие за лимиты хранения.
+        
+        Чаты в пределах лимитов отсеиваются по метаданным без чтения файлов.
+        Холодные сегменты целиком за пределами лимитов удаляются без распаковки,
+        переписывается только пограничный сегмент.
+        
+        Args:
+            chat_id: ID чата
+            max_messages: Сколько последних сообщений хранить (0 — без ограничения)
+            max_bytes: Сколько байт истории хранить на диске (0 — без ограничения)
+            max_age: Максимальный возраст сообщений в секундах (0 — без ограничения)
+        
+        Returns:
+            Сколько сообщений удалено и сколько байт освобождено
+        """
+        metadata = self._load_metadata(chat_id)
+        if metadata is None:
+            return {"messages": 0, "bytes": 0}
+        
+        cutoff = time.time() - max_age if max_age else None
+        first_ts = metadata.get("first_ts")
+        over_limits = (
+            (max_messages and metadata["message_count"] > max_messages)
+            or (max_bytes and metadata.get("bytes", 0) > max_bytes)
+            or (cutoff is not None and (first_ts is None or first_ts < cutoff))
+        )
+        if not over_limits:
+            return {"messages": 0, "bytes": 0}
+        
+        bytes_before = metadata.get("bytes", 0)
+        budget = _RetentionBudget(max_messages, max_bytes, cutoff)
+        with self._write_lock:
+            segment_log = self._get_segment_log(chat_id) if self.storage_format == STORAGE_SEGMENTS else None
+            if segment_log is not None and (segment_log.exists() or not self._get_chat_file_path(chat_id).exists()):
+                removed, first_ts, segments, doomed = self._trim_segments(chat_id, segment_log, budget)
+                if self.markdown_export and removed and self._get_chat_file_path(chat_id).exists():
+                    self.export_markdown(chat_id)
+            else:
+                removed, first_ts = self._trim_markdown(chat_id, budget)
+                segments, doomed = None, []
+            
+            if removed:
+                with self._metadata_lock:
+                    metadata["message_count"] = max(0, metadata["message_count"] - removed)
+                    metadata["first_ts"] = first_ts
+                    if segments is not None:
+                        metadata["segments"] = segments
+                    metadata["bytes"] = self._measure_chat_bytes(chat_id, metadata)
+                    self._sync_manifest_entry(chat_id, metadata)
+                    snapshot = dict(metadata)
+                    self._dirty_metadata.discard(chat_id)
+                # Метаданные пишем до удаления холодных сегментов, чтобы не сослаться на удаленный файл
+                _atomic_write_json(self._get_metadata_file_path(chat_id), snapshot)
+                for path in doomed:
+                    if path.exists():
+                        path.unlink()
+            else:
+                # Самое старое сообщение в пределах лимита — запоминаем, чтобы не проверять файлы снова
+                with self._metadata_lock:
+                    metadata["first_ts"] = first_ts
+                    self._dirty_metadata.add(chat_id)
+        
+        if not removed:
+            return {"messages": 0, "bytes": 0}
+        
+        if metadata["message_count"] == 0:
+            # Ничего не осталось — убираем чат целиком вместе с пустыми файлами
+            self.clear_chat(chat_id)
+            reclaimed = bytes_before
+        else:
+            reclaimed = max(0, bytes_before - metadata["bytes"])
+        
+        logging.info(f"AgentMemory: Чат {chat_id}: по лимитам хранения удалено {removed} сообщений, освобождено {reclaimed} байт")
+        return {"messages": removed, "bytes": reclaimed}
+
+    def _trim_segments(self, chat_id: int, segment_log: SegmentLog, budget: _RetentionBudget):
+        """
+        Оставляет в сегментах чата только новейшие сообщения, укладывающиеся в бюджет.
+        
+        Returns:
+            (удалено сообщений, время самого старого оставшегося, новые описания
+            холодных сегментов, файлы холодных сегментов к удалению)
+        """
+        hot = list(segment_log.iter_records())
+        keep = 0
+        for record in reversed(hot):
+            if not budget.take(record[2], len(encode_record(*record)) + INDEX_ENTRY.size):
+                break
+            keep += 1
+        
+        removed = len(hot) - keep
+        exhausted = removed > 0
+        if exhausted:
+            hot = hot[removed:]
+            segment_log.rewrite(hot)
+        
+        kept_segments = []
+        doomed = []
+        for segment in reversed(self._cold_segments(chat_id)):
+            path = self._cold_file_path(chat_id, segment)
+            if not exhausted and budget.take(segment["first_ts"], segment["bytes"], segment["count"]):
+                kept_segments.append(segment)
+                continue
+            
+            if not exhausted:
+                # Пограничный сегмент: оставляем его новейшую часть
+                exhausted = True
+                records = list(iter_sealed_segment(path))
+                record_size = segment["bytes"] / max(1, segment["count"])
+                keep = 0
+                for record in reversed(records):
+                    if not budget.take(record[2], record_size):
+                        break
+                    keep += 1
+                if keep:
+                    info = write_sealed_segment(path, records[len(records) - keep:])
+                    info["seq"] = segment["seq"]
+                    kept_segments.append(info)
+                    removed += len(records) - keep
+                    continue
+            
+            removed += segment["count"]
+            doomed.append(path)
+        
+        kept_segments.reverse()
+        if kept_segments:
+            first_ts = kept_segments[0]["first_ts"]
+        else:
+            first_ts = hot[0][2] if hot else None
+        return removed, first_ts, kept_segments, doomed
+
+    def _trim_markdown(self, chat_id: int, budget: _RetentionBudget):
+        """
+        Оставляет в markdown файле чата только новейшие сообщения, укладывающиеся в бюджет.
+        
+        Returns:
+            (удалено сообщений, время самого старого оставшегося)
+        """
+        file_path = self._get_chat_file_path(chat_id)
+        if not file_path.exists():
+            return 0, None
+        
+        content = file_path.read_text(encoding='utf-8')
+        header, *blocks = content.split('### Сообщение #')
+        
+        kept: List[str] = []
+        first_ts = None
+        for block in reversed(blocks):
+            match = re.search(r"^\*\*Время:\*\* (.+)$", block, re.MULTILINE)
+            try:
+                timestamp = datetime.strptime(match.group(1).strip(), '%Y-%m-%d %H:%M:%S').timestamp()
+            except (AttributeError, ValueError):
+                timestamp = time.time()  # без даты сообщение не считается устаревшим
+            if not budget.take(timestamp, len(('### Сообщение #' + block).encode('utf-8'))):
+                break
+            kept.append(block)
+            first_ts = timestamp
+        
+        removed = len(blocks) - len(kept)
+        if removed:
+            kept.reverse()
+            self._handles.close(file_path)
+            tmp_path = file_path.with_name(file_path.name + ".tmp")
+            tmp_path.write_text(header + "".join('### Сообщение #' + block for block in kept), encoding='utf-8')
+            os.replace(tmp_path, file_path)
+            self._rebuild_markdown_sparse(file_path, self._get_markdown_sparse(chat_id))
+        return removed, first_ts
+
+
+# Бэкенды хранения памяти
+BACKEND_FILES = "files"  # файлы на чат (markdown или сегменты)
+BACKEND_SQLITE = "sqlite"  # одна база SQLite в режиме WAL
+
+
+def create_agent_memory(use_daemon: bool = True):
+    """
+    Создает хранилище памяти согласно MEMORY_BACKEND из конфига.
+    
+    Args:
+        use_daemon: При заданном MEMORY_DAEMON_SOCKET писать через демона-писателя
+            (False — в самом демоне, который владеет директорией)
+    """
+    if config.MEMORY_BACKEND == BACKEND_SQLITE:
+        from .memory_sqlite import SQLiteMemory
+        return SQLiteMemory(db_path=str(Path(config.MEMORY_DIR) / "memory.db"))
+
+    if config.MEMORY_BACKEND != BACKEND_FILES:
+        raise ValueError(f"Неизвестный бэкенд памяти: {config.MEMORY_BACKEND}")
+
+    settings = dict(
+        memory_dir=config.MEMORY_DIR,
+        storage_format=config.MEMORY_FORMAT,
+        markdown_export=config.MEMORY_MARKDOWN_EXPORT,
+        metadata_flush_interval=config.MEMORY_META_FLUSH_INTERVAL,
+        max_open_files=config.MEMORY_MAX_OPEN_FILES,
+        layout=config.MEMORY_LAYOUT,
+        segment_max_bytes=config.MEMORY_SEGMENT_MAX_BYTES,
+        segment_max_age=config.MEMORY_SEGMENT_MAX_AGE_HOURS * 3600,
+        segment_tail_keep=config.MEMORY_SEGMENT_TAIL_KEEP,
+    )
+    if use_daemon and config.MEMORY_DAEMON_SOCKET:
+        from .memory_daemon import RemoteMemory
+        return RemoteMemory(config.MEMORY_DAEMON_SOCKET, reader=AgentMemory(read_only=True, **settings))
+
+    return AgentMemory(
+        search_index=MemorySearchIndex(
+            Path(config.MEMORY_DIR) / "search", max_open_chats=config.MEMORY_SEARCH_MAX_OPEN_CHATS,
+        ) if config.MEMORY_SEARCH_ENABLED else None,
+        **settings,
+    )
 
 
 # Инициализируем синглтон для использования в приложении
-agent_memory = AgentMemory()
+agent_memory = create_agent_memory()
@@ -12,7 +12,22 @@ class Settings(BaseSettings):
     # OpenRouter/LLM
     OPENROUTER_API_KEY: str
     OPENROUTER_MODEL: str = "google/gemini-3-flash-preview"
+    OPENROUTER_FALLBACK_MODEL: str = ""  # Запасная модель для хеджирования медленных ответов (пусто — выключено)
     LLM_MOCK_ENABLED: bool = False
+    LLM_MAX_CONNECTIONS: int = 200  # Размер пула HTTP-соединений к OpenRouter (одновременных запросов)
+    LLM_MAX_KEEPALIVE_CONNECTIONS: int = 50  # Сколько простаивающих соединений держать открытыми
+    LLM_KEEPALIVE_EXPIRY: float = 60.0  # Через сколько секунд простоя закрывать соединение
+    LLM_TIMEOUT: float = 60.0  # Таймаут (сек) одного запроса к LLM, включая ожидание соединения из пула
+    LLM_CONNECT_TIMEOUT: float = 5.0  # Таймаут (сек) подключения к OpenRouter
+    LLM_MAX_RETRIES: int = 2  # Сколько раз повторять запрос к LLM при сетевых ошибках
+    LLM_STREAMING: bool = False  # Читать ответ LLM потоком и начинать поиск шаблона, как только готов search_query
+    LLM_CACHE_SIZE: int = 1000  # Сколько идей мемов кешировать по входам промпта (0 — без кеша)
+    LLM_CACHE_TTL: float = 3600.0  # Время жизни (сек) идеи в кеше
+    LLM_CACHE_PERSIST: bool = False  # Сохранять кеш идей в MEMORY_DIR между перезапусками
+    LLM_HEDGE_QUANTILE: float = 0.9  # Квантиль задержек основной модели, после которого запускается запасная
+    LLM_HEDGE_MIN_SAMPLES: int = 20  # Сколько замеров нужно для квантиля (до этого ждем LLM_HEDGE_MAX_DELAY)
+    LLM_HEDGE_MIN_DELAY: float = 0.5  # Нижняя граница (сек) порога хеджирования
+    LLM_HEDGE_MAX_DELAY: float = 10.0  # Верхняя граница (сек) порога хеджирования
     
     # Tavily Search
     TAVILY_API_KEY: str
@@ -23,9 +38,40 @@ class Settings(BaseSettings):
     
     # History
     HISTORY_SIZE: int = 10 # Сколько сообщений хранить
+    HISTORY_MAX_TEXT_BYTES: int = 0  # Сколько байт текста хранить на сообщение в истории (0 — без ограничения)
+    HISTORY_MEMORY_BUDGET_MB: float = 0  # Бюджет памяти истории всех чатов в МБ, давние чаты выгружаются (0 — без ограничения)
+    HISTORY_IDLE_TTL_MINUTES: float = 0  # Через сколько минут простоя выгружать историю чата (0 — не выгружать)
+    HISTORY_PREWARM_CHATS: int = 0  # Сколько недавно активных чатов фоново загрузить после старта (0 — только по обращению)
+    HISTORY_SNAPSHOT_ENABLED: bool = False  # Сохранять историю в бинарный снимок при остановке и периодически
+    HISTORY_SNAPSHOT_INTERVAL: float = 300.0  # Интервал (сек) периодического снимка истории
+    CONTEXT_TOKEN_BUDGET: int = 1500  # Бюджет контекста промпта в токенах, триггер остается всегда (0 — без ограничения)
     
     # Agent Memory
     MEMORY_DIR: str = "memory"  # Директория для хранения markdown файлов с историей
     MEMORY_ENABLED: bool = True  # Включить сохранение истории в markdown
+    MEMORY_BACKEND: str = "files"  # Бэкенд памяти: "files" (файлы на чат) или "sqlite" (одна база в режиме WAL)
+    MEMORY_FORMAT: str = "markdown"  # Формат хранения: "markdown" или "segments" (append-only лог с индексом)
+    MEMORY_MARKDOWN_EXPORT: bool = False  # В режиме "segments" дополнительно писать markdown для чтения людьми
+    MEMORY_META_FLUSH_INTERVAL: float = 5.0  # Интервал (сек) сброса метаданных чатов из кеша на диск
+    MEMORY_ASYNC_WRITES: bool = True  # Писать память в фоновом потоке, не блокируя обработчики
+    MEMORY_WRITER_QUEUE_SIZE: int = 10000  # Максимальная длина очереди фонового писателя
+    MEMORY_WRITER_BATCH_SIZE: int = 500  # Максимум сообщений в одной пачке записи
+    MEMORY_WRITER_PUT_TIMEOUT: float = 5.0  # Сколько секунд ждать места в заполненной очереди писателя (0 — отбрасывать сразу)
+    MEMORY_MAX_OPEN_FILES: int = 256  # Сколько файлов истории держать открытыми на дозапись
+    MEMORY_LAYOUT: str = "flat"  # Раскладка файлов: "flat" или "sharded" (memory/ab/cd/chat_<id>.*)
+    MEMORY_SEGMENT_MAX_BYTES: int = 8 * 1024 * 1024  # Размер горячего сегмента, после которого он сжимается в холодный (0 — без лимита)
+    MEMORY_SEGMENT_MAX_AGE_HOURS: float = 0  # Возраст горячего сегмента для ротации в часах (0 — без лимита)
+    MEMORY_SEGMENT_TAIL_KEEP: int = 100  # Сколько последних сообщений остается в горячем сегменте после ротации
+    MEMORY_RETENTION_MAX_MESSAGES: int = 0  # Лимит сообщений на чат (0 — без лимита)
+    MEMORY_RETENTION_MAX_BYTES: int = 0  # Лимит байт истории на чат (0 — без лимита)
+    MEMORY_RETENTION_MAX_AGE_DAYS: float = 0  # Максимальный возраст сообщений в днях (0 — без лимита)
+    MEMORY_RETENTION_GLOBAL_MAX_MESSAGES: int = 0  # Лимит сообщений на всю память (0 — без лимита)
+    MEMORY_RETENTION_GLOBAL_MAX_BYTES: int = 0  # Лимит байт на всю память (0 — без лимита)
+    MEMORY_RETENTION_SWEEP_INTERVAL: float = 60.0  # Пауза между шагами фоновой очистки, сек
+    MEMORY_RETENTION_BATCH_SIZE: int = 50  # Сколько чатов проверять за один шаг очистки
+    MEMORY_SEARCH_ENABLED: bool = False  # Вести поисковый индекс и добавлять в контекст похожие старые сообщения
+    MEMORY_SEARCH_TOP_K: int = 5  # Сколько старых сообщений из поиска добавлять к контексту
+    MEMORY_SEARCH_MAX_OPEN_CHATS: int = 256  # Сколько чатов держать в поисковом индексе с открытыми сегментами
+    MEMORY_DAEMON_SOCKET: str = ""  # Unix сокет демона-писателя памяти; пусто — процесс пишет в память сам
 
 config = Settings()
@@ -0,0 +1,207 @@
+"""
+Сборка контекста для промпта MemeBrain в пределах бюджета токенов.
+
+Сообщения сжимаются (повторяющиеся строки схлопываются, ссылки и блоки
+кода сокращаются), затем в контекст берутся самые свежие из них, пока
+хватает бюджета. Сообщение-триггер попадает в контекст всегда.
+"""
+import re
+from functools import lru_cache
+from typing import Dict, List, Sequence, Tuple
+
+URL_PATTERN = re.compile(r"https?://([^\s/?#]+)[^\s]*")
+CODE_BLOCK_PATTERN = re.compile(r"```(.*?)(?:```|$)", re.S)
+# Сколько строк оставлять от блока кода
+CODE_BLOCK_KEEP_LINES = 3
+# Ссылка короче этого остается как есть
+URL_KEEP_CHARS = 40
+# Доля бюджета, которую может занять одно сообщение (триггер — половину)
+MESSAGE_BUDGET_SHARE = 4
+# Токенов на префикс строки "User <id>: "
+LINE_OVERHEAD_TOKENS = 6
+# Границы корзин гистограммы размеров, в токенах
+HISTOGRAM_BUCKETS = (128, 256, 512, 1024, 2048, 4096)
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов: около 4 байт UTF-8 на токен (кириллица — около 2 символов)."""
+    return len(text.encode("utf-8")) // 4 + 1
+
+
+def _shorten_code(match: re.Match) -> str:
+    lines = match.group(1).strip("\n").split("\n")
+    if len(lines) <= CODE_BLOCK_KEEP_LINES:
+        return match.group(0)
+    kept = "\n".join(lines[:CODE_BLOCK_KEEP_LINES])
+    return f"```{kept}\n… (еще {len(lines) - CODE_BLOCK_KEEP_LINES} строк кода)```"
+
+
+def _shorten_url(match: re.Match) -> str:
+    if len(match.group(0)) <= URL_KEEP_CHARS:
+        return match.group(0)
+    return f"{match.group(1)}/…"
+
+
+def _collapse_repeats(text: str) -> str:
+    """Схлопывает подряд идущие одинаковые строки в одну с пометкой ×N."""
+    lines = text.split("\n")
+    if len(lines) < 2:
+        return text
+    collapsed = []
+    previous, count = lines[0], 1
+    for line in lines[1:] + [None]:
+        if line is not None and line.strip() == previous.strip():
+            count += 1
+            continue
+        collapsed.append(f"{previous} ×{count}" if count > 1 else previous)
+        if line is not None:
+            previous, count = line, 1
+    return "\n".join(collapsed)
+
+
+def compress_text(text: str) -> str:
+    """Сокращает блоки кода и длинные ссылки, схлопывает повторы строк."""
+    if "```" in text:
+        text = CODE_BLOCK_PATTERN.sub(_shorten_code, text)
+    if "://" in text:
+        text = URL_PATTERN.sub(_shorten_url, text)
+    if "\n" in text:
+        text = _collapse_repeats(text)
+    return text
+
+
+@lru_cache(maxsize=8192)
+def compressed_message(text: str) -> Tuple[str, int]:
+    """Сжатый текст сообщения и его оценка в токенах (кешируются по тексту)."""
+    compressed = compress_text(text)
+    return compressed, estimate_tokens(compressed)
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """
+    Обрезает текст так, чтобы estimate_tokens() результата не превышала max_tokens
+    (но не короче одного токена), не разрывая символы. Место под «…» резервируется.
+    """
+    max_tokens = max(max_tokens, 1)
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    # estimate_tokens = байты // 4 + 1, а «…» — 3 байта UTF-8: на текст остается 4 * (max_tokens - 1) байт
+    limit = 4 * (max_tokens - 1)
+    return text.encode("utf-8")[:limit].decode("utf-8", errors="ignore") + "…"
+
+
+class TokenHistogram:
+    """Гистограмма размеров в токенах с фиксированными корзинами HISTOGRAM_BUCKETS."""
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.total = 0
+        self.max = 0
+
+    def record(self, tokens: int):
+        for i, bound in enumerate(HISTOGRAM_BUCKETS):
+            if tokens <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += tokens
+        self.max = max(self.max, tokens)
+
+    def get_statistics(self) -> Dict:
+        count = sum(self.counts)
+        buckets = {f"<={bound}": n for bound, n in zip(HISTOGRAM_BUCKETS, self.counts)}
+        buckets[f">{HISTOGRAM_BUCKETS[-1]}"] = self.counts[-1]
+        return {
+            "count": count,
+            "avg": round(self.total / count, 1) if count else 0.0,
+            "max": self.max,
+            "buckets": buckets,
+        }
+
+
+class ContextAssembler:
+    """
+    Собирает строки контекста в пределах бюджета токенов и ведет
+    гистограммы размера контекста до и после сжатия.
+    """
+
+    def __init__(self, token_budget: int = 0):
+        """
+        Args:
+            token_budget: Бюджет контекста в токенах (0 — без ограничения, только сжатие)
+        """
+        self.token_budget = token_budget
+        self.raw_tokens = TokenHistogram()
+        self.context_tokens = TokenHistogram()
+        self.dropped_messages = 0
+
+    def assemble(
+        self,
+        recent: Sequence[Tuple[int, int, str]],
+        triggered_id: int,
+        related: Sequence[Tuple[int, int, str]] = (),
+    ) -> List[str]:
+        """
+        Args:
+            recent: Последние сообщения чата (message_id, user_id, text) от старых к новым
+            triggered_id: ID сообщения-триггера, которое остается в контексте всегда
+            related: Старые похожие сообщения из поиска, берутся на остаток бюджета
+
+        Returns:
+            Строки "User {id}: текст", сначала найденные старые (с пометкой «(раньше)»), затем последние
+        """
+        budget = self.token_budget
+        message_cap = budget // MESSAGE_BUDGET_SHARE if budget else 0
+        raw = 0
+        lines = []
+        for message_id, user_id, text in recent:
+            raw += estimate_tokens(text) + LINE_OVERHEAD_TOKENS
+            compressed, tokens = compressed_message(text)
+            cap = budget // 2 if message_id == triggered_id else message_cap
+            if cap and tokens > cap:
+                compressed = truncate_tokens(compressed, cap)
+                tokens = estimate_tokens(compressed)
+            lines.append((message_id == triggered_id, f"User {user_id}: {compressed}", tokens + LINE_OVERHEAD_TOKENS))
+
+        used = sum(tokens for is_triggered, _, tokens in lines if is_triggered)
+        kept = [False] * len(lines)
+        # Самые свежие сообщения важнее: набираем с конца, пока помещаются подряд
+        full = False
+        for i in range(len(lines) - 1, -1, -1):
+            is_triggered, _, tokens = lines[i]
+            if is_triggered:
+                kept[i] = True
+            elif full:
+                continue
+            elif not budget or used + tokens <= budget:
+                kept[i] = True
+                used += tokens
+            else:
+                full = True
+
+        related_lines = []
+        for _, user_id, text in related if not full else ():
+            raw += estimate_tokens(text) + LINE_OVERHEAD_TOKENS
+            compressed, tokens = compressed_message(text)
+            if message_cap and tokens > message_cap:
+                compressed = truncate_tokens(compressed, message_cap)
+                tokens = estimate_tokens(compressed)
+            if budget and used + tokens + LINE_OVERHEAD_TOKENS > budget:
+                continue
+            related_lines.append(f"(раньше) User {user_id}: {compressed}")
+            used += tokens + LINE_OVERHEAD_TOKENS
+
+        result = related_lines + [line for (_, line, _), keep in zip(lines, kept) if keep]
+        self.dropped_messages += len(recent) + len(related) - len(result)
+        self.raw_tokens.record(raw)
+        self.context_tokens.record(used)
+        return result
+
+    def get_statistics(self) -> Dict:
+        return {
+            "token_budget": self.token_budget,
+            "raw_tokens": self.raw_tokens.get_statistics(),
+            "context_tokens": self.context_tokens.get_statistics(),
+            "dropped_messages": self.dropped_messages,
+        }
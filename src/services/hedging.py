@@ -0,0 +1,139 @@
+"""
+Хеджирование запросов к LLM.
+
+Если основной запрос не ответил за адаптивный порог (квантиль недавних
+задержек основной модели), параллельно запускается запрос к запасной
+модели. Берется первый годный ответ, второй запрос отменяется. Так хвост
+задержек OpenRouter (p99 в 3–4 раза больше медианы) срезается ценой
+небольшой доли лишних запросов.
+"""
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+
+class LatencyTracker:
+    """Скользящее окно последних задержек (в секундах)."""
+
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Квантиль q (0..1) по окну или None, если замеров нет."""
+        if not self._samples:
+            return None
+        samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+class Hedger:
+    """Запускает запасной запрос, если основной отвечает дольше адаптивного порога."""
+
+    def __init__(
+        self,
+        quantile: float = 0.9,
+        min_samples: int = 20,
+        min_delay: float = 0.5,
+        max_delay: float = 10.0,
+        window: int = 200,
+    ):
+        """
+        Args:
+            quantile: Квантиль задержек основной модели, после которого запускается запасной запрос
+            min_samples: Сколько замеров нужно, чтобы доверять квантилю (до этого порог — max_delay)
+            min_delay: Нижняя граница порога в секундах
+            max_delay: Верхняя граница порога в секундах
+            window: Сколько последних задержек учитывать
+        """
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.latencies = LatencyTracker(window)
+        self.requests = 0
+        self.hedged = 0
+        self.fallback_wins = 0
+
+    def delay(self) -> float:
+        """Текущий порог ожидания основного запроса в секундах."""
+        if len(self.latencies) < self.min_samples:
+            return self.max_delay
+        return min(max(self.latencies.quantile(self.quantile), self.min_delay), self.max_delay)
+
+    async def run(
+        self,
+        primary: Callable[[], Awaitable[Any]],
+        fallback: Optional[Callable[[], Awaitable[Any]]] = None,
+    ) -> Any:
+        """
+        Выполняет primary(), а если он не успел за delay() — еще и fallback().
+
+        Годный ответ — не None и без исключения. Возвращается первый годный,
+        незавершенный запрос отменяется. Если оба неудачны, пробрасывается
+        исключение основного (или запасного) запроса, иначе возвращается None.
+
+        Args:
+            primary: Создает корутину основного запроса
+            fallback: Создает корутину запасного запроса (None — без хеджирования)
+        """
+        self.requests += 1
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        primary_task = asyncio.ensure_future(primary())
+        # Отмененный основной запрос тоже дает замер: его задержка не меньше прошедшего
+        # времени. Без этого в окно попадали бы только быстрые ответы и порог сползал вниз.
+        primary_task.add_done_callback(lambda _: self.latencies.record(loop.time() - started))
+
+        if fallback is None:
+            return await primary_task
+
+        done, _ = await asyncio.wait({primary_task}, timeout=self.delay())
+        if done:
+            return primary_task.result()
+
+        self.hedged += 1
+        fallback_task = asyncio.ensure_future(fallback())
+        tasks = (primary_task, fallback_task)
+        error = None
+        try:
+            pending = set(tasks)
+            while pending:
+                _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # При одновременном завершении предпочитается основной ответ
+                for task in tasks:
+                    if task in pending or task.cancelled():
+                        continue
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                        continue
+                    result = task.result()
+                    if result is not None:
+                        if task is fallback_task:
+                            self.fallback_wins += 1
+                        return result
+                tasks = tuple(task for task in tasks if task in pending)
+        finally:
+            for task in (primary_task, fallback_task):
+                if not task.done():
+                    task.cancel()
+        if error is not None:
+            raise error
+        return None
+
+    def get_statistics(self) -> Dict:
+        """Доля хеджированных запросов, доля побед запасной модели и текущий порог."""
+        return {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_rate": round(self.hedged / self.requests, 3) if self.requests else 0.0,
+            "fallback_wins": self.fallback_wins,
+            "win_rate": round(self.fallback_wins / self.hedged, 3) if self.hedged else 0.0,
+            "delay_s": round(self.delay(), 3),
+            "samples": len(self.latencies),
+        }
@@ -1,5 +1,9 @@
-from collections import deque
-from typing import Deque, List, Tuple
+import sys
+import time
+import asyncio
+from array import array
+from collections import OrderedDict, deque
+from typing import Iterator, List, Optional, Tuple
 from aiogram.types import Message
 from datetime import datetime
 import logging
@@ -7,99 +11,543 @@ import logging
 # Размер истории берем из конфига
 from .config import config
 from .agent_memory import agent_memory
+from .memory_writer import memory_writer
+from .memory_retention import retention_sweeper
+from .context_budget import ContextAssembler
+
+# Окно из памяти для сообщения, вышедшего из кольцевого буфера: сколько сообщений после него
+# и во сколько раз больше HISTORY_SIZE ID назад начинать чтение
+DEEP_CONTEXT_AFTER = 3
+DEEP_LOOKBACK_FACTOR = 4
+
+def truncate_text(text: str, max_bytes: int) -> str:
+    """Обрезает текст до max_bytes байт UTF-8, не разрывая символы (0 — без ограничения)."""
+    if not max_bytes or len(text) * 4 <= max_bytes:
+        return text
+    data = text.encode('utf-8')
+    if len(data) <= max_bytes:
+        return text
+    return data[:max_bytes].decode('utf-8', errors='ignore')
+
+
+class ChatHistory:
+    """
+    Кольцевой буфер последних сообщений одного чата.
+
+    ID сообщений и пользователей лежат в array('q') без упаковки в объекты
+    int, тексты — в списке той же длины. Индекс message_id → слот — это
+    хеш-таблица с открытой адресацией в array('i') (слот + 1, 0 — пусто),
+    которая растет вместе с буфером и заполнена не больше чем наполовину.
+    Поиск и правка по ID не зависят от размера буфера. Итерация отдает
+    кортежи (message_id, user_id, text) от старых к новым.
+    """
+    __slots__ = ("capacity", "message_ids", "user_ids", "texts", "start", "table", "text_bytes", "last_access")
+
+    # Начальный размер таблицы индекса (степень двойки)
+    MIN_TABLE_SIZE = 8
+
+    def __init__(self, capacity: int, messages: Iterator[Tuple[int, int, str]] = ()):
+        self.capacity = capacity
+        # Массивы растут до capacity, дальше слоты перезаписываются по кругу
+        self.message_ids = array('q')
+        self.user_ids = array('q')
+        self.texts: List[str] = []
+        # Слот самого старого сообщения, когда буфер заполнен
+        self.start = 0
+        self.table = array('i', bytes(4 * self.MIN_TABLE_SIZE))
+        # Суммарный размер объектов str, для оценки памяти чата
+        self.text_bytes = 0
+        # time.monotonic() последнего обращения, для вытеснения неактивных чатов
+        self.last_access = time.monotonic()
+        for message_id, user_id, text in messages:
+            self.append(message_id, user_id, text)
+
+    def append(self, message_id: int, user_id: int, text: str):
+        if not self.capacity:
+            return
+        if len(self.texts) < self.capacity:
+            slot = len(self.texts)
+            self.message_ids.append(message_id)
+            self.user_ids.append(user_id)
+            self.texts.append(text)
+            self.text_bytes += sys.getsizeof(text)
+            if 2 * len(self.texts) > len(self.table):
+                self._resize(2 * len(self.table))
+        else:
+            slot = self.start
+            pos = self._find(self.message_ids[slot])
+            # ID мог повториться, тогда индекс уже указывает на более новый слот
+            if self.table[pos] == slot + 1:
+                self._delete(pos)
+            self.message_ids[slot] = message_id
+            self.user_ids[slot] = user_id
+            self.text_bytes += sys.getsizeof(text) - sys.getsizeof(self.texts[slot])
+            self.texts[slot] = text
+            self.start = (slot + 1) % self.capacity
+        self.table[self._find(message_id)] = slot + 1
+
+    def _find(self, message_id: int) -> int:
+        """Позиция ID в таблице или пустая позиция, куда его вставить."""
+        table = self.table
+        mask = len(table) - 1
+        # ID в чате идут подряд, поэтому сам ID — хороший хеш
+        pos = message_id & mask
+        while True:
+            entry = table[pos]
+            if not entry or self.message_ids[entry - 1] == message_id:
+                return pos
+            pos = (pos + 1) & mask
+
+    def _delete(self, pos: int):
+        """Удаляет позицию, сдвигая назад следующие за ней записи цепочки."""
+        table = self.table
+        mask = len(table) - 1
+        table[pos] = 0
+        probe = pos
+        while True:
+            probe = (probe + 1) & mask
+            entry = table[probe]
+            if not entry:
+                return
+            home = self.message_ids[entry - 1] & mask
+            # Запись можно сдвинуть, если ее домашняя позиция не позже освободившейся
+            if (probe - home) & mask >= (probe - pos) & mask:
+                table[pos] = entry
+                table[probe] = 0
+                pos = probe
+
+    def _resize(self, size: int):
+        self.table = array('i', bytes(4 * size))
+        # От старых к новым: при повторе ID в индексе остается более новый слот
+        size = len(self.texts)
+        for i in range(size):
+            slot = (self.start + i) % size
+            self.table[self._find(self.message_ids[slot])] = slot + 1
+
+    def _slot(self, message_id: int) -> Optional[int]:
+        entry = self.table[self._find(message_id)]
+        return entry - 1 if entry else None
+
+    def get_text(self, message_id: int) -> Optional[str]:
+        slot = self._slot(message_id)
+        return self.texts[slot] if slot is not None else None
+
+    def set_text(self, message_id: int, text: str) -> bool:
+        slot = self._slot(message_id)
+        if slot is None:
+            return False
+        self.text_bytes += sys.getsizeof(text) - sys.getsizeof(self.texts[slot])
+        self.texts[slot] = text
+        return True
+
+    @property
+    def nbytes(self) -> int:
+        """Примерный объем памяти чата: буферы массивов, список и тексты."""
+        return (
+            sys.getsizeof(self) + sys.getsizeof(self.message_ids) + sys.getsizeof(self.user_ids)
+            + sys.getsizeof(self.table) + sys.getsizeof(self.texts) + self.text_bytes
+        )
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def __iter__(self) -> Iterator[Tuple[int, int, str]]:
+        size = len(self.texts)
+        for i in range(size):
+            slot = (self.start + i) % size
+            yield self.message_ids[slot], self.user_ids[slot], self.texts[slot]
+
+
+def _merge_messages(
+    messages: List[Tuple[int, int, str]], newer: List[Tuple[int, int, str]],
+) -> List[Tuple[int, int, str]]:
+    """Объединяет сообщения по ID в хронологическом порядке; при совпадении ID берется newer."""
+    if not newer:
+        return messages
+    merged = {message[0]: message for message in messages}
+    merged.update((message[0], message) for message in newer)
+    return [merged[message_id] for message_id in sorted(merged)]
+
 
 class HistoryManager:
     """
     Хранит ограниченное количество последних сообщений для каждого чата.
-    Ключ - ID чата (int), Значение - deque сообщений.
+    Ключ - ID чата (int), Значение - кольцевой буфер ChatHistory.
+
+    Чаты лежат в порядке последнего обращения. При превышении бюджета памяти
+    или долгом простое целые чаты выгружаются, начиная с самых давних,
+    и при следующем обращении прозрачно загружаются из agent_memory.
     """
-    def __init__(self, max_size: int = config.HISTORY_SIZE):
+    def __init__(
+        self,
+        max_size: int = config.HISTORY_SIZE,
+        max_text_bytes: int = config.HISTORY_MAX_TEXT_BYTES,
+        memory_budget_bytes: int = int(config.HISTORY_MEMORY_BUDGET_MB * 1024 * 1024),
+        idle_ttl: float = config.HISTORY_IDLE_TTL_MINUTES * 60,
+        context_token_budget: int = config.CONTEXT_TOKEN_BUDGET,
+    ):
         self.max_size = max_size
-        # Словарь, где ключ - chat_id, значение - Deque[Tuple[message_id, user_id, text]]
-        # Храним ID сообщения и пользователя
-        self.history: dict[int, Deque[Tuple[int, int, str]]] = {}
+        # Сколько байт текста хранить на сообщение (0 — без ограничения)
+        self.max_text_bytes = max_text_bytes
+        # Бюджет памяти на все чаты и время простоя до выгрузки чата (0 — без ограничения)
+        self.memory_budget_bytes = memory_budget_bytes
+        self.idle_ttl = idle_ttl
+        # Словарь, где ключ - chat_id, значение - ChatHistory из (message_id, user_id, text)
+        # Храним ID сообщения и пользователя. Порядок — от давно не использованных к свежим
+        self.history: OrderedDict[int, ChatHistory] = OrderedDict()
+        self._total_bytes = 0
+        self.evicted_chats = 0
+        self.reloaded_chats = 0
+        self.deep_lookups = 0
+        self.deep_hits = 0
+        # Сборка контекста промпта в пределах бюджета токенов
+        self.context = ContextAssembler(context_token_budget)
         self.memory_enabled = config.MEMORY_ENABLED
-        
-        # Загружаем историю из markdown файлов если включена память
-        if self.memory_enabled:
-            self._load_from_memory()
-            logging.info("HistoryManager: Загружена история из agent_memory")
+        self.async_writes = config.MEMORY_ASYNC_WRITES
+        # Сколько похожих старых сообщений из поиска по памяти добавлять к контексту
+        # (поиск есть только у файлового бэкенда)
+        search_available = config.MEMORY_SEARCH_ENABLED and hasattr(agent_memory, "search_messages")
+        self.search_top_k = config.MEMORY_SEARCH_TOP_K if search_available else 0
+        # История чатов загружается из agent_memory лениво, при первом обращении (get_chat)
 
     def add_message(self, message: Message):
         """Добавляет новое сообщение в историю чата."""
-        chat_id = message.chat.id
-        message_id = message.message_id
-        user_id = message.from_user.id if message.from_user else 0
-        text = message.text
+        if self._accepts(message):
+            self._append(message, self.get_chat(message.chat.id))
+            self._persist(message)
+
+    async def add_message_async(self, message: Message):
+        """
+        То же, что add_message, но выгруженная история чата загружается в потоке,
+        а если очередь фонового писателя заполнена, места в ней ждем тоже в потоке.
+        """
+        if self._accepts(message):
+            self._append(message, await self.get_chat_async(message.chat.id))
+            if self.memory_enabled and self.async_writes and memory_writer.full():
+                await asyncio.to_thread(self._persist, message)
+            else:
+                self._persist(message)
 
-        if not text:
+    @staticmethod
+    def _accepts(message: Message) -> bool:
+        if not message.text:
             # Игнорируем сообщения без текста (фото, стикеры и т.д.)
-            return
+            return False
 
         # --- ДОПОЛНЕНИЕ: Игнорируем пересланные сообщения (репосты) ---
         # Если это репост или пересланное сообщение, мы его не сохраняем в историю.
         if message.forward_from or message.forward_from_chat or message.forward_sender_name:
-            return
+            return False
         # --------------------------------------------------------------------
+        return True
+
+    def _append(self, message: Message, chat: Optional[ChatHistory]):
+        chat_id = message.chat.id
+        message_id = message.message_id
+        user_id = message.from_user.id if message.from_user else 0
+        text = message.text
 
-        if chat_id not in self.history:
-            self.history[chat_id] = deque(maxlen=self.max_size)
+        if chat is None:
+            chat = self._store(chat_id, ChatHistory(self.max_size))
 
-        # Добавляем кортеж (ID сообщения, ID пользователя, текст)
-        self.history[chat_id].append((message_id, user_id, text))
-        
-        # Сохраняем в markdown если включена память
-        if self.memory_enabled:
-            timestamp = datetime.fromtimestamp(message.date.timestamp()) if message.date else datetime.now()
-            agent_memory.save_message(chat_id, message_id, user_id, text, timestamp)
+        # Добавляем запись (ID сообщения, ID пользователя, текст)
+        size = chat.nbytes
+        chat.append(message_id, user_id, truncate_text(text, self.max_text_bytes))
+        self._total_bytes += chat.nbytes - size
+        self._evict(keep=chat_id)
+
+    def _persist(self, message: Message):
+        """Сохраняет сообщение в агентскую память, если она включена."""
+        if not self.memory_enabled:
+            return
+        chat_id = message.chat.id
+        user_id = message.from_user.id if message.from_user else 0
+        timestamp = datetime.fromtimestamp(message.date.timestamp()) if message.date else datetime.now()
+        if self.async_writes:
+            # ⚡ Optimization: Запись на диск уходит в фоновый поток, хендлер не ждет I/O.
+            # Если писатель не успевает, submit() ждет места в очереди, а не теряет сообщение
+            memory_writer.submit(chat_id, message.message_id, user_id, message.text, timestamp)
+        else:
+            agent_memory.save_message(chat_id, message.message_id, user_id, message.text, timestamp)
 
     def get_message_text(self, chat_id: int, message_id: int) -> str:
         """Возвращает текст конкретного сообщения по его ID."""
-        if chat_id not in self.history:
+        chat = self.get_chat(chat_id)
+        if chat is None:
             return ""
-        
-        for mid, uid, text in self.history[chat_id]:
-            if mid == message_id:
-                return text
-        return ""
+        text = chat.get_text(message_id)
+        return text if text is not None else ""
+
+    def edit_message(self, message: Message) -> bool:
+        """
+        Обновляет текст отредактированного сообщения, если оно еще в истории.
+        Правится только история в памяти процесса: файлы agent_memory только дописываются,
+        а запись с тем же ID задвоила бы сообщение в экспорте, поиске и счетчиках.
+        Поэтому выгруженный чат ради правки не загружается, а после выгрузки
+        или перезапуска в истории снова исходный текст.
+
+        Returns:
+            True, если сообщение найдено и обновлено
+        """
+        chat = self.history.get(message.chat.id)
+        if not message.text or chat is None:
+            return False
+        size = chat.nbytes
+        updated = chat.set_text(message.message_id, truncate_text(message.text, self.max_text_bytes))
+        self._total_bytes += chat.nbytes - size
+        return updated
+
+    def clear_chat(self, chat_id: int) -> int:
+        """Очищает историю чата в памяти процесса и возвращает число удаленных сообщений."""
+        chat = self.history.pop(chat_id, None)
+        if chat is None:
+            return 0
+        self._total_bytes -= chat.nbytes
+        return len(chat)
+
+    def get_chat(self, chat_id: int) -> Optional[ChatHistory]:
+        """
+        История чата с отметкой обращения. Выгруженный или еще не загруженный
+        чат читается из agent_memory; для чата без сообщений — None.
+        """
+        chat = self._touch(chat_id)
+        if chat is not None or not self.memory_enabled:
+            return chat
+        return self._hydrate(chat_id, self._load_messages(chat_id))
+
+    async def get_chat_async(self, chat_id: int) -> Optional[ChatHistory]:
+        """То же, что get_chat, но история читается из agent_memory в потоке, не блокируя цикл событий."""
+        chat = self._touch(chat_id)
+        if chat is not None or not self.memory_enabled:
+            return chat
+        messages = await asyncio.to_thread(self._load_messages, chat_id)
+        # Пока читали диск, в чат могло прийти новое сообщение: сливаем его с загруженной историей
+        current = self.history.get(chat_id)
+        if current is not None:
+            messages = _merge_messages(messages, list(current))
+        return self._hydrate(chat_id, messages)
+
+    def _touch(self, chat_id: int) -> Optional[ChatHistory]:
+        chat = self.history.get(chat_id)
+        if chat is not None:
+            self.history.move_to_end(chat_id)
+            chat.last_access = time.monotonic()
+        return chat
+
+    def _load_messages(self, chat_id: int) -> List[Tuple[int, int, str]]:
+        """
+        Последние max_size сообщений чата из agent_memory вместе с теми,
+        что еще ждут записи в очереди фонового писателя.
+        """
+        # Очередь снимается до чтения диска: сообщение, записанное между
+        # этими шагами, найдется хотя бы в одном из них
+        pending = memory_writer.pending_messages(chat_id) if self.async_writes else []
+        try:
+            messages = agent_memory.load_chat_history(chat_id, limit=self.max_size)
+        except Exception as e:
+            logging.error(f"HistoryManager: Ошибка при загрузке истории чата {chat_id}: {e}")
+            messages = []
+        return _merge_messages(messages, pending)[-self.max_size:]
+
+    def _hydrate(self, chat_id: int, messages: List[Tuple[int, int, str]]) -> Optional[ChatHistory]:
+        # Пустую историю не запоминаем: сообщения, импортированные
+        # другим процессом, появятся при следующем обращении
+        if not messages:
+            return None
+        self.reloaded_chats += 1
+        chat = self._set_chat(chat_id, messages)
+        self._evict(keep=chat_id)
+        return chat
 
     def get_context(self, chat_id: int, message_id: int) -> List[str]:
         """
         Возвращает форматированный список строк для LLM.
-        Строки: "User {id}: Текст сообщения"
+        Строки: "User {id}: Текст сообщения", не больше бюджета токенов
+        """
+        chat = self.get_chat(chat_id)
+        if chat is None:
+            return []
+
+        # Получаем все сообщения из кольцевого буфера
+        messages_tuple = list(chat)
+
+        related = []
+        if self.memory_enabled and self.search_top_k and messages_tuple:
+            related = self._recall_related(chat_id, message_id, messages_tuple)
+
+        # Сжимаем и укладываем в бюджет токенов, триггер остается всегда
+        return self.context.assemble(messages_tuple, message_id, related)
+
+    async def get_context_async(self, chat_id: int, message_id: int) -> List[str]:
+        """
+        То же, что get_context, но загрузка истории и поиск похожих сообщений (догон
+        индекса и чтение найденных сообщений с диска) выполняются в потоке,
+        не блокируя цикл событий.
         """
-        if chat_id not in self.history:
+        chat = await self.get_chat_async(chat_id)
+        if chat is None:
             return []
 
-        formatted_history = []
+        messages_tuple = list(chat)
+        related = []
+        if self.memory_enabled and self.search_top_k and messages_tuple:
+            related = await asyncio.to_thread(self._recall_related, chat_id, message_id, messages_tuple)
+        return self.context.assemble(messages_tuple, message_id, related)
+
+    def get_deep_context(self, chat_id: int, message_id: int) -> Tuple[str, List[str]]:
+        """
+        Текст и контекст сообщения, которое уже вышло из кольцевого буфера.
+        
+        Окно вокруг сообщения читается из agent_memory: чтение начинается
+        с точки разреженного индекса по ID немного раньше сообщения,
+        поэтому время не зависит от длины истории чата. Окно в буфер
+        не попадает.
         
-        # Получаем все сообщения из deque
-        messages_tuple = list(self.history[chat_id])
-
-        # Форматируем для LLM
-        for mid, user_id, text in messages_tuple:
-            # Упрощенная маскировка ID:
-            user_display = f"User {user_id}"
-            formatted_history.append(f"{user_display}: {text}")
-            
-        return formatted_history
-
-    def _load_from_memory(self):
-        """Загружает историю сообщений из markdown файлов при инициализации."""
+        Returns:
+            (текст сообщения, строки контекста) или ("", []), если сообщения нет в памяти
+        """
+        if not self.memory_enabled:
+            return "", []
+        self.deep_lookups += 1
+        # ID в чате идут подряд, но часть из них — не текст, поэтому берем запас
+        start_after = max(0, message_id - DEEP_LOOKBACK_FACTOR * self.max_size - 1)
+        before = deque(maxlen=max(self.max_size - 1, 0))
+        target = None
+        after = []
+        messages = agent_memory.iter_messages(chat_id, after_message_id=start_after)
+        try:
+            for mid, user_id, text in messages:
+                if target is None:
+                    if mid == message_id:
+                        target = (mid, user_id, text)
+                    elif mid > message_id:
+                        # Сообщение не сохранялось (фото, репост и т.д.)
+                        break
+                    else:
+                        before.append((mid, user_id, text))
+                else:
+                    after.append((mid, user_id, text))
+                    if len(after) >= DEEP_CONTEXT_AFTER:
+                        break
+        except Exception as e:
+            logging.error(f"HistoryManager: Ошибка чтения истории чата {chat_id} из памяти: {e}")
+            return "", []
+        finally:
+            messages.close()
+
+        if target is None:
+            return "", []
+        self.deep_hits += 1
+        window = [*before, target, *after]
+        return target[2], self.context.assemble(window, message_id)
+
+    def _recall_related(
+        self, chat_id: int, message_id: int, recent: List[Tuple[int, int, str]],
+    ) -> List[Tuple[int, int, str]]:
+        """
+        Старые сообщения чата, похожие на сообщение-триггер, из поиска по памяти.
+        Ищем только среди сообщений старше тех, что уже есть в контексте.
+        """
+        triggered_text = next((text for mid, _, text in recent if mid == message_id), "")
+        if not triggered_text:
+            return []
+        return agent_memory.search_messages(
+            chat_id, triggered_text, limit=self.search_top_k, before_message_id=recent[0][0],
+        )
+
+    def warm_chat(self, chat_id: int, messages: List[Tuple[int, int, str]]):
+        """Заполняет историю чата готовыми сообщениями (например, после импорта)."""
+        if messages:
+            self._set_chat(chat_id, messages)
+            self._evict(keep=chat_id)
+            logging.info(f"HistoryManager: Прогрет чат {chat_id} ({len(self.history[chat_id])} сообщений)")
+
+    def _set_chat(self, chat_id: int, messages: List[Tuple[int, int, str]]) -> ChatHistory:
+        """Заменяет историю чата последними max_size сообщениями."""
+        return self._store(chat_id, ChatHistory(
+            self.max_size,
+            ((mid, uid, truncate_text(text, self.max_text_bytes)) for mid, uid, text in messages[-self.max_size:]),
+        ))
+
+    def _store(self, chat_id: int, chat: ChatHistory) -> ChatHistory:
+        """Кладет буфер чата в конец очереди вытеснения."""
+        self.clear_chat(chat_id)
+        self.history[chat_id] = chat
+        self._total_bytes += chat.nbytes
+        return chat
+
+    def _evict(self, keep: int):
+        """
+        Выгружает давно не использованные чаты, пока история не уложится в бюджет
+        и пока самый давний чат простаивает дольше idle_ttl. Чат keep не трогаем.
+        """
+        if not self.memory_budget_bytes and not self.idle_ttl:
+            return
+        now = time.monotonic()
+        while self.history:
+            chat_id, chat = next(iter(self.history.items()))
+            if chat_id == keep:
+                return
+            over_budget = self.memory_budget_bytes and self._total_bytes > self.memory_budget_bytes
+            idle = self.idle_ttl and now - chat.last_access > self.idle_ttl
+            if not over_budget and not idle:
+                return
+            self.clear_chat(chat_id)
+            self.evicted_chats += 1
+            if self.memory_enabled:
+                # Файлы, кеши метаданных и индекс чата тоже отпускаем, иначе они копятся без ограничений
+                if self.async_writes:
+                    memory_writer.release_chat(chat_id)
+                elif hasattr(agent_memory, "release_chat"):
+                    agent_memory.release_chat(chat_id)
+
+    def restore_chat(self, chat_id: int, chat: ChatHistory) -> bool:
+        """
+        Кладет готовый буфер чата (например, из снимка) в начало очереди вытеснения.
+        Уже загруженный чат не заменяется, сверх бюджета памяти буфер не берется.
+
+        Returns:
+            True, если буфер принят
+        """
+        if chat_id in self.history:
+            return False
+        if self.memory_budget_bytes and self._total_bytes + chat.nbytes > self.memory_budget_bytes:
+            return False
+        chat.last_access = time.monotonic()
+        self._store(chat_id, chat)
+        self.history.move_to_end(chat_id, last=False)
+        return True
+
+    async def prewarm(self, limit: int) -> int:
+        """
+        Фоново загружает историю недавно активных чатов, чтобы первые реакции
+        в них не ждали диск. Файлы читаются в потоке, а буферы кладутся в историю
+        из цикла событий, поэтому с обработчиками прогрев не пересекается.
+        Прогретые чаты встают в начало очереди вытеснения и не выталкивают
+        те, к которым уже обращались.
+
+        Returns:
+            Сколько чатов загружено
+        """
+        warmed = 0
         try:
-            chat_ids = agent_memory.list_chats()
-            
+            chat_ids = await asyncio.to_thread(agent_memory.recent_chats, limit)
             for chat_id in chat_ids:
-                # Загружаем последние max_size сообщений для каждого чата
-                messages = agent_memory.load_chat_history(chat_id, limit=self.max_size)
-                
-                if messages:
-                    # Создаем deque и заполняем его
-                    self.history[chat_id] = deque(messages, maxlen=self.max_size)
-                    logging.info(f"HistoryManager: Загружено {len(messages)} сообщений для чата {chat_id}")
-        
+                if self.memory_budget_bytes and self._total_bytes >= self.memory_budget_bytes:
+                    break
+                if chat_id in self.history:
+                    continue
+                messages = await asyncio.to_thread(agent_memory.load_chat_history, chat_id, self.max_size)
+                # Пока читали файл, чат мог загрузить обработчик
+                if not messages or chat_id in self.history:
+                    continue
+                self._set_chat(chat_id, messages)
+                self.history.move_to_end(chat_id, last=False)
+                warmed += 1
         except Exception as e:
-            logging.error(f"HistoryManager: Ошибка при загрузке истории из памяти: {e}")
+            logging.error(f"HistoryManager: Ошибка прогрева истории: {e}")
+        logging.info(f"HistoryManager: Прогрето {warmed} чатов")
+        return warmed
     
     def get_memory_statistics(self):
         """Возвращает статистику агентской памяти."""
@@ -108,6 +556,19 @@ class HistoryManager:
         
         stats = agent_memory.get_statistics()
         stats["enabled"] = True
+        stats["history"] = {
+            "chats": len(self.history),
+            "bytes": self._total_bytes,
+            "evicted_chats": self.evicted_chats,
+            "reloaded_chats": self.reloaded_chats,
+            "deep_lookups": self.deep_lookups,
+            "deep_hits": self.deep_hits,
+        }
+        stats["context"] = self.context.get_statistics()
+        if self.async_writes:
+            stats["writer"] = memory_writer.get_statistics()
+        if retention_sweeper.enabled:
+            stats["retention"] = retention_sweeper.get_statistics()
         return stats
 
 # Инициализируем синглтон-менеджер для всего приложения
@@ -0,0 +1,213 @@
+"""
+Бинарный снимок истории HistoryManager для быстрого перезапуска.
+
+Снимок — один файл: заголовок с CRC32 и подряд записанные кольцевые буферы
+чатов вместе с таблицами индекса. При старте он читается одним
+последовательным чтением. Чат, у которого в agent_memory появились
+сообщения новее снимка, пропускается и загружается из памяти как обычно.
+"""
+import os
+import sys
+import time
+import zlib
+import struct
+import asyncio
+import logging
+from array import array
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from .history import ChatHistory, HistoryManager
+
+SNAPSHOT_FILE = "history.snapshot"
+SNAPSHOT_MAGIC = b"MBHS"
+SNAPSHOT_VERSION = 1
+# Заголовок: магия, версия, размер буферов, число чатов, CRC32 тела, время записи
+SNAPSHOT_HEADER = struct.Struct("<4sHIIId")
+# Чат: ID, сообщений, слот самого старого, размер таблицы индекса, байт текста
+SNAPSHOT_CHAT = struct.Struct("<qIIII")
+
+
+def _to_le(values: array) -> bytes:
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_le(typecode: str, data) -> array:
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+def encode_snapshot(chats: Dict[int, ChatHistory], capacity: int) -> bytes:
+    """Сериализует буферы чатов (пустые пропускаются) в порядке словаря."""
+    parts = []
+    count = 0
+    for chat_id, chat in chats.items():
+        if not len(chat):
+            continue
+        blob = "".join(chat.texts).encode("utf-8")
+        lengths = array("I", map(len, chat.texts))
+        parts += [
+            SNAPSHOT_CHAT.pack(chat_id, len(chat), chat.start, len(chat.table), len(blob)),
+            _to_le(chat.message_ids), _to_le(chat.user_ids), _to_le(chat.table), _to_le(lengths), blob,
+        ]
+        count += 1
+    body = b"".join(parts)
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, capacity, count, zlib.crc32(body), time.time())
+    return header + body
+
+
+def decode_snapshot(data: bytes, capacity: int) -> Optional[Dict[int, ChatHistory]]:
+    """
+    Восстанавливает буферы чатов из снимка.
+
+    Returns:
+        Словарь chat_id → ChatHistory или None, если снимок поврежден
+        или записан с другим размером истории
+    """
+    if len(data) < SNAPSHOT_HEADER.size:
+        logging.warning("HistorySnapshot: Снимок обрезан")
+        return None
+    magic, version, snapshot_capacity, count, checksum, created = SNAPSHOT_HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        logging.warning("HistorySnapshot: Неизвестный формат снимка")
+        return None
+    if snapshot_capacity != capacity:
+        logging.info(f"HistorySnapshot: Снимок для истории из {snapshot_capacity} сообщений, сейчас {capacity}")
+        return None
+    view = memoryview(data)[SNAPSHOT_HEADER.size:]
+    if zlib.crc32(view) != checksum:
+        logging.warning("HistorySnapshot: Контрольная сумма снимка не совпала")
+        return None
+
+    chats: Dict[int, ChatHistory] = {}
+    pos = 0
+    for _ in range(count):
+        chat_id, size, start, table_size, text_bytes = SNAPSHOT_CHAT.unpack_from(view, pos)
+        pos += SNAPSHOT_CHAT.size
+        chat = ChatHistory(capacity)
+        chat.message_ids = _from_le("q", view[pos:pos + 8 * size])
+        pos += 8 * size
+        chat.user_ids = _from_le("q", view[pos:pos + 8 * size])
+        pos += 8 * size
+        chat.table = _from_le("i", view[pos:pos + 4 * table_size])
+        pos += 4 * table_size
+        lengths = _from_le("I", view[pos:pos + 4 * size])
+        pos += 4 * size
+        text = str(view[pos:pos + text_bytes], "utf-8")
+        pos += text_bytes
+
+        texts = []
+        offset = 0
+        for length in lengths:
+            texts.append(text[offset:offset + length])
+            offset += length
+        chat.texts = texts
+        chat.start = start
+        chat.text_bytes = sum(map(sys.getsizeof, texts))
+        chats[chat_id] = chat
+    logging.info(f"HistorySnapshot: Прочитано {count} чатов, снимку {time.time() - created:.0f} с")
+    return chats
+
+
+def read_snapshot(path: Path, capacity: int) -> Optional[Dict[int, ChatHistory]]:
+    """Читает снимок одним чтением; None — снимка нет или он непригоден."""
+    try:
+        data = Path(path).read_bytes()
+    except FileNotFoundError:
+        return None
+    try:
+        return decode_snapshot(data, capacity)
+    except (struct.error, ValueError) as e:
+        logging.warning(f"HistorySnapshot: Снимок {path} не читается: {e}")
+        return None
+
+
+def write_snapshot(path: Path, data: bytes):
+    """Атомарно заменяет файл снимка."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _newest_message_id(chat: ChatHistory) -> int:
+    return chat.message_ids[(chat.start - 1) % len(chat)]
+
+
+def _last_message_ids(memory, chat_ids: List[int]) -> Dict[int, int]:
+    """ID последнего сохраненного сообщения каждого чата по данным памяти."""
+    if hasattr(memory, "chat_usage"):
+        usage = memory.chat_usage()
+        return {chat_id: usage[chat_id].get("last_message_id") for chat_id in chat_ids if chat_id in usage}
+    last_ids = {}
+    for chat_id in chat_ids:
+        metadata = memory.get_metadata(chat_id)
+        if metadata:
+            last_ids[chat_id] = metadata.get("last_message_id")
+    return last_ids
+
+
+async def save_history(manager: HistoryManager, path: Path) -> int:
+    """
+    Пишет снимок истории. Буферы сериализуются в цикле событий, чтобы снимок
+    был согласованным, а запись на диск уходит в поток.
+
+    Returns:
+        Размер снимка в байтах
+    """
+    started = time.perf_counter()
+    data = encode_snapshot(manager.history, manager.max_size)
+    await asyncio.to_thread(write_snapshot, path, data)
+    logging.info(
+        f"HistorySnapshot: Записано {len(manager.history)} чатов, {len(data)} байт "
+        f"за {(time.perf_counter() - started) * 1000:.0f} мс"
+    )
+    return len(data)
+
+
+async def restore_history(manager: HistoryManager, path: Path, memory) -> int:
+    """
+    Восстанавливает историю из снимка. Чаты, уже загруженные обработчиками,
+    и чаты, которые в памяти ушли дальше снимка, пропускаются.
+
+    Args:
+        manager: HistoryManager, в который кладутся буферы
+        path: Путь к снимку
+        memory: Хранилище памяти для проверки свежести чатов
+
+    Returns:
+        Сколько чатов восстановлено
+    """
+    started = time.perf_counter()
+    try:
+        chats = await asyncio.to_thread(read_snapshot, path, manager.max_size)
+        if not chats:
+            return 0
+        last_ids = await asyncio.to_thread(_last_message_ids, memory, list(chats))
+    except Exception as e:
+        logging.error(f"HistorySnapshot: Ошибка восстановления истории: {e}")
+        return 0
+
+    restored = stale = 0
+    # С самых свежих: каждый следующий встает перед ними в очереди вытеснения
+    for chat_id, chat in reversed(chats.items()):
+        if last_ids.get(chat_id) != _newest_message_id(chat):
+            stale += 1
+            continue
+        if manager.restore_chat(chat_id, chat):
+            restored += 1
+    logging.info(
+        f"HistorySnapshot: Восстановлено {restored} чатов (устарело {stale}) "
+        f"за {(time.perf_counter() - started) * 1000:.0f} мс"
+    )
+    return restored
@@ -64,6 +64,10 @@ class MemeGenerator:
             print(f"Ошибка при открытии изображения: {e}")
             return None
 
+    def prefetch_template(self, url: str) -> bool:
+        """Заранее скачивает и декодирует шаблон в кеш, чтобы create_meme не ждал сети."""
+        return self._get_cached_image_object(url) is not None
+
     def _download_image(self, url: str) -> Optional[Image.Image]:
         """Скачивает изображение по URL и возвращает объект PIL Image."""
         # ⚡ Optimized: Use cached decoded image and return a copy to avoid repeated decoding overhead.
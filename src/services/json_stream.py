@@ -0,0 +1,103 @@
+"""
+Инкрементальный разбор JSON-объекта из потока ответа LLM.
+
+Поля верхнего уровня отдаются по мере того, как их значения полностью
+пришли в потоке, не дожидаясь закрывающей скобки объекта. Текст до первой
+«{» (например, ```json) пропускается.
+"""
+import json
+from typing import Any, Dict, Optional
+
+WHITESPACE = " \t\r\n"
+
+
+class JsonFieldExtractor:
+    """Выделяет завершенные поля верхнего уровня из кусков JSON по мере поступления."""
+
+    def __init__(self):
+        self.buffer = ""
+        self.fields: Dict[str, Any] = {}
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        # Ключ текущего поля и начало его значения в буфере
+        self._key: Optional[str] = None
+        self._value_start: Optional[int] = None
+        self.done = False
+
+    def feed(self, chunk: str) -> Dict[str, Any]:
+        """
+        Добавляет кусок потока.
+
+        Returns:
+            Поля, значения которых завершились в этом куске
+        """
+        self.buffer += chunk
+        completed: Dict[str, Any] = {}
+        buffer = self.buffer
+        i = self._pos
+        while i < len(buffer) and not self.done:
+            c = buffer[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        if self._key is None:
+                            self._key = self._decode(self._string_start, i + 1)
+                        elif self._value_start == self._string_start:
+                            self._complete(i + 1, completed)
+            elif c == '"':
+                self._in_string = True
+                self._string_start = i
+                self._start_value(i)
+            elif c in "{[":
+                if self._depth:
+                    self._start_value(i)
+                self._depth += 1
+            elif c in "}]":
+                self._depth -= 1
+                if self._depth == 1 and self._value_start is not None:
+                    # Закрылся вложенный объект или массив — значение поля
+                    self._complete(i + 1, completed)
+                elif self._depth == 0:
+                    self._complete_literal(i, completed)
+                    self.done = True
+            elif self._depth == 1:
+                if c == ",":
+                    self._complete_literal(i, completed)
+                elif c not in WHITESPACE and c != ":":
+                    # Начало числа, true/false/null
+                    self._start_value(i)
+            i += 1
+        self._pos = i
+        return completed
+
+    def _start_value(self, pos: int):
+        if self._depth == 1 and self._key is not None and self._value_start is None:
+            self._value_start = pos
+
+    def _decode(self, start: int, end: int) -> Any:
+        try:
+            return json.loads(self.buffer[start:end])
+        except ValueError:
+            return None
+
+    def _complete(self, end: int, completed: Dict[str, Any]):
+        value = self._decode(self._value_start, end)
+        self.fields[self._key] = completed[self._key] = value
+        self._key = None
+        self._value_start = None
+
+    def _complete_literal(self, end: int, completed: Dict[str, Any]):
+        """Завершает значение без кавычек и скобок (число, true/false/null) на «,» или «}»."""
+        if self._key is not None and self._value_start is not None:
+            self._complete(end, completed)
+        # Ключ без значения (или значение уже отдано) сбрасывается на разделителе
+        self._key = None
+        self._value_start = None
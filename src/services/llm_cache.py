@@ -0,0 +1,155 @@
+"""
+Кеш идей мемов перед запросом к LLM.
+
+Ключ — SHA-256 нормализованных входов промпта (контекст, сообщение-триггер,
+смысл реакции) и модели, поэтому повторный триггер с тем же текстом
+(переотправка в личке, снятая и поставленная заново реакция) не ждет
+ответа OpenRouter. Кеш ограничен по числу записей и времени жизни
+и может сохраняться на диск между перезапусками.
+"""
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+LLM_CACHE_FILE = "llm_cache.json"
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def _normalize(text: Optional[str]) -> str:
+    return WHITESPACE_PATTERN.sub(" ", text or "").strip()
+
+
+def prompt_fingerprint(
+    model: str, context_messages: List[str], triggered_text: str, reaction_context: Optional[str] = None,
+) -> str:
+    """Стабильный хеш входов промпта; пробелы и переводы строк нормализуются."""
+    payload = json.dumps(
+        [model, [_normalize(line) for line in context_messages], _normalize(triggered_text), _normalize(reaction_context)],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemeIdeaCache:
+    """
+    LRU-кеш идей мемов с временем жизни записей.
+    Потокобезопасен: load/save выполняются в потоке, пока цикл событий читает кеш.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600.0, path: Optional[Path] = None):
+        """
+        Args:
+            max_entries: Сколько идей хранить (0 — кеш отключен)
+            ttl: Время жизни записи в секундах
+            path: Файл для сохранения кеша между перезапусками (None — только в памяти)
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = Path(path) if path else None
+        # Ключ → (время истечения по time.time(), идея); порядок — от давно не использованных к свежим
+        self._entries: OrderedDict[str, Tuple[float, Dict[str, Any]]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Идея по ключу или None (промах или запись устарела)."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.time():
+                del self._entries[key]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            # Копия, чтобы вызывающий код не менял закешированную идею
+            return dict(entry[1])
+
+    def put(self, key: str, idea: Dict[str, Any]):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, dict(idea))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def load(self) -> int:
+        """
+        Читает кеш с диска, устаревшие записи пропускаются.
+
+        Returns:
+            Сколько записей загружено
+        """
+        if not self.enabled or not self.path:
+            return 0
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            logging.warning(f"MemeIdeaCache: Кеш {self.path} не читается: {e}")
+            return 0
+        now = time.time()
+        with self._lock:
+            # В файле записи лежат от старых к свежим; уже закешированные в процессе свежее них
+            entries = OrderedDict(
+                (key, (expires_at, idea)) for key, (expires_at, idea) in stored.items() if expires_at > now
+            )
+            entries.update(self._entries)
+            for key in self._entries:
+                entries.move_to_end(key)
+            self._entries = entries
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            loaded = len(self._entries)
+        logging.info(f"MemeIdeaCache: Загружено {loaded} идей из {self.path}")
+        return loaded
+
+    def save(self) -> int:
+        """
+        Атомарно пишет неустаревшие записи на диск.
+
+        Returns:
+            Сколько записей сохранено
+        """
+        if not self.enabled or not self.path:
+            return 0
+        now = time.time()
+        with self._lock:
+            stored = {key: [expires_at, idea] for key, (expires_at, idea) in self._entries.items() if expires_at > now}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(stored, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        return len(stored)
+
+    def get_statistics(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
@@ -0,0 +1,193 @@
+"""
+Служебные команды для директории агентской памяти.
+
+Запуск:
+    python -m src.services.memory_cli repair-manifest [--workers 8] [--memory-dir memory]
+    python -m src.services.memory_cli migrate-layout [--workers 8]
+    python -m src.services.memory_cli migrate --to segments|sqlite|jsonl --output PATH [--workers 4]
+    python -m src.services.memory_cli import-telegram result.json [--chat-id ID] [--replace]
+"""
+import os
+import argparse
+import logging
+import sys
+import time
+from typing import Dict, List, Optional
+
+from .config import config
+from .agent_memory import AgentMemory, BACKEND_FILES, LAYOUTS, LAYOUT_SHARDED, create_agent_memory
+from .memory_daemon import RemoteMemory
+from .memory_migrate import TARGETS, migrate_memory
+from .telegram_import import import_telegram_export
+
+
+def _open_memory(args: argparse.Namespace, layout: Optional[str] = None) -> AgentMemory:
+    return AgentMemory(
+        memory_dir=args.memory_dir or config.MEMORY_DIR,
+        storage_format=config.MEMORY_FORMAT,
+        layout=layout or config.MEMORY_LAYOUT,
+    )
+
+
+def cmd_repair_manifest(args: argparse.Namespace) -> int:
+    """Перестраивает манифест памяти по файлам чатов."""
+    memory = _open_memory(args)
+    stats = memory.rebuild_manifest(workers=args.workers)
+    memory.close()
+    print(
+        f"Манифест перестроен: {stats['total_chats']} чатов, "
+        f"{stats['total_messages']} сообщений за {stats['elapsed_seconds']} с"
+    )
+    return 0
+
+
+def cmd_migrate_layout(args: argparse.Namespace) -> int:
+    """Переносит плоскую директорию памяти в шарды без остановки бота."""
+    memory = _open_memory(args, layout=LAYOUT_SHARDED)
+
+    def progress(done: int, total: int):
+        if done % 1000 == 0 or done == total:
+            print(f"  перенесено чатов: {done}/{total}")
+
+    stats = memory.migrate_layout(workers=args.workers, progress=progress)
+    memory.close()
+    print(f"Миграция завершена: {stats['chats']} чатов, {stats['moved_files']} файлов за {stats['elapsed_seconds']} с")
+    return 0
+
+
+def cmd_migrate(args: argparse.Namespace) -> int:
+    """Переносит markdown историю в другой бэкенд или JSONL, продолжая с контрольной точки."""
+    last_report = [0.0]
+
+    def progress(stats):
+        now = time.monotonic()
+        if now - last_report[0] < 1.0 and stats["chats"] + stats["skipped_chats"] < stats["total_chats"]:
+            return
+        last_report[0] = now
+        print(
+            f"  чатов: {stats['chats'] + stats['skipped_chats']}/{stats['total_chats']}, "
+            f"сообщений: {stats['messages']} "
+            f"({stats['messages_per_second']} сообщ/с, {stats['megabytes_per_second']} МБ/с)"
+        )
+
+    stats = migrate_memory(
+        memory_dir=args.memory_dir or config.MEMORY_DIR,
+        target=args.to,
+        output=args.output,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        checkpoint_path=args.checkpoint,
+        layout=args.layout or config.MEMORY_LAYOUT,
+        progress=progress,
+    )
+    print(
+        f"Миграция завершена: {stats['chats']} чатов (пропущено {stats['skipped_chats']}), "
+        f"{stats['messages']} сообщений за {stats['elapsed_seconds']} с ({stats['messages_per_second']} сообщ/с)"
+    )
+    return 0
+
+
+def _import_via_daemon(args: argparse.Namespace) -> Dict:
+    """Передает импорт демону памяти, который владеет директорией, пока бот работает."""
+    print(f"Импорт выполняет демон памяти ({config.MEMORY_DAEMON_SOCKET})...")
+    reader = AgentMemory(
+        memory_dir=config.MEMORY_DIR, storage_format=config.MEMORY_FORMAT, layout=config.MEMORY_LAYOUT, read_only=True,
+    )
+    # Импорт большого экспорта идет дольше обычного запроса, поэтому без таймаута
+    memory = RemoteMemory(config.MEMORY_DAEMON_SOCKET, reader=reader, timeout=None)
+    try:
+        return memory.import_telegram(args.path, chat_id=args.chat_id, replace=args.replace, batch_size=args.batch_size)
+    finally:
+        memory.close()
+
+
+def cmd_import_telegram(args: argparse.Namespace) -> int:
+    """Импортирует экспорт чата Telegram Desktop в память бота."""
+    if config.MEMORY_DAEMON_SOCKET and not args.memory_dir and os.path.exists(config.MEMORY_DAEMON_SOCKET):
+        try:
+            stats = _import_via_daemon(args)
+        except (OSError, RuntimeError) as e:
+            print(f"Ошибка: {e}", file=sys.stderr)
+            return 1
+        _print_import_stats(stats)
+        return 0
+
+    if config.MEMORY_BACKEND == BACKEND_FILES or args.memory_dir:
+        memory = _open_memory(args)
+    else:
+        memory = create_agent_memory()
+
+    last_report = [0.0]
+
+    def progress(stats):
+        now = time.monotonic()
+        if now - last_report[0] >= 1.0:
+            last_report[0] = now
+            print(f"  импортировано: {stats['messages']} ({stats['messages_per_second']} сообщ/с)")
+
+    try:
+        stats = import_telegram_export(
+            args.path,
+            memory,
+            chat_id=args.chat_id,
+            replace=args.replace,
+            batch_size=args.batch_size,
+            progress=progress,
+        )
+    except ValueError as e:
+        print(f"Ошибка: {e}", file=sys.stderr)
+        return 1
+    finally:
+        memory.close()
+
+    _print_import_stats(stats)
+    return 0
+
+
+def _print_import_stats(stats: Dict):
+    print(
+        f"Импорт завершен: чат {stats['chat_id']}, {stats['messages']} сообщений "
+        f"(пропущено {stats['skipped']}) за {stats['elapsed_seconds']} с ({stats['messages_per_second']} сообщ/с)"
+    )
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m src.services.memory_cli", description="Обслуживание агентской памяти")
+    parser.add_argument("--memory-dir", help="Директория памяти (по умолчанию MEMORY_DIR из конфига)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    repair = subparsers.add_parser("repair-manifest", help="Перестроить манифест чатов по файлам на диске")
+    repair.add_argument("--workers", type=int, default=8, help="Число потоков для чтения файлов")
+    repair.set_defaults(func=cmd_repair_manifest)
+
+    migrate_layout = subparsers.add_parser("migrate-layout", help="Перенести файлы чатов из плоской директории в шарды")
+    migrate_layout.add_argument("--workers", type=int, default=8, help="Число потоков для переноса")
+    migrate_layout.set_defaults(func=cmd_migrate_layout)
+
+    migrate = subparsers.add_parser("migrate", help="Перенести markdown историю в другой бэкенд или JSONL")
+    migrate.add_argument("--to", choices=TARGETS, required=True, help="Куда переносить")
+    migrate.add_argument("--output", required=True, help="Директория назначения (segments, jsonl) или файл базы (sqlite)")
+    migrate.add_argument("--workers", type=int, default=4, help="Число процессов")
+    migrate.add_argument("--batch-size", type=int, default=1000, help="Сообщений в одной пачке записи")
+    migrate.add_argument("--checkpoint", help="Файл контрольной точки (по умолчанию <output>.checkpoint)")
+    migrate.add_argument("--layout", choices=LAYOUTS, help="Раскладка файлов для --to segments")
+    migrate.set_defaults(func=cmd_migrate)
+
+    import_telegram = subparsers.add_parser("import-telegram", help="Импортировать экспорт чата Telegram Desktop (result.json)")
+    import_telegram.add_argument("path", help="Путь к result.json")
+    import_telegram.add_argument("--chat-id", type=int, help="ID чата в Bot API (по умолчанию берется из экспорта)")
+    import_telegram.add_argument("--replace", action="store_true", help="Перезаписать историю, если чат уже есть в памяти")
+    import_telegram.add_argument("--batch-size", type=int, default=1000, help="Сообщений в одной пачке записи")
+    import_telegram.set_defaults(func=cmd_import_telegram)
+
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    logging.basicConfig(level=logging.INFO)
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
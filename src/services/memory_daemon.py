@@ -0,0 +1,371 @@
+"""
+Демон-писатель агентской памяти для запуска нескольких процессов бота.
+
+Один процесс владеет директорией памяти и единственный пишет в нее,
+а процессы бота отправляют ему пачки сообщений через Unix сокет.
+Историю процессы бота читают сами прямо из файлов: сегменты, индексы
+и markdown дописываются, а целиком переписываются только при ротации
+и очистке по лимитам — такое чтение AgentMemory в режиме read_only
+распознает по поколению сегмента и повторяет.
+
+Запуск:
+    python -m src.services.memory_daemon [--socket memory/writer.sock]
+"""
+import os
+import json
+import time
+import signal
+import socket
+import struct
+import logging
+import argparse
+import threading
+import socketserver
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .config import config
+from .agent_memory import AgentMemory, create_agent_memory
+from .telegram_import import import_telegram_export
+
+# Кадр протокола: [длина: uint32][JSON]
+FRAME_HEADER = struct.Struct("<I")
+MAX_FRAME_BYTES = 64 * 1024 * 1024
+# Операции, которые безопасно повторить, если демон упал, не успев ответить
+IDEMPOTENT_OPS = frozenset({"search", "metadata", "list_chats", "recent_chats", "stats", "flush"})
+
+
+def _send_frame(sock: socket.socket, payload: Dict):
+    data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    sock.sendall(FRAME_HEADER.pack(len(data)) + data)
+
+
+def _recv_exact(sock: socket.socket, size: int) -> Optional[bytes]:
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def _recv_frame(sock: socket.socket) -> Optional[Dict]:
+    """Читает один кадр; None — собеседник закрыл соединение."""
+    header = _recv_exact(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    (length,) = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_BYTES:
+        raise ValueError(f"Слишком большой кадр: {length} байт")
+    data = _recv_exact(sock, length)
+    if data is None:
+        return None
+    return json.loads(data)
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    """Обслуживает одно соединение процесса бота: запросы идут по очереди до закрытия."""
+
+    def handle(self):
+        daemon: "MemoryDaemon" = self.server.memory_daemon
+        while True:
+            try:
+                request = _recv_frame(self.request)
+            except (OSError, ValueError) as e:
+                logging.warning(f"MemoryDaemon: Соединение закрыто с ошибкой: {e}")
+                return
+            if request is None:
+                return
+            try:
+                response = {"ok": True, "result": daemon.dispatch(request)}
+            except Exception as e:
+                logging.error(f"MemoryDaemon: Ошибка выполнения {request.get('op')}: {e}")
+                response = {"ok": False, "error": str(e)}
+            try:
+                _send_frame(self.request, response)
+            except OSError:
+                return
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class MemoryDaemon:
+    """
+    Единственный писатель директории памяти.
+
+    Пачки от процессов бота ставятся в очередь одного MemoryWriter,
+    поэтому запись и обновление метаданных идут в одном потоке
+    без гонок между процессами.
+    """
+
+    def __init__(self, memory: AgentMemory, socket_path: str, max_queue_size: int = 10000, batch_size: int = 500):
+        """
+        Args:
+            memory: Хранилище, которым владеет демон
+            socket_path: Путь к Unix сокету
+            max_queue_size: Максимальная длина очереди записи
+            batch_size: Максимум сообщений в одной пачке записи
+        """
+        # Импорт здесь: модуль memory_writer при импорте создает синглтон поверх agent_memory
+        from .memory_writer import MemoryWriter
+
+        self.memory = memory
+        self.socket_path = Path(socket_path)
+        self.writer = MemoryWriter(memory, max_queue_size=max_queue_size, batch_size=batch_size)
+        self._server: Optional[_Server] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Открывает сокет и начинает принимать соединения в фоновом потоке."""
+        # Сокет от предыдущего запуска остается на диске
+        self.socket_path.unlink(missing_ok=True)
+        self._server = _Server(str(self.socket_path), _RequestHandler)
+        self._server.memory_daemon = self
+        self.writer.start()
+        self._thread = threading.Thread(target=self._server.serve_forever, name="memory-daemon", daemon=True)
+        self._thread.start()
+        logging.info(f"MemoryDaemon: Слушаю {self.socket_path}")
+
+    def stop(self):
+        """Перестает принимать запросы и дописывает очередь."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        self.socket_path.unlink(missing_ok=True)
+        self.writer.stop()
+        logging.info("MemoryDaemon: Остановлен")
+
+    def dispatch(self, request: Dict):
+        """Выполняет запрос процесса бота."""
+        op = request.get("op")
+        if op == "append":
+            return self._append(request["chat_id"], request["messages"])
+        if op == "clear":
+            # Сначала дописываем то, что уже принято, иначе оно воскресит чат
+            self.writer.flush()
+            self.memory.clear_chat(request["chat_id"])
+            return None
+        if op == "flush":
+            self.writer.flush()
+            self.memory.flush_metadata()
+            return None
+        if op == "import":
+            # Импорт идет в процессе-владельце памяти: манифест и метаданные не расходятся
+            # с записью живых сообщений. Принятые сообщения сначала дописываются
+            self.writer.flush()
+            return import_telegram_export(
+                request["path"], self.memory,
+                chat_id=request.get("chat_id"),
+                replace=request.get("replace", False),
+                batch_size=request.get("batch_size", 1000),
+            )
+        if op == "search":
+            return self.memory.search_messages(
+                request["chat_id"], request["text"], request.get("limit", 5), request.get("before_message_id"),
+            )
+        if op == "metadata":
+            return self.memory.get_metadata(request["chat_id"])
+        if op == "list_chats":
+            return self.memory.list_chats()
+        if op == "recent_chats":
+            return self.memory.recent_chats(request["limit"])
+        if op == "stats":
+            stats = self.memory.get_statistics()
+            stats["daemon_writer"] = self.writer.get_statistics()
+            return stats
+        raise ValueError(f"Неизвестная операция: {op}")
+
+    def _append(self, chat_id: int, messages: List) -> int:
+        dropped = 0
+        for message_id, user_id, text, timestamp in messages:
+            if not self.writer.submit(chat_id, message_id, user_id, text, datetime.fromtimestamp(timestamp)):
+                dropped += 1
+        if dropped:
+            raise RuntimeError(f"Очередь демона переполнена, отброшено {dropped} сообщений")
+        return len(messages)
+
+
+class RemoteMemory:
+    """
+    Память процесса бота, работающего рядом с демоном-писателем.
+
+    Повторяет публичный API AgentMemory: запись, очистка, поиск и счетчики
+    уходят демону, а история читается напрямую из файлов через AgentMemory
+    в режиме только для чтения.
+    """
+
+    def __init__(self, socket_path: str, reader: AgentMemory, timeout: float = 30.0):
+        """
+        Args:
+            socket_path: Путь к Unix сокету демона
+            reader: AgentMemory в режиме read_only поверх той же директории
+            timeout: Таймаут одного запроса к демону, сек
+        """
+        self.socket_path = str(socket_path)
+        self.reader = reader
+        self.timeout = timeout
+        self._sock: Optional[socket.socket] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        return sock
+
+    def _request(self, op: str, **params):
+        """
+        Отправляет запрос демону; при обрыве соединения (демон перезапущен) повторяет один раз.
+
+        Запрос, который мог дойти до демона, повторяется только для операций
+        из IDEMPOTENT_OPS: демон мог выполнить append или clear и упасть до ответа,
+        и повтор записал бы сообщения дважды. Если же запрос не удалось даже
+        отправить целиком, демон его не выполнял и повтор безопасен для любой операции.
+        """
+        payload = {"op": op, **params}
+        with self._lock:
+            for attempt in range(2):
+                sent = False
+                try:
+                    if self._sock is None:
+                        self._sock = self._connect()
+                    _send_frame(self._sock, payload)
+                    sent = True
+                    response = _recv_frame(self._sock)
+                    if response is None:
+                        raise ConnectionError("Демон памяти закрыл соединение")
+                    break
+                except OSError:
+                    if self._sock is not None:
+                        self._sock.close()
+                        self._sock = None
+                    if attempt or (sent and op not in IDEMPOTENT_OPS):
+                        raise
+        if not response["ok"]:
+            raise RuntimeError(f"Демон памяти: {response['error']}")
+        return response["result"]
+
+    def save_message(self, chat_id: int, message_id: int, user_id: int, text: str, timestamp: Optional[datetime] = None):
+        if timestamp is None:
+            timestamp = datetime.now()
+        self.save_messages(chat_id, [(message_id, user_id, text, timestamp)])
+
+    def save_messages(self, chat_id: int, messages: List[Tuple[int, int, str, datetime]]):
+        """Отправляет пачку сообщений демону одним запросом."""
+        if not messages:
+            return
+        self._request("append", chat_id=chat_id, messages=[
+            (message_id, user_id, text, timestamp.timestamp()) for message_id, user_id, text, timestamp in messages
+        ])
+
+    def load_chat_history(self, chat_id: int, limit: Optional[int] = None) -> List[Tuple[int, int, str]]:
+        return self.reader.load_chat_history(chat_id, limit)
+
+    def iter_messages(self, chat_id: int, after_message_id: int = 0) -> Iterator[Tuple[int, int, str]]:
+        return self.reader.iter_messages(chat_id, after_message_id)
+
+    def load_chat_range(self, chat_id: int, since: datetime, until: datetime) -> Iterator[Tuple[int, int, str]]:
+        return self.reader.load_chat_range(chat_id, since, until)
+
+    def search_messages(
+        self, chat_id: int, text: str, limit: int = 5, before_message_id: Optional[int] = None,
+    ) -> List[Tuple[int, int, str]]:
+        # Поисковый индекс с несброшенным буфером есть только у демона
+        try:
+            found = self._request("search", chat_id=chat_id, text=text, limit=limit, before_message_id=before_message_id)
+        except (OSError, RuntimeError) as e:
+            logging.error(f"RemoteMemory: Ошибка поиска по истории чата {chat_id}: {e}")
+            return []
+        return [tuple(message) for message in found]
+
+    def get_metadata(self, chat_id: int) -> Optional[Dict]:
+        return self._request("metadata", chat_id=chat_id)
+
+    def list_chats(self) -> List[int]:
+        return self._request("list_chats")
+
+    def recent_chats(self, limit: int) -> List[int]:
+        return self._request("recent_chats", limit=limit)
+
+    def clear_chat(self, chat_id: int):
+        self._request("clear", chat_id=chat_id)
+
+    def get_statistics(self) -> Dict:
+        return self._request("stats")
+
+    def import_telegram(self, path: str, chat_id: Optional[int] = None, replace: bool = False, batch_size: int = 1000) -> Dict:
+        """Импортирует экспорт Telegram Desktop силами демона (путь должен быть доступен демону)."""
+        return self._request(
+            "import", path=os.path.abspath(path), chat_id=chat_id, replace=replace, batch_size=batch_size,
+        )
+
+    def flush_metadata(self):
+        # Метаданные сбрасывает демон по своему расписанию
+        pass
+
+    def close(self):
+        with self._lock:
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+        self.reader.close()
+
+
+def run_daemon(socket_path: str):
+    """Запускает демона и обслуживает его до SIGTERM/SIGINT."""
+    from .memory_retention import RetentionSweeper
+
+    memory = create_agent_memory(use_daemon=False)
+    daemon = MemoryDaemon(
+        memory, socket_path,
+        max_queue_size=config.MEMORY_WRITER_QUEUE_SIZE,
+        batch_size=config.MEMORY_WRITER_BATCH_SIZE,
+    )
+    sweeper = RetentionSweeper(
+        memory,
+        max_messages=config.MEMORY_RETENTION_MAX_MESSAGES,
+        max_bytes=config.MEMORY_RETENTION_MAX_BYTES,
+        max_age=config.MEMORY_RETENTION_MAX_AGE_DAYS * 86400,
+        global_max_messages=config.MEMORY_RETENTION_GLOBAL_MAX_MESSAGES,
+        global_max_bytes=config.MEMORY_RETENTION_GLOBAL_MAX_BYTES,
+        batch_size=config.MEMORY_RETENTION_BATCH_SIZE,
+    )
+
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+
+    daemon.start()
+    next_sweep = time.monotonic() + config.MEMORY_RETENTION_SWEEP_INTERVAL
+    try:
+        while not stop.wait(config.MEMORY_META_FLUSH_INTERVAL):
+            memory.flush_metadata()
+            # Очистка уступает диск записи, пока очередь не разобрана
+            if sweeper.enabled and time.monotonic() >= next_sweep and not daemon.writer.get_statistics()["queue_depth"]:
+                next_sweep = time.monotonic() + config.MEMORY_RETENTION_SWEEP_INTERVAL
+                try:
+                    sweeper.sweep_step()
+                except Exception as e:
+                    logging.error(f"MemoryDaemon: Ошибка очистки памяти: {e}")
+    finally:
+        daemon.stop()
+        memory.close()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(prog="python -m src.services.memory_daemon", description="Демон-писатель агентской памяти")
+    parser.add_argument("--socket", help="Путь к Unix сокету (по умолчанию MEMORY_DAEMON_SOCKET или <MEMORY_DIR>/writer.sock)")
+    args = parser.parse_args(argv)
+    run_daemon(args.socket or config.MEMORY_DAEMON_SOCKET or os.path.join(config.MEMORY_DIR, "writer.sock"))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
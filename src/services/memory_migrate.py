@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+from .agent_memory import AgentMemory, CHAT_FILE_PATTERN, LAYOUT_FLAT, STORAGE_SEGMENTS, iter_markdown_messages
+from .memory_sqlite import SQLiteMemory
+
+# Куда можно перенести markdown историю
+TARGET_SEGMENTS = "segments"  # директория AgentMemory в формате сегментов
+TARGET_SQLITE = "sqlite"  # база SQLiteMemory
+TARGET_JSONL = "jsonl"  # по файлу chat_<id>.jsonl на чат
+TARGETS = (TARGET_SEGMENTS, TARGET_SQLITE, TARGET_JSONL)
+
+# Хранилище, открытое в процессе-воркере (одно на процесс)
+_target = None
+
+
+def iter_markdown_chats(memory_dir: Path) -> Iterator[Tuple[int, Path]]:
+    """Итерирует (chat_id, путь) по markdown файлам чатов, включая шард-директории."""
+    for root, _, files in os.walk(memory_dir):
+        for name in files:
+            match = CHAT_FILE_PATTERN.match(name)
+            if match and match.group(2) == ".md":
+                yield int(match.group(1)), Path(root) / name
+
+
+def _init_worker(target: str, output: str, layout: str):
+    global _target
+    if target == TARGET_SEGMENTS:
+        # Манифест строит родительский процесс после миграции — воркеры его не трогают
+        _target = AgentMemory(memory_dir=output, storage_format=STORAGE_SEGMENTS, layout=layout, track_manifest=False)
+    elif target == TARGET_SQLITE:
+        _target = SQLiteMemory(db_path=output)
+
+
+def _migrate_chat(task: Tuple[int, str, str, str, int]) -> Tuple[int, int, int]:
+    """
+    Переносит один чат, читая markdown построчно и записывая пачками.
+
+    Returns:
+        (chat_id, перенесено сообщений, размер исходного файла в байтах)
+    """
+    chat_id, source_path, target, output, batch_size = task
+    source_size = os.path.getsize(source_path)
+
+    if target == TARGET_JSONL:
+        return chat_id, _export_jsonl(chat_id, Path(source_path), Path(output) / f"chat_{chat_id}.jsonl"), source_size
+
+    # Чат мог быть перенесен наполовину до прерывания — переносим его заново
+    _target.clear_chat(chat_id)
+    count = 0
+    batch = []
+    for message_id, user_id, timestamp, text in iter_markdown_messages(Path(source_path)):
+        batch.append((message_id, user_id, text, timestamp or datetime.now()))
+        if len(batch) >= batch_size:
+            _target.save_messages(chat_id, batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        _target.save_messages(chat_id, batch)
+        count += len(batch)
+
+    if isinstance(_target, AgentMemory):
+        _target.release_chat(chat_id)
+    return chat_id, count, source_size
+
+
+def _export_jsonl(chat_id: int, source_path: Path, output_path: Path) -> int:
+    """Выгружает чат в JSONL через временный файл: файл либо полный, либо отсутствует."""
+    tmp_path = output_path.with_name(output_path.name + ".tmp")
+    count = 0
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for message_id, user_id, timestamp, text in iter_markdown_messages(source_path):
+            record = {
+                "chat_id": chat_id,
+                "message_id": message_id,
+                "user_id": user_id,
+                "timestamp": timestamp.isoformat() if timestamp else None,
+                "text": text,
+            }
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    os.replace(tmp_path, output_path)
+    return count
+
+
+def _read_checkpoint(path: Path) -> Set[int]:
+    """ID чатов, перенесенных до прерывания."""
+    if not path.exists():
+        return set()
+    done = set()
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line.lstrip('-').isdigit():
+                done.add(int(line))
+    return done
+
+
+def migrate_memory(
+    memory_dir: str,
+    target: str,
+    output: str,
+    workers: int = 4,
+    batch_size: int = 1000,
+    checkpoint_path: Optional[str] = None,
+    layout: str = LAYOUT_FLAT,
+    progress=None,
+) -> Dict:
+    """
+    Переносит markdown историю всех чатов в другой бэкенд или в JSONL.
+
+    Файлы читаются построчно, поэтому память не зависит от размера чата.
+    Чаты распределяются по пулу процессов. Каждый завершенный чат
+    дописывается в файл контрольной точки, и повторный запуск
+    продолжает с того места, где миграция прервалась.
+
+    Args:
+        memory_dir: Исходная директория памяти с markdown файлами
+        target: "segments", "sqlite" или "jsonl"
+        output: Директория (segments, jsonl) или файл базы (sqlite)
+        workers: Число процессов
+        batch_size: Сколько сообщений писать одной пачкой
+        checkpoint_path: Файл контрольной точки (по умолчанию <output>.checkpoint)
+        layout: Раскладка файлов для target="segments"
+        progress: Необязательный callback(stats) после каждого чата
+
+    Returns:
+        Статистика: чаты, сообщения, байты, время и пропускная способность
+    """
+    if target not in TARGETS:
+        raise ValueError(f"Неизвестная цель миграции: {target}")
+
+    source = Path(memory_dir)
+    output_path = Path(output)
+    if target != TARGET_SQLITE:
+        if output_path.resolve() == source.resolve():
+            raise ValueError("Директория назначения должна отличаться от исходной")
+        output_path.mkdir(parents=True, exist_ok=True)
+    else:
+        # Схему создаем заранее, чтобы воркеры не гонялись за ее созданием
+        SQLiteMemory(db_path=str(output_path)).close()
+
+    checkpoint = Path(checkpoint_path) if checkpoint_path else output_path.with_name(output_path.name + ".checkpoint")
+    done = _read_checkpoint(checkpoint)
+    tasks = [
+        (chat_id, str(path), target, str(output_path), batch_size)
+        for chat_id, path in sorted(iter_markdown_chats(source))
+        if chat_id not in done
+    ]
+
+    started = time.perf_counter()
+    stats = {
+        "total_chats": len(tasks) + len(done),
+        "skipped_chats": len(done),
+        "chats": 0,
+        "messages": 0,
+        "bytes": 0,
+    }
+    logging.info(f"MemoryMigration: {len(tasks)} чатов к переносу в {target}, {len(done)} уже перенесено")
+
+    with open(checkpoint, 'a', encoding='utf-8') as checkpoint_file, ProcessPoolExecutor(
+        max_workers=max(1, workers),
+        initializer=_init_worker,
+        initargs=(target, str(output_path), layout),
+    ) as executor:
+        for chat_id, count, source_size in executor.map(_migrate_chat, tasks, chunksize=8):
+            checkpoint_file.write(f"{chat_id}\n")
+            checkpoint_file.flush()
+            stats["chats"] += 1
+            stats["messages"] += count
+            stats["bytes"] += source_size
+            if progress:
+                progress(_with_rates(stats, started))
+
+    if target == TARGET_SEGMENTS:
+        AgentMemory(memory_dir=str(output_path), storage_format=STORAGE_SEGMENTS, layout=layout).rebuild_manifest(workers)
+
+    # Миграция завершена целиком — следующий запуск начнет заново
+    checkpoint.unlink(missing_ok=True)
+    stats = _with_rates(stats, started)
+    logging.info(
+        f"MemoryMigration: Перенесено {stats['chats']} чатов, {stats['messages']} сообщений "
+        f"за {stats['elapsed_seconds']} с ({stats['messages_per_second']} сообщ/с)"
+    )
+    return stats
+
+
+def _with_rates(stats: Dict, started: float) -> Dict:
+    elapsed = time.perf_counter() - started
+    return {
+        **stats,
+        "elapsed_seconds": round(elapsed, 3),
+        "messages_per_second": round(stats["messages"] / elapsed, 1) if elapsed else 0.0,
+        "megabytes_per_second": round(stats["bytes"] / 1024 / 1024 / elapsed, 2) if elapsed else 0.0,
+    }
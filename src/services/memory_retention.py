@@ -0,0 +1,176 @@
+import time
+import logging
+from typing import Dict, List, Optional
+
+from .config import config
+from .agent_memory import agent_memory
+
+
+class RetentionSweeper:
+    """
+    Фоновая очистка агентской памяти по лимитам хранения.
+
+    За один шаг обходит небольшую пачку чатов по кругу, поэтому даже при
+    десятках тысяч чатов каждый шаг короткий и не мешает записи. Чаты в
+    пределах лимитов отсеиваются по счетчикам из манифеста, файлы читаются
+    только у тех, что лимиты превысили. Общие лимиты на всю память
+    освобождают место за счет чатов, которые дольше всех не обновлялись.
+    """
+
+    def __init__(
+        self,
+        memory,
+        max_messages: int = 0,
+        max_bytes: int = 0,
+        max_age: float = 0,
+        global_max_messages: int = 0,
+        global_max_bytes: int = 0,
+        batch_size: int = 50,
+    ):
+        """
+        Args:
+            memory: Хранилище памяти с поддержкой apply_retention (файловый бэкенд)
+            max_messages: Сколько последних сообщений хранить в каждом чате (0 — без ограничения)
+            max_bytes: Сколько байт истории хранить на чат (0 — без ограничения)
+            max_age: Максимальный возраст сообщений в секундах (0 — без ограничения)
+            global_max_messages: Лимит сообщений на всю память (0 — без ограничения)
+            global_max_bytes: Лимит байт на всю память (0 — без ограничения)
+            batch_size: Сколько чатов проверять за один шаг
+        """
+        self.memory = memory
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.global_max_messages = global_max_messages
+        self.global_max_bytes = global_max_bytes
+        self.batch_size = batch_size
+        # Позиция обхода: ID чата, на котором закончился прошлый шаг
+        self._cursor: Optional[int] = None
+
+        # Статистика
+        self.reclaimed_messages = 0
+        self.reclaimed_bytes = 0
+        self.chats_trimmed = 0
+        self.sweeps = 0
+        self.last_sweep_ms = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        has_limits = any((
+            self.max_messages, self.max_bytes, self.max_age,
+            self.global_max_messages, self.global_max_bytes,
+        ))
+        return has_limits and hasattr(self.memory, "apply_retention")
+
+    def sweep_step(self) -> Dict:
+        """
+        Выполняет один шаг очистки: следующую пачку чатов по кругу
+        и, если нужно, освобождение места под общие лимиты.
+
+        Returns:
+            Сколько сообщений удалено и байт освобождено за шаг
+        """
+        if not self.enabled:
+            return {"messages": 0, "bytes": 0}
+
+        started = time.perf_counter()
+        reclaimed = {"messages": 0, "bytes": 0}
+
+        if self.max_messages or self.max_bytes or self.max_age:
+            for chat_id in self._next_batch():
+                self._add(reclaimed, self.memory.apply_retention(
+                    chat_id,
+                    max_messages=self.max_messages,
+                    max_bytes=self.max_bytes,
+                    max_age=self.max_age,
+                ))
+
+        if self.global_max_messages or self.global_max_bytes:
+            result = self._enforce_global_limits()
+            reclaimed["messages"] += result["messages"]
+            reclaimed["bytes"] += result["bytes"]
+
+        self.sweeps += 1
+        self.last_sweep_ms = (time.perf_counter() - started) * 1000
+        if reclaimed["messages"]:
+            logging.info(
+                f"RetentionSweeper: Удалено {reclaimed['messages']} сообщений, "
+                f"освобождено {reclaimed['bytes']} байт за {self.last_sweep_ms:.1f} мс"
+            )
+        return reclaimed
+
+    def _next_batch(self) -> List[int]:
+        """Следующие batch_size чатов после курсора, с переходом в начало списка."""
+        chat_ids = self.memory.list_chats()
+        if not chat_ids:
+            return []
+
+        start = 0
+        if self._cursor is not None:
+            start = next((i for i, chat_id in enumerate(chat_ids) if chat_id > self._cursor), 0)
+        batch = (chat_ids[start:] + chat_ids[:start])[:self.batch_size]
+        self._cursor = batch[-1]
+        return batch
+
+    def _enforce_global_limits(self) -> Dict:
+        """Урезает историю давно не обновлявшихся чатов, пока память превышает общие лимиты."""
+        reclaimed = {"messages": 0, "bytes": 0}
+        stats = self.memory.get_statistics()
+        excess_messages = stats["total_messages"] - self.global_max_messages if self.global_max_messages else 0
+        excess_bytes = stats.get("total_bytes", 0) - self.global_max_bytes if self.global_max_bytes else 0
+        if excess_messages <= 0 and excess_bytes <= 0:
+            return reclaimed
+
+        usage = self.memory.chat_usage()
+        # Сначала чаты, которые дольше всех не обновлялись
+        for chat_id in sorted(usage, key=lambda chat_id: usage[chat_id].get("last_update") or ""):
+            entry = usage[chat_id]
+            keep_messages = entry["message_count"] - excess_messages if excess_messages > 0 else None
+            keep_bytes = entry.get("bytes", 0) - excess_bytes if excess_bytes > 0 else None
+            if (keep_messages is not None and keep_messages <= 0) or (keep_bytes is not None and keep_bytes <= 0):
+                # Весь чат укладывается в превышение — удаляем его целиком
+                self.memory.clear_chat(chat_id)
+                result = {"messages": entry["message_count"], "bytes": entry.get("bytes", 0)}
+            else:
+                result = self.memory.apply_retention(
+                    chat_id,
+                    max_messages=keep_messages or 0,
+                    max_bytes=keep_bytes or 0,
+                )
+            self._add(reclaimed, result)
+            excess_messages -= result["messages"]
+            excess_bytes -= result["bytes"]
+            if excess_messages <= 0 and excess_bytes <= 0:
+                break
+        return reclaimed
+
+    def _add(self, total: Dict, result: Dict):
+        total["messages"] += result["messages"]
+        total["bytes"] += result["bytes"]
+        if result["messages"]:
+            self.chats_trimmed += 1
+            self.reclaimed_messages += result["messages"]
+            self.reclaimed_bytes += result["bytes"]
+
+    def get_statistics(self) -> Dict:
+        """Возвращает, сколько очистка освободила с момента запуска."""
+        return {
+            "enabled": self.enabled,
+            "reclaimed_messages": self.reclaimed_messages,
+            "reclaimed_bytes": self.reclaimed_bytes,
+            "chats_trimmed": self.chats_trimmed,
+            "sweeps": self.sweeps,
+            "last_sweep_ms": round(self.last_sweep_ms, 2),
+        }
+
+
+# Инициализируем синглтон; шаги очистки запускает фоновая задача в main.py
+retention_sweeper = RetentionSweeper(
+    agent_memory,
+    max_messages=config.MEMORY_RETENTION_MAX_MESSAGES,
+    max_bytes=config.MEMORY_RETENTION_MAX_BYTES,
+    max_age=config.MEMORY_RETENTION_MAX_AGE_DAYS * 86400,
+    global_max_messages=config.MEMORY_RETENTION_GLOBAL_MAX_MESSAGES,
+    global_max_bytes=config.MEMORY_RETENTION_GLOBAL_MAX_BYTES,
+    batch_size=config.MEMORY_RETENTION_BATCH_SIZE,
+)
@@ -0,0 +1,387 @@
+import os
+import re
+import json
+import math
+import heapq
+import struct
+import hashlib
+import logging
+import threading
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict, deque
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# Сегмент индекса: [magic][число термов: uint32][число сообщений: uint32][первый и последний ID: int64]
+SEGMENT_MAGIC = b"MBIX"
+SEGMENT_HEADER = struct.Struct("<4sIIqq")
+# Словарь термов, отсортированный по хешу: [хеш терма: uint64][начало постингов: uint32][длина: uint32]
+TERM_ENTRY = struct.Struct("<QII")
+SEGMENT_SUFFIX = ".fts"
+
+# Слова короче трех букв почти не несут смысла для поиска
+TOKEN_PATTERN = re.compile(r"\w{3,}")
+# Грубый стемминг: у русских словоформ отрезаем окончание, длинные основы обрезаем
+STEM_LENGTH = 6
+ENDINGS = (
+    "ами", "ями", "ого", "его", "ому", "ему",
+    "ов", "ев", "ей", "ой", "ый", "ий", "ая", "яя", "ое", "ее", "ые", "ие", "ом", "ем", "ам", "ям", "ах", "ях",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "s",
+)
+STOP_WORDS = frozenset({
+    "это", "что", "как", "так", "вот", "был", "была", "были", "быть", "уже", "еще", "ещё", "или",
+    "для", "его", "она", "они", "оно", "мне", "меня", "тебя", "тебе", "все", "всё", "нет", "да",
+    "ну", "там", "тут", "где", "когда", "если", "чтобы", "тоже", "только", "очень", "просто",
+    "the", "and", "for", "you", "that", "this", "with", "are", "was",
+})
+# Сколько последних вхождений терма учитывать: держит время запроса
+# в миллисекундах даже для слов, которые встречаются в каждом сообщении
+MAX_POSTINGS_PER_TERM = 5000
+
+
+def _stem(word: str) -> str:
+    for ending in ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            word = word[:-len(ending)]
+            break
+    return word[:STEM_LENGTH]
+
+
+def tokenize(text: str) -> Set[str]:
+    """Термы сообщения: слова от трех букв без стоп-слов, сведенные к основе."""
+    return {
+        _stem(word)
+        for word in TOKEN_PATTERN.findall(text.lower())
+        if word not in STOP_WORDS and not word.isdigit()
+    }
+
+
+def _term_hash(term: str) -> int:
+    return int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class IndexSegment:
+    """
+    Неизменяемый сегмент инвертированного индекса.
+
+    Словарь термов держится в памяти (16 байт на терм), постинги —
+    отсортированные ID сообщений — читаются с диска по запросу.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._fd = os.open(self.path, os.O_RDONLY)
+        header = os.pread(self._fd, SEGMENT_HEADER.size, 0)
+        magic, n_terms, self.docs, self.first_message_id, self.last_message_id = SEGMENT_HEADER.unpack(header)
+        if magic != SEGMENT_MAGIC:
+            os.close(self._fd)
+            raise ValueError(f"{self.path} не является сегментом поискового индекса")
+
+        table = os.pread(self._fd, n_terms * TERM_ENTRY.size, SEGMENT_HEADER.size)
+        self._hashes = array("Q")
+        self._starts = array("I")
+        self._counts = array("I")
+        for term_hash, start, count in TERM_ENTRY.iter_unpack(table):
+            self._hashes.append(term_hash)
+            self._starts.append(start)
+            self._counts.append(count)
+        self._postings_offset = SEGMENT_HEADER.size + n_terms * TERM_ENTRY.size
+
+    def postings(self, term_hash: int) -> array:
+        """ID сообщений с термом, по возрастанию."""
+        position = bisect_left(self._hashes, term_hash)
+        if position == len(self._hashes) or self._hashes[position] != term_hash:
+            return array("q")
+        postings = array("q")
+        itemsize = postings.itemsize
+        postings.frombytes(os.pread(
+            self._fd, self._counts[position] * itemsize, self._postings_offset + self._starts[position] * itemsize,
+        ))
+        return postings
+
+    def iter_terms(self) -> Iterable[Tuple[int, array]]:
+        for term_hash in self._hashes:
+            yield term_hash, self.postings(term_hash)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    @staticmethod
+    def write(path: Path, postings: Dict[int, List[int]], docs: int, first_message_id: int, last_message_id: int):
+        """Записывает сегмент через временный файл."""
+        table = []
+        blob = array("q")
+        for term_hash in sorted(postings):
+            ids = postings[term_hash]
+            table.append(TERM_ENTRY.pack(term_hash, len(blob), len(ids)))
+            blob.extend(ids)
+
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, len(table), docs, first_message_id, last_message_id))
+            f.write(b"".join(table))
+            f.write(blob.tobytes())
+        os.replace(tmp_path, path)
+
+
+class _ChatIndex:
+    """Индекс одного чата: сегменты на диске и буфер еще не сброшенных сообщений."""
+
+    def __init__(self, segments: List[IndexSegment], next_seq: int, indexed_through: int):
+        self.segments = segments
+        self.next_seq = next_seq
+        self.flushed_through = indexed_through
+        self.buffer: Dict[int, List[int]] = defaultdict(list)
+        self.buffered_docs = 0
+        self.buffer_first_id = 0
+        self.last_message_id = indexed_through
+
+    @property
+    def docs(self) -> int:
+        return sum(segment.docs for segment in self.segments) + self.buffered_docs
+
+    def postings(self, term_hash: int) -> List[int]:
+        ids: List[int] = []
+        for segment in self.segments:
+            ids.extend(segment.postings(term_hash))
+        ids.extend(self.buffer.get(term_hash, ()))
+        return ids
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+
+class MemorySearchIndex:
+    """
+    Инкрементальный инвертированный индекс по истории чатов (терм → ID сообщений).
+
+    Новые сообщения копятся в буфере и сбрасываются на диск неизменяемыми
+    сегментами по flush_messages сообщений; когда сегментов становится
+    больше max_segments, они сливаются в один. Буфер после сбоя не
+    сохраняется — AgentMemory доиндексирует хвост по indexed_through.
+    """
+
+    def __init__(self, index_dir: str, flush_messages: int = 1000, max_segments: int = 8, max_open_chats: int = 256):
+        """
+        Args:
+            index_dir: Директория индекса
+            flush_messages: Сколько сообщений копить в буфере перед сбросом сегмента
+            max_segments: Сколько сегментов на чат держать до слияния
+            max_open_chats: Сколько чатов держать загруженными с открытыми сегментами (0 — без ограничения)
+        """
+        self.index_dir = Path(index_dir)
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        self.flush_messages = flush_messages
+        self.max_segments = max_segments
+        self.max_open_chats = max_open_chats
+        # Порядок — от давно не использованных к свежим; лишние чаты сбрасываются и закрываются
+        self._chats: OrderedDict[int, _ChatIndex] = OrderedDict()
+        self._lock = threading.RLock()
+        # Время последних запросов (мс) для перцентилей
+        self._latencies: deque = deque(maxlen=1000)
+        self.queries = 0
+        self.segments_written = 0
+
+    def _manifest_path(self, chat_id: int) -> Path:
+        return self.index_dir / f"{chat_id}.json"
+
+    def _segment_path(self, chat_id: int, seq: int) -> Path:
+        return self.index_dir / f"{chat_id}.{seq:06d}{SEGMENT_SUFFIX}"
+
+    def _get_chat(self, chat_id: int) -> _ChatIndex:
+        chat = self._chats.get(chat_id)
+        if chat is not None:
+            self._chats.move_to_end(chat_id)
+        else:
+            manifest = {}
+            try:
+                with open(self._manifest_path(chat_id), "r", encoding="utf-8") as f:
+                    manifest = json.load(f)
+            except FileNotFoundError:
+                pass
+            except ValueError as e:
+                logging.warning(f"MemorySearchIndex: Поврежден манифест индекса чата {chat_id}, индекс строится заново: {e}")
+
+            segments = []
+            try:
+                for name in manifest.get("segments", []):
+                    segments.append(IndexSegment(self.index_dir / name))
+            except (OSError, ValueError) as e:
+                logging.warning(f"MemorySearchIndex: Не удалось открыть сегмент индекса чата {chat_id}, индекс строится заново: {e}")
+                for segment in segments:
+                    segment.close()
+                segments = []
+                manifest = {}
+
+            chat = _ChatIndex(segments, manifest.get("next_seq", 1), manifest.get("indexed_through", 0))
+            self._chats[chat_id] = chat
+            while self.max_open_chats and len(self._chats) > self.max_open_chats:
+                self.release_chat(next(iter(self._chats)))
+        return chat
+
+    def indexed_through(self, chat_id: int) -> int:
+        """ID последнего проиндексированного сообщения чата (включая буфер)."""
+        with self._lock:
+            return self._get_chat(chat_id).last_message_id
+
+    def add(self, chat_id: int, messages: Iterable[Tuple[int, str]]):
+        """
+        Индексирует сообщения чата.
+
+        Args:
+            chat_id: ID чата
+            messages: Пары (message_id, text) по возрастанию ID; уже
+                проиндексированные сообщения пропускаются
+        """
+        with self._lock:
+            chat = self._get_chat(chat_id)
+            for message_id, text in messages:
+                if message_id <= chat.last_message_id:
+                    continue
+                for term in tokenize(text):
+                    chat.buffer[_term_hash(term)].append(message_id)
+                if not chat.buffered_docs:
+                    chat.buffer_first_id = message_id
+                chat.buffered_docs += 1
+                chat.last_message_id = message_id
+            if chat.buffered_docs >= self.flush_messages:
+                self._flush_chat(chat_id, chat)
+
+    def _flush_chat(self, chat_id: int, chat: _ChatIndex):
+        """Сбрасывает буфер чата в новый сегмент и при необходимости сливает сегменты."""
+        if not chat.buffered_docs:
+            return
+        path = self._segment_path(chat_id, chat.next_seq)
+        IndexSegment.write(path, chat.buffer, chat.buffered_docs, chat.buffer_first_id, chat.last_message_id)
+        chat.segments.append(IndexSegment(path))
+        chat.next_seq += 1
+        chat.buffer = defaultdict(list)
+        chat.buffered_docs = 0
+        chat.flushed_through = chat.last_message_id
+        self.segments_written += 1
+
+        obsolete = []
+        if len(chat.segments) > self.max_segments:
+            # Самый старый сегмент, если он больше всех остальных вместе,
+            # не переписываем — так объем слияний растет логарифмически
+            keep = 1 if chat.segments[0].docs > sum(segment.docs for segment in chat.segments[1:]) else 0
+            obsolete = chat.segments[keep:]
+            chat.segments = chat.segments[:keep] + [self._merge(chat_id, chat, obsolete)]
+        self._write_manifest(chat_id, chat)
+        # Старые сегменты удаляем только после того, как манифест ссылается на новый
+        for segment in obsolete:
+            segment.close()
+            segment.path.unlink(missing_ok=True)
+
+    def _merge(self, chat_id: int, chat: _ChatIndex, segments: List[IndexSegment]) -> IndexSegment:
+        postings: Dict[int, List[int]] = defaultdict(list)
+        for segment in segments:
+            for term_hash, ids in segment.iter_terms():
+                postings[term_hash].extend(ids)
+        path = self._segment_path(chat_id, chat.next_seq)
+        IndexSegment.write(
+            path, postings, sum(segment.docs for segment in segments),
+            segments[0].first_message_id, segments[-1].last_message_id,
+        )
+        chat.next_seq += 1
+        logging.info(f"MemorySearchIndex: Чат {chat_id}: {len(segments)} сегментов индекса слиты в {path.name}")
+        return IndexSegment(path)
+
+    def _write_manifest(self, chat_id: int, chat: _ChatIndex):
+        manifest = {
+            "segments": [segment.path.name for segment in chat.segments],
+            "next_seq": chat.next_seq,
+            "indexed_through": chat.flushed_through,
+        }
+        path = self._manifest_path(chat_id)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, path)
+
+    def search(self, chat_id: int, text: str, limit: int = 5, before_message_id: Optional[int] = None) -> List[int]:
+        """
+        Находит сообщения чата, лексически близкие к тексту.
+
+        Сообщения ранжируются по сумме IDF совпавших термов, при равенстве
+        выше новые.
+
+        Args:
+            chat_id: ID чата
+            text: Текст запроса
+            limit: Сколько сообщений вернуть
+            before_message_id: Искать только среди сообщений с меньшим ID
+
+        Returns:
+            ID найденных сообщений, от самых релевантных
+        """
+        terms = tokenize(text)
+        if not terms or limit <= 0:
+            return []
+
+        scores: Dict[int, float] = defaultdict(float)
+        with self._lock:
+            chat = self._get_chat(chat_id)
+            docs = chat.docs
+            for term in terms:
+                ids = chat.postings(_term_hash(term))
+                if before_message_id is not None:
+                    ids = ids[:bisect_left(ids, before_message_id)]
+                if not ids:
+                    continue
+                idf = math.log(1 + docs / len(ids))
+                for message_id in ids[-MAX_POSTINGS_PER_TERM:]:
+                    scores[message_id] += idf
+
+        top = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], item[0]))
+        return [message_id for message_id, _ in top]
+
+    def record_latency(self, elapsed_ms: float):
+        """Учитывает время одного запроса (вместе с чтением найденных сообщений)."""
+        self.queries += 1
+        self._latencies.append(elapsed_ms)
+
+    def release_chat(self, chat_id: int):
+        """Сбрасывает буфер чата и закрывает его сегменты."""
+        with self._lock:
+            chat = self._chats.pop(chat_id, None)
+            if chat is not None:
+                self._flush_chat(chat_id, chat)
+                chat.close()
+
+    def drop_chat(self, chat_id: int):
+        """Удаляет индекс чата целиком."""
+        with self._lock:
+            chat = self._chats.pop(chat_id, None)
+            if chat is not None:
+                chat.close()
+            for path in self.index_dir.glob(f"{chat_id}.*"):
+                path.unlink(missing_ok=True)
+
+    def flush(self):
+        """Сбрасывает буферы всех чатов на диск."""
+        with self._lock:
+            for chat_id, chat in self._chats.items():
+                self._flush_chat(chat_id, chat)
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            for chat in self._chats.values():
+                chat.close()
+            self._chats.clear()
+
+    def get_statistics(self) -> Dict:
+        """Статистика запросов: число, среднее и p95 времени в мс."""
+        latencies = sorted(self._latencies)
+        return {
+            "queries": self.queries,
+            "avg_ms": round(sum(latencies) / len(latencies), 2) if latencies else 0.0,
+            "p95_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 2) if latencies else 0.0,
+            "loaded_chats": len(self._chats),
+            "segments_written": self.segments_written,
+        }
@@ -0,0 +1,223 @@
+import sqlite3
+import threading
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_chat_message ON messages (chat_id, message_id);
+CREATE INDEX IF NOT EXISTS idx_messages_chat_time ON messages (chat_id, timestamp);
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id INTEGER PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    last_message_id INTEGER NOT NULL DEFAULT 0,
+    last_update TEXT
+);
+"""
+
+
+class SQLiteMemory:
+    """
+    Агентская память в одной базе SQLite (режим WAL).
+
+    Повторяет публичный API AgentMemory, но вместо двух файлов на чат хранит
+    все сообщения в одной таблице с индексом (chat_id, message_id).
+    Пишет один поток (фоновый писатель) через общее соединение, читатели
+    получают собственные соединения и не блокируются записью благодаря WAL.
+    """
+
+    def __init__(self, db_path: str = "memory/memory.db"):
+        """
+        Args:
+            db_path: Путь к файлу базы данных
+        """
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._write_lock = threading.Lock()
+        self._local = threading.local()
+        self._write_conn = self._connect()
+        self._write_conn.execute("PRAGMA journal_mode=WAL")
+        self._write_conn.executescript(SCHEMA)
+        logging.info(f"SQLiteMemory: Инициализирована база {self.db_path}")
+
+    def _connect(self) -> sqlite3.Connection:
+        # Запас по ожиданию блокировки: в базу могут параллельно писать процессы миграции
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None, timeout=30.0)
+        # В WAL режиме NORMAL не теряет целостность, а fsync делается только на checkpoint
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _read_conn(self) -> sqlite3.Connection:
+        """Соединение для чтения, свое у каждого потока."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    def save_message(self, chat_id: int, message_id: int, user_id: int, text: str, timestamp: Optional[datetime] = None):
+        """Сохраняет одно сообщение."""
+        if timestamp is None:
+            timestamp = datetime.now()
+        self.save_messages(chat_id, [(message_id, user_id, text, timestamp)])
+
+    def save_messages(self, chat_id: int, messages: List[Tuple[int, int, str, datetime]]):
+        """
+        Сохраняет пачку сообщений одного чата в одной транзакции.
+
+        Args:
+            chat_id: ID чата
+            messages: Список кортежей (message_id, user_id, text, timestamp)
+        """
+        if not messages:
+            return
+
+        rows = [
+            (chat_id, message_id, user_id, timestamp.timestamp(), text)
+            for message_id, user_id, text, timestamp in messages
+        ]
+        last_message_id, last_timestamp = messages[-1][0], messages[-1][3]
+
+        with self._write_lock:
+            conn = self._write_conn
+            conn.execute("BEGIN")
+            try:
+                conn.executemany(
+                    "INSERT INTO messages (chat_id, message_id, user_id, timestamp, text) VALUES (?, ?, ?, ?, ?)",
+                    rows,
+                )
+                conn.execute(
+                    """
+                    INSERT INTO chats (chat_id, created_at, message_count, last_message_id, last_update)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (chat_id) DO UPDATE SET
+                        message_count = message_count + excluded.message_count,
+                        last_message_id = excluded.last_message_id,
+                        last_update = excluded.last_update
+                    """,
+                    (chat_id, datetime.now().isoformat(), len(rows), last_message_id, last_timestamp.isoformat()),
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def load_chat_history(self, chat_id: int, limit: Optional[int] = None) -> List[Tuple[int, int, str]]:
+        """
+        Загружает историю сообщений чата.
+
+        Returns:
+            Список кортежей (message_id, user_id, text) в хронологическом порядке
+        """
+        try:
+            conn = self._read_conn()
+            if limit:
+                rows = conn.execute(
+                    "SELECT message_id, user_id, text FROM messages WHERE chat_id = ? "
+                    "ORDER BY message_id DESC LIMIT ?",
+                    (chat_id, limit),
+                ).fetchall()
+                rows.reverse()
+            else:
+                rows = conn.execute(
+                    "SELECT message_id, user_id, text FROM messages WHERE chat_id = ? ORDER BY message_id",
+                    (chat_id,),
+                ).fetchall()
+        except sqlite3.Error as e:
+            logging.error(f"SQLiteMemory: Ошибка при загрузке истории чата {chat_id}: {e}")
+            return []
+        return [tuple(row) for row in rows]
+
+    def iter_messages(self, chat_id: int, after_message_id: int = 0) -> Iterator[Tuple[int, int, str]]:
+        """Итерирует сообщения чата после after_message_id (поиск по индексу (chat_id, message_id))."""
+        cursor = self._read_conn().execute(
+            "SELECT message_id, user_id, text FROM messages WHERE chat_id = ? AND message_id > ? ORDER BY message_id",
+            (chat_id, after_message_id),
+        )
+        for row in cursor:
+            yield tuple(row)
+
+    def load_chat_range(self, chat_id: int, since: datetime, until: datetime) -> Iterator[Tuple[int, int, str]]:
+        """Итерирует сообщения чата за период [since, until] (поиск по индексу (chat_id, timestamp))."""
+        cursor = self._read_conn().execute(
+            "SELECT message_id, user_id, text FROM messages WHERE chat_id = ? AND timestamp BETWEEN ? AND ? "
+            "ORDER BY timestamp, message_id",
+            (chat_id, since.timestamp(), until.timestamp()),
+        )
+        for row in cursor:
+            yield tuple(row)
+
+    def get_metadata(self, chat_id: int) -> Optional[Dict]:
+        """Возвращает метаданные чата."""
+        row = self._read_conn().execute(
+            "SELECT chat_id, created_at, message_count, last_message_id, last_update FROM chats WHERE chat_id = ?",
+            (chat_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "chat_id": row[0],
+            "created_at": row[1],
+            "message_count": row[2],
+            "last_message_id": row[3],
+            "last_update": row[4],
+        }
+
+    def list_chats(self) -> List[int]:
+        """Возвращает список ID всех чатов в памяти."""
+        rows = self._read_conn().execute("SELECT chat_id FROM chats ORDER BY chat_id").fetchall()
+        return [row[0] for row in rows]
+
+    def recent_chats(self, limit: int) -> List[int]:
+        """ID не больше limit чатов, от недавно обновленных к давним."""
+        rows = self._read_conn().execute(
+            "SELECT chat_id FROM chats ORDER BY last_update DESC LIMIT ?", (limit,),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def clear_chat(self, chat_id: int):
+        """Очищает историю конкретного чата."""
+        with self._write_lock:
+            conn = self._write_conn
+            conn.execute("BEGIN")
+            try:
+                conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+                conn.execute("DELETE FROM chats WHERE chat_id = ?", (chat_id,))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        logging.info(f"SQLiteMemory: Удалена история чата {chat_id}")
+
+    def get_statistics(self) -> Dict:
+        """Возвращает статистику по всей памяти."""
+        conn = self._read_conn()
+        total_messages = conn.execute("SELECT COALESCE(SUM(message_count), 0) FROM chats").fetchone()[0]
+        chats = self.list_chats()
+        return {
+            "total_chats": len(chats),
+            "total_messages": total_messages,
+            "chat_ids": chats
+        }
+
+    def flush_metadata(self):
+        """Метаданные пишутся в той же транзакции, что и сообщения — сбрасывать нечего."""
+
+    def close(self):
+        """Закрывает соединения с базой."""
+        with self._write_lock:
+            self._write_conn.close()
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
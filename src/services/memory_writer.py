@@ -0,0 +1,272 @@
+import queue
+import threading
+import time
+import logging
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from .config import config
+from .agent_memory import agent_memory
+
+# Маркер остановки для потока-писателя
+_STOP = object()
+
+
+class _ReleaseChat:
+    """Просьба выгрузить чат из кешей памяти после уже поставленных в очередь записей."""
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+
+
+class MemoryWriter:
+    """
+    Фоновый писатель агентской памяти.
+
+    Хендлеры кладут сообщения в ограниченную очередь и сразу возвращаются,
+    а отдельный поток забирает их пачками и пишет в AgentMemory:
+    все сообщения одного чата из пачки уходят одной записью (group commit).
+    """
+
+    def __init__(self, memory, max_queue_size: int = 10000, batch_size: int = 500, put_timeout: float = 5.0):
+        """
+        Args:
+            memory: Хранилище (AgentMemory или SQLiteMemory), в которое пишутся сообщения
+            max_queue_size: Максимальная длина очереди
+            batch_size: Максимальное число сообщений в одной пачке
+            put_timeout: Сколько секунд ждать места в переполненной очереди, прежде чем
+                отбросить сообщение (0 — отбрасывать сразу)
+        """
+        self.memory = memory
+        self.batch_size = batch_size
+        self.put_timeout = put_timeout
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        # Сообщения, принятые в очередь, но еще не записанные: chat_id → {message_id: (message_id, user_id, text)}
+        self._pending: Dict[int, Dict[int, Tuple[int, int, str]]] = defaultdict(dict)
+        self._pending_lock = threading.Lock()
+
+        # Статистика
+        self.messages_written = 0
+        self.batches_written = 0
+        # Сколько раз submit() ждал места в заполненной очереди
+        self.waits = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Запускает поток-писатель (повторный вызов ничего не делает)."""
+        with self._start_lock:
+            if self.running:
+                return
+            self._thread = threading.Thread(target=self._run, name="memory-writer", daemon=True)
+            self._thread.start()
+            logging.info("MemoryWriter: Фоновый писатель памяти запущен")
+
+    def submit(
+        self, chat_id: int, message_id: int, user_id: int, text: str,
+        timestamp: Optional[datetime] = None, timeout: Optional[float] = None,
+    ) -> bool:
+        """
+        Ставит сообщение в очередь на запись.
+
+        Пока в очереди есть место, вызов не блокируется. Если писатель не успевает
+        и очередь заполнена, вызывающий код ждет места до timeout секунд, то есть
+        притормаживает вместе с диском, а не теряет сообщения.
+
+        Args:
+            timeout: Сколько ждать места в очереди (None — put_timeout, 0 — не ждать)
+
+        Returns:
+            False, если место в очереди так и не освободилось и сообщение отброшено
+        """
+        if timeout is None:
+            timeout = self.put_timeout
+        if timestamp is None:
+            timestamp = datetime.now()
+
+        if not self.running:
+            self.start()
+
+        # Сообщение видно в pending_messages с момента постановки в очередь и до записи на диск
+        with self._pending_lock:
+            self._pending[chat_id][message_id] = (message_id, user_id, text)
+        item = (chat_id, message_id, user_id, text, timestamp)
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+        if timeout > 0:
+            self.waits += 1
+            try:
+                self._queue.put(item, timeout=timeout)
+                return True
+            except queue.Full:
+                pass
+        self._forget_pending(chat_id, [message_id])
+        self.dropped += 1
+        logging.warning(f"MemoryWriter: Очередь записи переполнена, сообщение {message_id} чата {chat_id} не сохранено")
+        return False
+
+    def full(self) -> bool:
+        """Очередь заполнена: следующий submit() будет ждать места."""
+        return self._queue.full()
+
+    def pending_messages(self, chat_id: int) -> List[Tuple[int, int, str]]:
+        """
+        Сообщения чата, которые стоят в очереди или пишутся прямо сейчас.
+        Чтобы ничего не потерять, их нужно взять до чтения истории с диска.
+
+        Returns:
+            Список кортежей (message_id, user_id, text)
+        """
+        with self._pending_lock:
+            return list(self._pending.get(chat_id, {}).values())
+
+    def _forget_pending(self, chat_id: int, message_ids: List[int]):
+        with self._pending_lock:
+            pending = self._pending.get(chat_id)
+            if pending is None:
+                return
+            for message_id in message_ids:
+                pending.pop(message_id, None)
+            if not pending:
+                del self._pending[chat_id]
+
+    def release_chat(self, chat_id: int):
+        """
+        Выгружает чат из кешей и открытых файлов памяти в фоновом потоке,
+        после записи уже поставленных в очередь сообщений этого чата.
+        """
+        if not hasattr(self.memory, "release_chat"):
+            return
+        if not self.running:
+            self.start()
+        try:
+            self._queue.put_nowait(_ReleaseChat(chat_id))
+        except queue.Full:
+            # Чат останется в кешах памяти до следующего вытеснения
+            pass
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """
+        Ждет, пока будет записано все, что поставлено в очередь до вызова.
+
+        Returns:
+            False, если не дождались за timeout
+        """
+        if not self.running:
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def stop(self, timeout: float = 10.0):
+        """Дописывает все, что осталось в очереди, и останавливает поток."""
+        if not self.running:
+            return
+        # Маркер остановки ждет своей очереди за уже поставленными сообщениями
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logging.error(f"MemoryWriter: Не удалось дописать очередь за {timeout} с, осталось {self._queue.qsize()} сообщений")
+        else:
+            logging.info("MemoryWriter: Фоновый писатель памяти остановлен")
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            batch = []
+            # Ожидающие flush() и выгрузки чатов: выполняем после записи пачки
+            barriers = []
+            stop = item is _STOP
+            if isinstance(item, (threading.Event, _ReleaseChat)):
+                barriers.append(item)
+            elif not stop:
+                batch.append(item)
+
+            # Забираем все, что уже накопилось, но не больше batch_size
+            while not stop and not barriers and len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                elif isinstance(item, (threading.Event, _ReleaseChat)):
+                    barriers.append(item)
+                else:
+                    batch.append(item)
+
+            if batch:
+                self._write_batch(batch)
+            for barrier in barriers:
+                if isinstance(barrier, _ReleaseChat):
+                    self._release(barrier.chat_id)
+                else:
+                    barrier.set()
+            if stop:
+                return
+
+    def _release(self, chat_id: int):
+        try:
+            self.memory.release_chat(chat_id)
+        except Exception as e:
+            logging.error(f"MemoryWriter: Ошибка выгрузки чата {chat_id} из памяти: {e}")
+
+    def _write_batch(self, batch: List[Tuple[int, int, int, str, datetime]]):
+        """Группирует пачку по чатам и пишет каждый чат одной записью."""
+        started = time.perf_counter()
+
+        by_chat: Dict[int, List[Tuple[int, int, str, datetime]]] = defaultdict(list)
+        for chat_id, message_id, user_id, text, timestamp in batch:
+            by_chat[chat_id].append((message_id, user_id, text, timestamp))
+
+        for chat_id, messages in by_chat.items():
+            try:
+                self.memory.save_messages(chat_id, messages)
+                self.messages_written += len(messages)
+            except Exception as e:
+                self.errors += 1
+                logging.error(f"MemoryWriter: Ошибка записи {len(messages)} сообщений чата {chat_id}: {e}")
+            self._forget_pending(chat_id, [message_id for message_id, _, _, _ in messages])
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.batches_written += 1
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+        self._total_flush_ms += elapsed_ms
+
+    def get_statistics(self) -> Dict:
+        """Возвращает глубину очереди и задержку записи пачек."""
+        return {
+            "queue_depth": self._queue.qsize(),
+            "queue_max": self._queue.maxsize,
+            "messages_written": self.messages_written,
+            "batches_written": self.batches_written,
+            "waits": self.waits,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "avg_flush_ms": round(self._total_flush_ms / self.batches_written, 2) if self.batches_written else 0.0,
+            "max_flush_ms": round(self.max_flush_ms, 2),
+        }
+
+
+# Инициализируем синглтон; поток стартует при первой записи
+memory_writer = MemoryWriter(
+    agent_memory,
+    max_queue_size=config.MEMORY_WRITER_QUEUE_SIZE,
+    batch_size=config.MEMORY_WRITER_BATCH_SIZE,
+    put_timeout=config.MEMORY_WRITER_PUT_TIMEOUT,
+)
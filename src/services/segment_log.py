@@ -0,0 +1,565 @@
+import os
+import gzip
+import struct
+import zlib
+import hashlib
+import logging
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    # zstd есть в стандартной библиотеке начиная с Python 3.14
+    from compression import zstd
+except ImportError:
+    zstd = None
+
+# Формат записи: [длина тела: uint32][crc32 тела: uint32][тело]
+# Тело: [message_id: int64][user_id: int64][timestamp: float64][текст в utf-8]
+RECORD_HEADER = struct.Struct("<II")
+RECORD_BODY = struct.Struct("<qqd")
+# Индекс: по одному uint64 смещению записи в сегменте на каждую запись
+INDEX_ENTRY = struct.Struct("<Q")
+# Разреженный индекс: [timestamp: float64][message_id: int64][смещение: uint64]
+SPARSE_ENTRY = struct.Struct("<dqQ")
+SPARSE_INTERVAL_BYTES = 64 * 1024  # примерно одна точка входа на столько байт файла
+# Поле разреженного индекса, по которому ищется начало диапазона
+SPARSE_BY_TIMESTAMP = 0
+SPARSE_BY_MESSAGE_ID = 1
+
+# (message_id, user_id, timestamp, text)
+Record = Tuple[int, int, float, str]
+
+# Запечатанные (холодные) сегменты сжимаются zstd, если он доступен, иначе gzip
+COLD_SEGMENT_SUFFIX = ".seg.zst" if zstd is not None else ".seg.gz"
+# Тело записи холодного сегмента: RECORD_BODY + вид текста + данные
+SEALED_INLINE = 0  # короткий текст как есть
+SEALED_KEYED = 1  # [хеш 16 байт][текст] — первое вхождение текста, на который можно ссылаться
+SEALED_REF = 2  # [хеш 16 байт] — повтор уже встреченного в сегменте текста
+DEDUP_MIN_BYTES = 32  # более короткие тексты дешевле хранить как есть, чем ссылкой
+DIGEST_SIZE = 16
+
+
+def encode_record(message_id: int, user_id: int, timestamp: float, text: str) -> bytes:
+    """Кодирует сообщение в запись с префиксом длины."""
+    body = RECORD_BODY.pack(message_id, user_id, timestamp) + text.encode("utf-8")
+    return RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def decode_body(body: bytes) -> Record:
+    """Декодирует тело записи в кортеж (message_id, user_id, timestamp, text)."""
+    message_id, user_id, timestamp = RECORD_BODY.unpack_from(body)
+    return message_id, user_id, timestamp, body[RECORD_BODY.size:].decode("utf-8")
+
+
+def _inode(path: Path) -> Optional[int]:
+    try:
+        return os.stat(path).st_ino
+    except FileNotFoundError:
+        return None
+
+
+def _open_cold(path: Path, mode: str):
+    if path.name.endswith(".zst"):
+        if zstd is None:
+            raise RuntimeError(f"Сегмент {path} сжат zstd, но модуль compression.zstd недоступен")
+        return zstd.open(path, mode)
+    return gzip.open(path, mode, compresslevel=6)
+
+
+def write_sealed_segment(path: Path, records: List[Record]) -> Dict:
+    """
+    Записывает записи в сжатый холодный сегмент.
+
+    Повторяющиеся тексты (копипаста, флуд) хранятся один раз: повторы
+    заменяются ссылкой на хеш содержимого первого вхождения в этом сегменте.
+    Файл пишется во временный и подменяется атомарно.
+
+    Returns:
+        Описание сегмента: число записей, границы по ID и времени, размеры
+    """
+    seen = set()
+    raw_bytes = 0
+    deduplicated = 0
+    tmp_path = path.with_name(path.name + ".tmp")
+
+    with _open_cold(tmp_path, "wb") as f:
+        for message_id, user_id, timestamp, text in records:
+            data = text.encode("utf-8")
+            raw_bytes += len(data)
+            head = RECORD_BODY.pack(message_id, user_id, timestamp)
+            if len(data) < DEDUP_MIN_BYTES:
+                body = head + bytes((SEALED_INLINE,)) + data
+            else:
+                digest = hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+                if digest in seen:
+                    body = head + bytes((SEALED_REF,)) + digest
+                    deduplicated += 1
+                else:
+                    seen.add(digest)
+                    body = head + bytes((SEALED_KEYED,)) + digest + data
+            f.write(RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body)
+
+    os.replace(tmp_path, path)
+    return {
+        "file": path.name,
+        "count": len(records),
+        "first_message_id": records[0][0],
+        "last_message_id": records[-1][0],
+        "first_ts": records[0][2],
+        "last_ts": records[-1][2],
+        "bytes": path.stat().st_size,
+        "raw_bytes": raw_bytes,
+        "deduplicated": deduplicated,
+    }
+
+
+def iter_sealed_segment(path: Path) -> Iterator[Record]:
+    """Последовательно читает холодный сегмент, разворачивая ссылки на повторы."""
+    texts: Dict[bytes, str] = {}
+    with _open_cold(path, "rb") as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            length, crc = RECORD_HEADER.unpack(header)
+            body = f.read(length)
+            if len(body) < length or zlib.crc32(body) != crc:
+                logging.warning(f"SegmentLog: Поврежденная запись в холодном сегменте {path}")
+                return
+
+            message_id, user_id, timestamp = RECORD_BODY.unpack_from(body)
+            kind = body[RECORD_BODY.size]
+            payload = body[RECORD_BODY.size + 1:]
+            if kind == SEALED_INLINE:
+                text = payload.decode("utf-8")
+            elif kind == SEALED_KEYED:
+                text = payload[DIGEST_SIZE:].decode("utf-8")
+                texts[payload[:DIGEST_SIZE]] = text
+            else:
+                text = texts[payload]
+            yield message_id, user_id, timestamp, text
+
+
+class SparseIndex:
+    """
+    Разреженный индекс файла истории: (время, ID сообщения, смещение)
+    примерно раз в interval байт.
+
+    Позволяет начать чтение диапазона по времени или по ID сообщения
+    с ближайшей точки входа, а не с начала файла. Записи в файле истории
+    идут в порядке поступления, поэтому время и ID в индексе неубывают.
+    """
+
+    def __init__(self, path: Path, interval: int = SPARSE_INTERVAL_BYTES):
+        self.path = Path(path)
+        self.interval = interval
+        self._entries: Optional[List[Tuple[float, int, int]]] = None
+        self._signature: Optional[Tuple[int, int]] = None
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def _stat_signature(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size
+
+    def refresh(self):
+        """Сбрасывает загруженные точки входа, если файл индекса изменил другой процесс."""
+        if self._entries is not None and self._stat_signature() != self._signature:
+            self._entries = None
+
+    def entries(self) -> List[Tuple[float, int, int]]:
+        """Точки входа, загружаются с диска при первом обращении."""
+        if self._entries is None:
+            entries = []
+            self._signature = self._stat_signature()
+            if self._signature is not None:
+                data = self.path.read_bytes()
+                # Оборванную последнюю запись игнорируем (ее отрежет следующий add)
+                usable = len(data) - len(data) % SPARSE_ENTRY.size
+                entries = list(SPARSE_ENTRY.iter_unpack(data[:usable]))
+            self._entries = entries
+        return self._entries
+
+    def _select(self, items: Iterable[Tuple[float, int, int]], last_offset: int) -> List[Tuple[float, int, int]]:
+        # Начало файла в индекс не пишем: с него чтение начинается и так,
+        # а у небольших чатов файла индекса не будет вовсе
+        selected = []
+        for timestamp, message_id, offset in items:
+            if offset - last_offset >= self.interval:
+                selected.append((timestamp, message_id, offset))
+                last_offset = offset
+        return selected
+
+    def add(self, items: Iterable[Tuple[float, int, int]]):
+        """Добавляет точки входа из только что дописанных записей (не чаще раза в interval байт)."""
+        entries = self.entries()
+        new_entries = self._select(items, entries[-1][2] if entries else 0)
+        if new_entries:
+            with open(self.path, "ab") as f:
+                f.truncate(len(entries) * SPARSE_ENTRY.size)
+                f.write(b"".join(SPARSE_ENTRY.pack(*entry) for entry in new_entries))
+            entries.extend(new_entries)
+
+    def rebuild(self, items: Iterable[Tuple[float, int, int]]):
+        """Строит индекс заново по всем записям файла."""
+        entries = self._select(items, 0)
+        if entries:
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            tmp_path.write_bytes(b"".join(SPARSE_ENTRY.pack(*entry) for entry in entries))
+            os.replace(tmp_path, self.path)
+        elif self.path.exists():
+            self.path.unlink()
+        self._entries = entries
+
+    def truncate(self, size: int):
+        """Отбрасывает точки входа за концом файла (после отрезания оборванного хвоста)."""
+        entries = self.entries()
+        keep = len(entries)
+        while keep and entries[keep - 1][2] >= size:
+            keep -= 1
+        if keep < len(entries):
+            del entries[keep:]
+            with open(self.path, "r+b") as f:
+                f.truncate(keep * SPARSE_ENTRY.size)
+
+    def floor(self, field: int, value: float) -> int:
+        """
+        Смещение, с которого нужно читать, чтобы не пропустить записи
+        со значением поля field не меньше value.
+        """
+        entries = self.entries()
+        position = bisect_left(entries, value, key=lambda entry: entry[field])
+        return entries[position - 1][2] if position else 0
+
+    def delete(self):
+        self._entries = None
+        if self.path.exists():
+            self.path.unlink()
+
+
+class AppendHandleCache:
+    """
+    LRU открытых на дозапись файлов.
+
+    ⚡ Optimization: При частых дозаписях в одни и те же чаты открытие файла
+    на каждое сообщение стоит дороже самой записи. Держим ограниченное число
+    дескрипторов открытыми и закрываем самые давно использованные.
+    """
+
+    def __init__(self, max_open: int = 256):
+        self.max_open = max_open
+        self._handles: "OrderedDict[Path, BinaryIO]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def write(self, path: Path, data: bytes) -> int:
+        """Дописывает данные в конец файла и возвращает смещение, с которого они легли."""
+        with self._lock:
+            handle = self._handles.get(path)
+            if handle is None:
+                handle = open(path, "ab")
+                self._handles[path] = handle
+                while len(self._handles) > self.max_open:
+                    _, evicted = self._handles.popitem(last=False)
+                    evicted.close()
+            else:
+                self._handles.move_to_end(path)
+
+            offset = handle.tell()
+            handle.write(data)
+            # Сбрасываем буфер, чтобы читатели сразу видели данные
+            handle.flush()
+            return offset
+
+    def close(self, path: Path):
+        """Закрывает дескриптор файла (перед удалением или переписыванием)."""
+        with self._lock:
+            handle = self._handles.pop(path, None)
+            if handle is not None:
+                handle.close()
+
+    def close_all(self):
+        with self._lock:
+            for handle in self._handles.values():
+                handle.close()
+            self._handles.clear()
+
+    def __len__(self) -> int:
+        return len(self._handles)
+
+    def __del__(self):
+        # Закрываем дескрипторы, даже если владелец забыл вызвать close()
+        for handle in self._handles.values():
+            handle.close()
+
+
+class SegmentLog:
+    """
+    Append-only сегмент с записями фиксированного формата и индексом смещений.
+
+    Сегмент (`.log`) хранит записи с префиксом длины, а соседний файл (`.idx`)
+    хранит смещение каждой записи. Благодаря этому чтение последних N сообщений
+    сводится к seek с конца индекса и одному последовательному чтению хвоста лога,
+    без разбора всего файла.
+    """
+
+    def __init__(self, log_path: Path, index_path: Path, handles: Optional[AppendHandleCache] = None):
+        self.log_path = Path(log_path)
+        self.index_path = Path(index_path)
+        self.handles = handles
+        self.sparse = SparseIndex(self.log_path.with_name(self.log_path.name + ".sparse"))
+        self._first_timestamp: Optional[float] = None
+
+    def size(self) -> int:
+        """Размер сегмента в байтах."""
+        try:
+            return self.log_path.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def first_timestamp(self) -> Optional[float]:
+        """Время самой старой записи сегмента (для ротации по возрасту)."""
+        if self._first_timestamp is None:
+            first = next(iter(self.iter_records()), None)
+            if first is not None:
+                self._first_timestamp = first[2]
+        return self._first_timestamp
+
+    def rewrite(self, records: List[Record]):
+        """Атомарно заменяет содержимое сегмента и индекса переданными записями."""
+        chunks = [encode_record(*record) for record in records]
+        offsets = []
+        positions = []
+        offset = 0
+        for record, chunk in zip(records, chunks):
+            offsets.append(INDEX_ENTRY.pack(offset))
+            positions.append((record[2], record[0], offset))
+            offset += len(chunk)
+
+        log_tmp = self.log_path.with_name(self.log_path.name + ".tmp")
+        index_tmp = self._index_tmp_path()
+        log_tmp.write_bytes(b"".join(chunks))
+        index_tmp.write_bytes(b"".join(offsets))
+
+        if self.handles is not None:
+            self.handles.close(self.log_path)
+            self.handles.close(self.index_path)
+        # Старые индексы удаляем до подмены лога: если упадем посередине,
+        # recover() перестроит их по логу с нуля, а не по чужим смещениям
+        if self.index_path.exists():
+            self.index_path.unlink()
+        self.sparse.delete()
+        os.replace(log_tmp, self.log_path)
+        self.sparse.rebuild(positions)
+        # Индекс подменяется последним: пока его временный файл существует,
+        # читатели из других процессов знают, что сегмент переписывается
+        os.replace(index_tmp, self.index_path)
+        self._first_timestamp = records[0][2] if records else None
+
+    def _index_tmp_path(self) -> Path:
+        return self.index_path.with_name(self.index_path.name + ".tmp")
+
+    def generation(self) -> Optional[Tuple[Optional[int], Optional[int]]]:
+        """
+        Поколение сегмента для читателя из другого процесса: inode лога и индекса.
+
+        Дозапись поколение не меняет, а rewrite() подменяет оба файла новыми.
+        Если поколение до и после чтения совпало, лог и индекс прочитаны из одной
+        версии сегмента. None — сегмент переписывается прямо сейчас.
+        """
+        if self._index_tmp_path().exists():
+            return None
+        return _inode(self.log_path), _inode(self.index_path)
+
+    def exists(self) -> bool:
+        return self.log_path.exists()
+
+    def count(self) -> int:
+        """Количество записей в сегменте (по размеру индекса)."""
+        try:
+            return self.index_path.stat().st_size // INDEX_ENTRY.size
+        except FileNotFoundError:
+            return 0
+
+    def append(self, records: List[Record]) -> int:
+        """
+        Дописывает записи в конец сегмента и индекса одной операцией записи.
+
+        Returns:
+            Количество байт, записанных в сегмент
+        """
+        if not records:
+            return 0
+
+        chunks = [encode_record(*record) for record in records]
+        payload = b"".join(chunks)
+        offset = self._write(self.log_path, payload)
+
+        offsets = []
+        positions = []
+        for record, chunk in zip(records, chunks):
+            offsets.append(INDEX_ENTRY.pack(offset))
+            positions.append((record[2], record[0], offset))
+            offset += len(chunk)
+
+        # Индекс пишем после данных: при сбое между записями recover() достроит его
+        self._write(self.index_path, b"".join(offsets))
+        self.sparse.add(positions)
+
+        return len(payload)
+
+    def _write(self, path: Path, data: bytes) -> int:
+        if self.handles is not None:
+            return self.handles.write(path, data)
+        with open(path, "ab") as f:
+            offset = f.tell()
+            f.write(data)
+            return offset
+
+    def tail(self, limit: int) -> List[Record]:
+        """Возвращает последние `limit` записей, читая только хвост сегмента."""
+        if limit <= 0:
+            return []
+
+        total = self.count()
+        if total == 0:
+            return []
+
+        start = max(0, total - limit)
+        with open(self.index_path, "rb") as index_file:
+            index_file.seek(start * INDEX_ENTRY.size)
+            (offset,) = INDEX_ENTRY.unpack(index_file.read(INDEX_ENTRY.size))
+
+        return list(self._iter_from(offset))
+
+    def iter_records(self) -> Iterator[Record]:
+        """Последовательно итерирует все записи сегмента."""
+        if not self.log_path.exists():
+            return iter(())
+        return self._iter_from(0)
+
+    def open_reader(self) -> Optional[BinaryIO]:
+        """
+        Открывает сегмент на чтение. Открытый файл продолжает читать прежнюю
+        версию сегмента, даже если его тут же переписала ротация.
+        """
+        try:
+            return open(self.log_path, "rb")
+        except FileNotFoundError:
+            return None
+
+    def iter_file(self, log_file: BinaryIO, offset: int) -> Iterator[Record]:
+        """Итерирует записи открытого сегмента начиная со смещения (файл не закрывает)."""
+        for _, record in self._iter_entries(log_file, offset):
+            yield record
+
+    def _iter_from(self, offset: int) -> Iterator[Record]:
+        with open(self.log_path, "rb") as log_file:
+            yield from self.iter_file(log_file, offset)
+
+    def _iter_entries(self, log_file: BinaryIO, offset: int) -> Iterator[Tuple[int, Record]]:
+        log_file.seek(offset)
+        while True:
+            header = log_file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            length, crc = RECORD_HEADER.unpack(header)
+            body = log_file.read(length)
+            if len(body) < length or zlib.crc32(body) != crc:
+                logging.warning(f"SegmentLog: Обрезанная или поврежденная запись в {self.log_path} на смещении {offset}")
+                return
+            yield offset, decode_body(body)
+            offset += RECORD_HEADER.size + length
+
+    def rebuild_sparse(self):
+        """Строит разреженный индекс по всему сегменту (для сегментов, записанных без него)."""
+        with open(self.log_path, "rb") as log_file:
+            self.sparse.rebuild(
+                (record[2], record[0], offset) for offset, record in self._iter_entries(log_file, 0)
+            )
+
+    def recover(self):
+        """
+        Приводит индекс в соответствие с сегментом после аварийного завершения.
+
+        Если последняя проиндексированная запись не заканчивается в конце лога,
+        недостающие записи доиндексируются, а оборванный хвост отрезается.
+        Достаточно вызвать один раз при первом обращении к сегменту.
+        """
+        index_tmp = self._index_tmp_path()
+        if index_tmp.exists():
+            # Остаток прерванного rewrite(): индекс перестроим по логу ниже
+            index_tmp.unlink()
+        if not self.log_path.exists():
+            return
+
+        log_size = self.log_path.stat().st_size
+        if not self.sparse.exists() and log_size > self.sparse.interval:
+            # Сегмент записан версией без разреженного индекса
+            self.rebuild_sparse()
+        total = self.count()
+        offset = 0
+
+        if total:
+            with open(self.index_path, "r+b") as index_file:
+                # Индекс мог оборваться посередине записи
+                index_size = total * INDEX_ENTRY.size
+                if os.path.getsize(self.index_path) != index_size:
+                    index_file.truncate(index_size)
+                index_file.seek(index_size - INDEX_ENTRY.size)
+                (last_offset,) = INDEX_ENTRY.unpack(index_file.read(INDEX_ENTRY.size))
+
+            with open(self.log_path, "rb") as log_file:
+                log_file.seek(last_offset)
+                header = log_file.read(RECORD_HEADER.size)
+            offset = last_offset + RECORD_HEADER.size
+            if len(header) == RECORD_HEADER.size:
+                offset += RECORD_HEADER.unpack(header)[0]
+
+            if offset == log_size:
+                return
+            if offset > log_size:
+                # Индекс ссылается за конец лога — перестраиваем его целиком
+                offset = 0
+                total = 0
+        elif log_size == 0:
+            return
+
+        # Доиндексируем записи после offset и отрезаем оборванный хвост
+        new_offsets = []
+        with open(self.log_path, "r+b") as log_file:
+            log_file.seek(offset)
+            while True:
+                header = log_file.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                length, crc = RECORD_HEADER.unpack(header)
+                body = log_file.read(length)
+                if len(body) < length or zlib.crc32(body) != crc:
+                    break
+                new_offsets.append(INDEX_ENTRY.pack(offset))
+                offset += RECORD_HEADER.size + length
+            log_file.truncate(offset)
+
+        with open(self.index_path, "ab") as index_file:
+            index_file.truncate(total * INDEX_ENTRY.size)
+            index_file.write(b"".join(new_offsets))
+        self.sparse.truncate(offset)
+
+        logging.warning(f"SegmentLog: Восстановлен индекс {self.index_path} (+{len(new_offsets)} записей)")
+
+    def delete(self):
+        """Удаляет сегмент и его индекс."""
+        self._first_timestamp = None
+        for path in (self.log_path, self.index_path):
+            if self.handles is not None:
+                self.handles.close(path)
+            if path.exists():
+                path.unlink()
+        self.sparse.delete()
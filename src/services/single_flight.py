@@ -0,0 +1,46 @@
+"""
+Объединение одинаковых одновременных задач (single-flight).
+
+Пока задача с ключом выполняется, повторные вызовы с тем же ключом не
+запускают ее снова, а дожидаются результата первой.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    """Выполняет не больше одной задачи на ключ одновременно."""
+
+    def __init__(self):
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Запускает factory() или присоединяется к уже идущей задаче с тем же ключом.
+
+        Args:
+            key: Ключ задачи
+            factory: Создает корутину задачи; вызывается, только если задачи с ключом нет
+
+        Returns:
+            Результат задачи (общий для всех присоединившихся)
+        """
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(factory())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+            self.started += 1
+        # Отмена одного из ожидающих не отменяет общую задачу для остальных
+        return await asyncio.shield(task)
+
+    def get_statistics(self) -> Dict:
+        return {
+            "in_flight": len(self._in_flight),
+            "started": self.started,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,219 @@
+import re
+import json
+import time
+import logging
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple
+
+# Начало массива сообщений в result.json
+EXPORT_MESSAGES_KEY = re.compile(r'"messages"\s*:\s*\[')
+# Поля чата, которые Telegram Desktop пишет перед массивом сообщений
+EXPORT_HEADER_FIELDS = {
+    "name": re.compile(r'"name"\s*:\s*("(?:[^"\\]|\\.)*")'),
+    "type": re.compile(r'"type"\s*:\s*("(?:[^"\\]|\\.)*")'),
+    "id": re.compile(r'"id"\s*:\s*(-?\d+)'),
+}
+# Разделители между элементами массива
+EXPORT_SEPARATORS = re.compile(r'[\s,]*')
+
+# Типы чатов, которым Bot API дает ID вида -100<id>
+CHANNEL_CHAT_TYPES = ("private_supergroup", "public_supergroup", "private_channel", "public_channel")
+
+
+class TelegramExportReader:
+    """
+    Потоковое чтение экспорта чата Telegram Desktop (result.json).
+
+    Файл читается кусками, а сообщения по одному разбираются
+    json.JSONDecoder.raw_decode из буфера, поэтому память не зависит
+    от размера экспорта. Поддерживается экспорт одного чата.
+    """
+
+    def __init__(self, path: Path, chunk_size: int = 1 << 20):
+        self.path = Path(path)
+        self.chunk_size = chunk_size
+        self._file = open(self.path, 'r', encoding='utf-8')
+        self._buffer = ""
+        self._pos = 0
+        try:
+            self.header = self._read_header()
+        except Exception:
+            self._file.close()
+            raise
+
+    def _fill(self) -> bool:
+        """Дочитывает следующий кусок файла, отбрасывая уже разобранную часть буфера."""
+        chunk = self._file.read(self.chunk_size)
+        if not chunk:
+            return False
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _read_header(self) -> Dict:
+        """Читает поля чата до начала массива messages."""
+        while True:
+            match = EXPORT_MESSAGES_KEY.search(self._buffer)
+            if match:
+                break
+            if not self._fill():
+                raise ValueError(f"В {self.path} нет массива messages — это не экспорт чата Telegram Desktop")
+
+        head = self._buffer[:match.start()]
+        self._pos = match.end()
+        header = {}
+        for field, pattern in EXPORT_HEADER_FIELDS.items():
+            field_match = pattern.search(head)
+            if field_match:
+                header[field] = json.loads(field_match.group(1))
+        return header
+
+    def __iter__(self) -> Iterator[Dict]:
+        decoder = json.JSONDecoder()
+        while True:
+            self._pos = EXPORT_SEPARATORS.match(self._buffer, self._pos).end()
+            if self._pos >= len(self._buffer):
+                if not self._fill():
+                    raise ValueError(f"Экспорт {self.path} оборвался посреди массива messages")
+                continue
+            if self._buffer[self._pos] == ']':
+                return
+
+            try:
+                item, end = decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                # Сообщение не поместилось в буфер целиком — дочитываем
+                if not self._fill():
+                    raise
+                continue
+            self._pos = end
+            yield item
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def bot_api_chat_id(export_id: int, chat_type: str) -> int:
+    """Переводит ID чата из экспорта в ID, который бот видит через Bot API."""
+    if chat_type in CHANNEL_CHAT_TYPES:
+        return int(f"-100{export_id}")
+    if chat_type == "private_group":
+        return -export_id
+    return export_id
+
+
+def _message_text(text) -> str:
+    """Текст сообщения: строка или список из строк и сущностей форматирования."""
+    if isinstance(text, str):
+        return text
+    return "".join(part if isinstance(part, str) else part.get("text", "") for part in text)
+
+
+def _to_memory_message(item: Dict) -> Optional[Tuple[int, int, str, datetime]]:
+    """
+    Переводит сообщение экспорта в кортеж (message_id, user_id, text, timestamp).
+
+    Служебные, пересланные и сообщения без текста пропускаются —
+    так же, как HistoryManager.add_message пропускает их в живом чате.
+    """
+    if item.get("type") != "message" or "forwarded_from" in item:
+        return None
+    text = _message_text(item.get("text", ""))
+    if not text:
+        return None
+
+    digits = re.sub(r"\D", "", str(item.get("from_id", "")))
+    user_id = int(digits) if digits else 0
+    if "date_unixtime" in item:
+        timestamp = datetime.fromtimestamp(int(item["date_unixtime"]))
+    else:
+        timestamp = datetime.fromisoformat(item["date"])
+    return item["id"], user_id, text, timestamp
+
+
+def import_telegram_export(
+    path: str,
+    memory,
+    chat_id: Optional[int] = None,
+    replace: bool = False,
+    batch_size: int = 1000,
+    history=None,
+    progress=None,
+) -> Dict:
+    """
+    Импортирует экспорт чата Telegram Desktop в агентскую память.
+
+    Args:
+        path: Путь к result.json
+        memory: Хранилище памяти (AgentMemory или SQLiteMemory)
+        chat_id: ID чата в Bot API (по умолчанию выводится из экспорта)
+        replace: Перезаписать историю, если чат уже есть в памяти
+        batch_size: Сколько сообщений писать одной пачкой
+        history: HistoryManager, который нужно прогреть последними сообщениями
+        progress: Необязательный callback(stats) после каждой пачки
+
+    Returns:
+        Статистика: ID чата, импортировано, пропущено, время и сообщений в секунду
+    """
+    started = time.perf_counter()
+    stats = {"chat_id": chat_id, "messages": 0, "skipped": 0}
+    tail = deque(maxlen=history.max_size if history is not None else 0)
+
+    with TelegramExportReader(path) as reader:
+        if chat_id is None:
+            if "id" not in reader.header:
+                raise ValueError("В экспорте нет ID чата, укажите его явно")
+            chat_id = bot_api_chat_id(reader.header["id"], reader.header.get("type", ""))
+        stats["chat_id"] = chat_id
+
+        metadata = memory.get_metadata(chat_id)
+        if metadata and metadata.get("message_count"):
+            if not replace:
+                raise ValueError(f"Чат {chat_id} уже есть в памяти, для перезаписи укажите replace")
+            memory.clear_chat(chat_id)
+
+        batch = []
+        for item in reader:
+            message = _to_memory_message(item)
+            if message is None:
+                stats["skipped"] += 1
+                continue
+            batch.append(message)
+            tail.append((message[0], message[1], message[2]))
+            if len(batch) >= batch_size:
+                memory.save_messages(chat_id, batch)
+                stats["messages"] += len(batch)
+                batch = []
+                if progress:
+                    progress(_with_rate(stats, started))
+        if batch:
+            memory.save_messages(chat_id, batch)
+            stats["messages"] += len(batch)
+
+    memory.flush_metadata()
+    if history is not None:
+        history.warm_chat(chat_id, list(tail))
+
+    stats = _with_rate(stats, started)
+    logging.info(
+        f"TelegramImport: Чат {chat_id}: импортировано {stats['messages']} сообщений "
+        f"(пропущено {stats['skipped']}) за {stats['elapsed_seconds']} с, {stats['messages_per_second']} сообщ/с"
+    )
+    return stats
+
+
+def _with_rate(stats: Dict, started: float) -> Dict:
+    elapsed = time.perf_counter() - started
+    return {
+        **stats,
+        "elapsed_seconds": round(elapsed, 3),
+        "messages_per_second": round(stats["messages"] / elapsed, 1) if elapsed else 0.0,
+    }
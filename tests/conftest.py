@@ -1,4 +1,6 @@
 import os
+import shutil
+import tempfile
 import pytest
 from unittest.mock import patch, MagicMock
 from PIL import Image
@@ -8,6 +10,9 @@ os.environ["TELEGRAM_BOT_TOKEN"] = "dummy_token"
 os.environ["TAVILY_API_KEY"] = "dummy_key"
 os.environ["OPENROUTER_API_KEY"] = "dummy_openrouter"
 os.environ["MEMORY_ENABLED"] = "False"  # Disable memory for tests
+# Синглтоны памяти (agent_memory, снимки, кеш LLM) пишут во временную директорию, а не в ./memory
+TEST_MEMORY_DIR = tempfile.mkdtemp(prefix="test_memory_")
+os.environ["MEMORY_DIR"] = TEST_MEMORY_DIR
 # Clean up old vars if they interfere (though pydantic allows extra)
 if "GOOGLE_SEARCH_API_KEY" in os.environ:
     del os.environ["GOOGLE_SEARCH_API_KEY"]
@@ -36,3 +41,7 @@ def mock_fonts():
 
         mock_font.return_value = font_instance
         yield mock_font
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(TEST_MEMORY_DIR, ignore_errors=True)
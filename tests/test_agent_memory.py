@@ -1,8 +1,10 @@
 import unittest
 import tempfile
+import json
 import shutil
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta
+from unittest.mock import patch
 from src.services.agent_memory import AgentMemory
 
 
@@ -218,5 +220,541 @@ class TestAgentMemory(unittest.TestCase):
             self.assertIn("2026-01-09 15:30:00", content)
 
 
+
+
+class TestAgentMemoryMetadataCache(unittest.TestCase):
+    """Тесты write-behind кеша метаданных"""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.agent_memory = AgentMemory(memory_dir=self.temp_dir, metadata_flush_interval=3600)
+    
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def _read_meta_file(self, chat_id):
+        import json
+        with open(self.agent_memory._get_metadata_file_path(chat_id), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    
+    def test_updates_are_deferred(self):
+        """Файл пишется при создании чата, дальнейшие обновления копятся в памяти"""
+        for i in range(1, 4):
+            self.agent_memory.save_message(1, i, 111, f"msg {i}")
+        
+        self.assertEqual(self._read_meta_file(1)['message_count'], 1)
+        self.assertEqual(self.agent_memory.get_metadata(1)['message_count'], 3)
+        self.assertEqual(self.agent_memory.get_statistics()['total_messages'], 3)
+        
+        self.agent_memory.flush_metadata()
+        self.assertEqual(self._read_meta_file(1)['message_count'], 3)
+        self.assertEqual(self._read_meta_file(1)['last_message_id'], 3)
+    
+    def test_close_flushes_and_reloads(self):
+        """close() сбрасывает кеш, новый экземпляр видит актуальные значения"""
+        self.agent_memory.save_message(1, 1, 111, "a")
+        self.agent_memory.save_message(1, 2, 111, "b")
+        self.agent_memory.close()
+        
+        reloaded = AgentMemory(memory_dir=self.temp_dir)
+        self.assertEqual(reloaded.get_metadata(1)['message_count'], 2)
+        reloaded.save_message(1, 3, 111, "c")
+        self.assertEqual(reloaded.get_metadata(1)['message_count'], 3)
+        self.assertEqual(list(Path(self.temp_dir).glob("*.tmp")), [])
+    
+    def test_interval_flush(self):
+        """При истекшем интервале сброс происходит прямо при записи"""
+        memory = AgentMemory(memory_dir=self.temp_dir, metadata_flush_interval=0)
+        memory.save_message(1, 1, 111, "a")
+        memory.save_message(1, 2, 111, "b")
+        self.assertEqual(self._read_meta_file(1)['message_count'], 2)
+    
+    def test_get_metadata_returns_copy(self):
+        """Изменение результата get_metadata не портит кеш"""
+        self.agent_memory.save_message(1, 1, 111, "a")
+        self.agent_memory.get_metadata(1)['message_count'] = 100
+        self.assertEqual(self.agent_memory.get_metadata(1)['message_count'], 1)
+    
+    def test_clear_drops_cached_metadata(self):
+        """После очистки чат не воскресает при сбросе кеша"""
+        self.agent_memory.save_message(1, 1, 111, "a")
+        self.agent_memory.save_message(1, 2, 111, "b")
+        self.agent_memory.clear_chat(1)
+        self.agent_memory.flush_metadata()
+        self.assertIsNone(self.agent_memory.get_metadata(1))
+        self.assertEqual(self.agent_memory.list_chats(), [])
+
+
+
+class TestAgentMemoryManifest(unittest.TestCase):
+    """Тесты инкрементального манифеста чатов"""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.agent_memory = AgentMemory(memory_dir=self.temp_dir, metadata_flush_interval=3600)
+    
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def test_statistics_from_manifest(self):
+        """После сброса новый экземпляр берет список чатов и итоги из манифеста"""
+        for chat_id in (-100123, 5, 7):
+            self.agent_memory.save_message(chat_id, 1, 111, "a")
+        self.agent_memory.save_message(5, 2, 111, "b")
+        self.agent_memory.close()
+        
+        # Без манифеста этих чатов не было бы: метаданных на диске больше нет
+        for meta_path in Path(self.temp_dir).glob("chat_*_meta.json"):
+            meta_path.unlink()
+        
+        reloaded = AgentMemory(memory_dir=self.temp_dir)
+        stats = reloaded.get_statistics()
+        self.assertEqual(stats['chat_ids'], [-100123, 5, 7])
+        self.assertEqual(stats['total_messages'], 4)
+    
+    def test_recent_chats(self):
+        """Недавно обновленные чаты идут первыми"""
+        base = datetime(2026, 1, 1, 12, 0, 0)
+        for chat_id, minutes in ((1, 5), (2, 30), (3, 10)):
+            self.agent_memory.save_message(chat_id, 1, 111, "a", base + timedelta(minutes=minutes))
+        self.assertEqual(self.agent_memory.recent_chats(2), [2, 3])
+    
+    def test_journal_replay_without_flush(self):
+        """Созданные и очищенные после сброса чаты восстанавливаются из журнала"""
+        self.agent_memory.save_message(1, 1, 111, "a")
+        self.agent_memory.close()
+        self.agent_memory.save_message(2, 1, 111, "b")
+        self.agent_memory.clear_chat(1)
+        # Без close(): имитируем аварийное завершение
+        
+        reloaded = AgentMemory(memory_dir=self.temp_dir)
+        self.assertEqual(reloaded.list_chats(), [2])
+        self.assertEqual(reloaded.get_statistics()['total_messages'], 1)
+    
+    def test_running_totals(self):
+        """Итоги меняются инкрементально при записи и очистке"""
+        self.agent_memory.save_messages(1, [(i, 111, "x", datetime.now()) for i in range(10)])
+        self.agent_memory.save_message(2, 1, 111, "y")
+        self.assertEqual(self.agent_memory.get_statistics()['total_messages'], 11)
+        self.agent_memory.clear_chat(1)
+        self.assertEqual(self.agent_memory.get_statistics()['total_messages'], 1)
+    
+    def test_rebuild_manifest(self):
+        """Манифест перестраивается по файлам, включая чаты без метаданных"""
+        self.agent_memory.save_message(1, 1, 111, "a")
+        self.agent_memory.save_message(1, 2, 111, "b")
+        segments = AgentMemory(memory_dir=self.temp_dir, storage_format="segments")
+        segments.save_message(2, 1, 111, "c")
+        segments.close()
+        self.agent_memory.close()
+        Path(self.temp_dir, "chat_2_meta.json").unlink()
+        Path(self.temp_dir, "manifest.json").write_text("{broken", encoding='utf-8')
+        
+        reloaded = AgentMemory(memory_dir=self.temp_dir)
+        self.assertEqual(reloaded.list_chats(), [1, 2])
+        self.assertEqual(reloaded.get_statistics()['total_messages'], 3)
+        
+        stats = reloaded.rebuild_manifest(workers=2)
+        self.assertEqual(stats['total_chats'], 2)
+        self.assertEqual(stats['total_messages'], 3)
+    
+    def test_repair_manifest_cli(self):
+        """Команда repair-manifest перестраивает манифест"""
+        from src.services.memory_cli import main
+        self.agent_memory.save_message(1, 1, 111, "a")
+        self.agent_memory.close()
+        Path(self.temp_dir, "manifest.json").unlink()
+        
+        self.assertEqual(main(["--memory-dir", self.temp_dir, "repair-manifest", "--workers", "2"]), 0)
+        self.assertTrue(Path(self.temp_dir, "manifest.json").exists())
+
+
+
+class TestAgentMemoryShardedLayout(unittest.TestCase):
+    """Тесты шардированной раскладки директории памяти"""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def test_files_are_sharded(self):
+        """Файлы чата лежат в memory/ab/cd/ по хешу ID"""
+        memory = AgentMemory(memory_dir=self.temp_dir, storage_format="segments", layout="sharded")
+        memory.save_message(-100123, 1, 111, "Привет")
+        
+        log_path = memory._chat_path(-100123, ".log")
+        self.assertTrue(log_path.exists())
+        self.assertEqual(log_path.parent.parent.parent, Path(self.temp_dir))
+        self.assertEqual(len(log_path.parent.name), 2)
+        self.assertEqual(memory.load_chat_history(-100123), [(1, 111, "Привет")])
+        self.assertEqual(list(Path(self.temp_dir).glob("chat_*")), [])
+    
+    def test_lazy_migration_on_access(self):
+        """Чат из плоской раскладки переносится в шард при первом обращении"""
+        flat = AgentMemory(memory_dir=self.temp_dir)
+        flat.save_message(1, 1, 111, "Старое")
+        flat.close()
+        
+        sharded = AgentMemory(memory_dir=self.temp_dir, layout="sharded")
+        self.assertEqual(sharded.load_chat_history(1), [(1, 111, "Старое")])
+        self.assertFalse(Path(self.temp_dir, "chat_1.md").exists())
+        sharded.save_message(1, 2, 111, "Новое")
+        self.assertEqual(sharded.get_metadata(1)['message_count'], 2)
+        self.assertEqual([m[0] for m in sharded.load_chat_history(1)], [1, 2])
+    
+    def test_migrate_layout(self):
+        """Утилита миграции переносит все чаты, манифест остается верным"""
+        flat = AgentMemory(memory_dir=self.temp_dir)
+        for chat_id in range(20):
+            flat.save_message(chat_id, 1, 111, f"msg {chat_id}")
+        flat.close()
+        
+        sharded = AgentMemory(memory_dir=self.temp_dir, layout="sharded")
+        seen = []
+        stats = sharded.migrate_layout(workers=4, progress=lambda done, total: seen.append((done, total)))
+        
+        self.assertEqual(stats['chats'], 20)
+        self.assertEqual(stats['moved_files'], 40)
+        self.assertEqual(seen[-1], (20, 20))
+        self.assertEqual(list(Path(self.temp_dir).glob("chat_*")), [])
+        self.assertEqual(sharded.list_chats(), list(range(20)))
+        self.assertEqual(sharded.load_chat_history(7), [(1, 111, "msg 7")])
+        # Перестроение манифеста находит файлы в шардах
+        self.assertEqual(sharded.rebuild_manifest()['total_chats'], 20)
+    
+    def test_migrate_layout_cli(self):
+        """Команда migrate-layout переносит плоскую директорию"""
+        from src.services.memory_cli import main
+        flat = AgentMemory(memory_dir=self.temp_dir)
+        flat.save_message(5, 1, 111, "a")
+        flat.close()
+        
+        self.assertEqual(main(["--memory-dir", self.temp_dir, "migrate-layout"]), 0)
+        self.assertFalse(Path(self.temp_dir, "chat_5.md").exists())
+    
+    def test_invalid_layout(self):
+        with self.assertRaises(ValueError):
+            AgentMemory(memory_dir=self.temp_dir, layout="nested")
+
+
+class TestAgentMemorySegments(unittest.TestCase):
+    """Тесты режима хранения в append-only сегментах"""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.agent_memory = AgentMemory(memory_dir=self.temp_dir, storage_format="segments")
+    
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def test_save_and_load(self):
+        """Сообщения читаются из сегмента, markdown не пишется"""
+        chat_id = 12345
+        for i in range(1, 6):
+            self.agent_memory.save_message(chat_id, i, 100 + i, f"Сообщение {i}\nс ```кодом```")
+        
+        history = self.agent_memory.load_chat_history(chat_id)
+        self.assertEqual([m[0] for m in history], [1, 2, 3, 4, 5])
+        self.assertEqual(history[0], (1, 101, "Сообщение 1\nс ```кодом```"))
+        self.assertFalse(self.agent_memory._get_chat_file_path(chat_id).exists())
+        self.assertEqual(self.agent_memory.get_metadata(chat_id)['message_count'], 5)
+    
+    def test_tail_limit(self):
+        """Последние N сообщений читаются с хвоста сегмента"""
+        chat_id = 12345
+        for i in range(1, 101):
+            self.agent_memory.save_message(chat_id, i, 1, f"msg {i}")
+        
+        history = self.agent_memory.load_chat_history(chat_id, limit=3)
+        self.assertEqual(history, [(98, 1, "msg 98"), (99, 1, "msg 99"), (100, 1, "msg 100")])
+    
+    def test_markdown_export(self):
+        """Markdown экспортируется из сегмента как представление"""
+        chat_id = 12345
+        timestamp = datetime(2026, 1, 9, 15, 30, 0)
+        self.agent_memory.save_message(chat_id, 1, 111, "Текст с `кавычками`", timestamp)
+        
+        path = self.agent_memory.export_markdown(chat_id)
+        content = path.read_text(encoding='utf-8')
+        self.assertIn("### Сообщение #1", content)
+        self.assertIn("2026-01-09 15:30:00", content)
+        
+        # Экспорт разбирается старым markdown парсером без потерь
+        markdown_memory = AgentMemory(memory_dir=self.temp_dir)
+        self.assertEqual(markdown_memory.load_chat_history(chat_id), [(1, 111, "Текст с `кавычками`")])
+    
+    def test_markdown_export_mode(self):
+        """При markdown_export=True markdown пишется вместе с сегментом"""
+        memory = AgentMemory(memory_dir=self.temp_dir, storage_format="segments", markdown_export=True)
+        memory.save_message(1, 1, 111, "Привет")
+        self.assertTrue(memory._get_chat_file_path(1).exists())
+        self.assertEqual(memory.load_chat_history(1), [(1, 111, "Привет")])
+    
+    def test_legacy_markdown_fallback(self):
+        """Чаты, сохраненные в markdown до переключения, продолжают читаться"""
+        AgentMemory(memory_dir=self.temp_dir).save_message(777, 1, 111, "Старое сообщение")
+        self.assertEqual(self.agent_memory.load_chat_history(777), [(1, 111, "Старое сообщение")])
+    
+    def test_recovery_after_torn_write(self):
+        """Оборванная запись и отставший индекс восстанавливаются при открытии"""
+        chat_id = 12345
+        for i in range(1, 4):
+            self.agent_memory.save_message(chat_id, i, 1, f"msg {i}")
+        log_path = self.agent_memory._chat_path(chat_id, ".log")
+        idx_path = self.agent_memory._chat_path(chat_id, ".idx")
+        
+        # Имитируем сбой: индекс потерял последнюю запись, в лог попал обрывок
+        with open(idx_path, 'r+b') as f:
+            f.truncate(16)
+        with open(log_path, 'ab') as f:
+            f.write(b"\x10\x00")
+        
+        fresh = AgentMemory(memory_dir=self.temp_dir, storage_format="segments")
+        self.assertEqual([m[0] for m in fresh.load_chat_history(chat_id, limit=10)], [1, 2, 3])
+        fresh.save_message(chat_id, 4, 1, "msg 4")
+        self.assertEqual([m[0] for m in fresh.load_chat_history(chat_id, limit=2)], [3, 4])
+    
+    def test_clear_chat(self):
+        """Очистка удаляет сегмент и индекс"""
+        self.agent_memory.save_message(1, 1, 111, "Сообщение")
+        self.agent_memory.clear_chat(1)
+        self.assertFalse(self.agent_memory._chat_path(1, ".log").exists())
+        self.assertFalse(self.agent_memory._chat_path(1, ".idx").exists())
+        self.assertEqual(self.agent_memory.load_chat_history(1), [])
+    
+    def test_save_messages_batch(self):
+        """Пачка сообщений пишется одной записью и учитывается в метаданных"""
+        timestamp = datetime(2026, 1, 9, 15, 30, 0)
+        self.agent_memory.save_messages(1, [(i, 111, f"msg {i}", timestamp) for i in range(1, 11)])
+        
+        self.assertEqual(len(self.agent_memory.load_chat_history(1)), 10)
+        metadata = self.agent_memory.get_metadata(1)
+        self.assertEqual(metadata['message_count'], 10)
+        self.assertEqual(metadata['last_message_id'], 10)
+    
+    def test_open_handles_are_bounded(self):
+        """LRU открытых файлов не разрастается сверх лимита"""
+        memory = AgentMemory(memory_dir=self.temp_dir, storage_format="segments", max_open_files=4)
+        for chat_id in range(10):
+            memory.save_message(chat_id, 1, 111, "msg")
+        self.assertLessEqual(len(memory._handles), 4)
+        self.assertEqual(memory.load_chat_history(0), [(1, 111, "msg")])
+        memory.close()
+        self.assertEqual(len(memory._handles), 0)
+
+    def test_invalid_format(self):
+        """Неизвестный формат хранения отклоняется"""
+        with self.assertRaises(ValueError):
+            AgentMemory(memory_dir=self.temp_dir, storage_format="xml")
+
+
+class TestAgentMemorySegmentRotation(unittest.TestCase):
+    """Тесты ротации горячего сегмента в сжатые холодные"""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.agent_memory = AgentMemory(
+            memory_dir=self.temp_dir, storage_format="segments",
+            segment_max_bytes=2048, segment_tail_keep=10,
+        )
+    
+    def tearDown(self):
+        self.agent_memory.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def _fill(self, chat_id, count):
+        for i in range(1, count + 1):
+            self.agent_memory.save_message(chat_id, i, 111, f"Сообщение номер {i} с достаточно длинным текстом")
+    
+    def test_rotation_by_size(self):
+        """При превышении размера старые сообщения уходят в холодный сегмент"""
+        self._fill(1, 100)
+        
+        segments = self.agent_memory.get_metadata(1)["segments"]
+        self.assertGreaterEqual(len(segments), 1)
+        for segment in segments:
+            self.assertTrue(self.agent_memory._chat_path(1, segment["file"][len("chat_1"):]).exists())
+        self.assertLess(self.agent_memory._get_segment_log(1).size(), 2048)
+        
+        history = self.agent_memory.load_chat_history(1)
+        self.assertEqual([m[0] for m in history], list(range(1, 101)))
+        self.assertEqual(history[0][2], "Сообщение номер 1 с достаточно длинным текстом")
+    
+    def test_tail_read_skips_cold_segments(self):
+        """Чтение хвоста не открывает холодные сегменты"""
+        self._fill(1, 100)
+        
+        with patch("src.services.agent_memory.iter_sealed_segment") as iter_sealed:
+            history = self.agent_memory.load_chat_history(1, limit=5)
+        iter_sealed.assert_not_called()
+        self.assertEqual([m[0] for m in history], [96, 97, 98, 99, 100])
+        
+        # Лимит больше горячего сегмента добирается из холодных
+        history = self.agent_memory.load_chat_history(1, limit=40)
+        self.assertEqual([m[0] for m in history], list(range(61, 101)))
+    
+    def test_rotation_by_age(self):
+        """Старый горячий сегмент запечатывается даже без превышения размера"""
+        memory = AgentMemory(
+            memory_dir=self.temp_dir, storage_format="segments",
+            segment_max_bytes=0, segment_max_age=3600, segment_tail_keep=2,
+        )
+        old = datetime(2020, 1, 1)
+        memory.save_messages(5, [(i, 111, f"msg {i}", old) for i in range(1, 6)])
+        
+        self.assertEqual(memory.get_metadata(5)["segments"][0]["count"], 3)
+        self.assertEqual(memory._get_segment_log(5).count(), 2)
+        self.assertEqual([m[0] for m in memory.load_chat_history(5)], [1, 2, 3, 4, 5])
+        memory.close()
+    
+    def test_duplicate_messages_stored_once(self):
+        """Одинаковые тексты в холодном сегменте хранятся один раз"""
+        spam = "Одинаковое сообщение, которое пересылают в чат снова и снова"
+        for i in range(1, 101):
+            self.agent_memory.save_message(1, i, 111, spam)
+        
+        segments = self.agent_memory.get_metadata(1)["segments"]
+        self.assertGreater(sum(segment["deduplicated"] for segment in segments), 0)
+        self.assertEqual([m[2] for m in self.agent_memory.load_chat_history(1)], [spam] * 100)
+    
+    def test_reopen_and_export(self):
+        """После перезапуска холодные сегменты читаются и попадают в экспорт"""
+        self._fill(1, 100)
+        self.agent_memory.close()
+        
+        fresh = AgentMemory(memory_dir=self.temp_dir, storage_format="segments", segment_max_bytes=2048, segment_tail_keep=10)
+        self.assertEqual(len(fresh.load_chat_history(1)), 100)
+        content = fresh.export_markdown(1).read_text(encoding='utf-8')
+        self.assertIn("### Сообщение #1\n", content)
+        self.assertIn("### Сообщение #100\n", content)
+        fresh.close()
+    
+    def test_interrupted_rotation_recovered(self):
+        """Холодный сегмент, не попавший в метаданные, подхватывается при открытии"""
+        self._fill(1, 100)
+        self.agent_memory.flush_metadata()
+        meta_path = self.agent_memory._get_metadata_file_path(1)
+        metadata = json.loads(meta_path.read_text(encoding='utf-8'))
+        
+        # Имитируем сбой после записи холодного сегмента, но до обновления метаданных
+        lost = metadata["segments"].pop()
+        metadata["next_segment_seq"] = lost["seq"]
+        meta_path.write_text(json.dumps(metadata), encoding='utf-8')
+        
+        fresh = AgentMemory(memory_dir=self.temp_dir, storage_format="segments", segment_max_bytes=2048, segment_tail_keep=10)
+        self.assertEqual([m[0] for m in fresh.load_chat_history(1)], list(range(1, 101)))
+        self.assertEqual(len(fresh.get_metadata(1)["segments"]), len(metadata["segments"]) + 1)
+        fresh.close()
+    
+    def test_clear_chat_removes_cold_segments(self):
+        """Очистка чата удаляет и холодные сегменты"""
+        self._fill(1, 100)
+        files = [segment["file"] for segment in self.agent_memory.get_metadata(1)["segments"]]
+        
+        self.agent_memory.clear_chat(1)
+        for name in files:
+            self.assertFalse((Path(self.temp_dir) / name).exists())
+        self.assertEqual(self.agent_memory.load_chat_history(1), [])
+    
+    def test_sharded_layout_moves_cold_segments(self):
+        """Онлайн-миграция в шарды переносит и холодные сегменты"""
+        self._fill(1, 100)
+        self.agent_memory.close()
+        
+        sharded = AgentMemory(
+            memory_dir=self.temp_dir, storage_format="segments", layout="sharded",
+            segment_max_bytes=2048, segment_tail_keep=10,
+        )
+        self.assertEqual(len(sharded.load_chat_history(1)), 100)
+        self.assertEqual(list(Path(self.temp_dir).glob("chat_1.*")), [])
+        sharded.close()
+
+
+
+class TestAgentMemoryRangeQueries(unittest.TestCase):
+    """Тесты выборки по периоду и по ID сообщения через разреженный индекс"""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.start = datetime(2026, 3, 1)
+    
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def _memory(self, storage_format, **kwargs):
+        memory = AgentMemory(memory_dir=tempfile.mkdtemp(dir=self.temp_dir), storage_format=storage_format, **kwargs)
+        # По сообщению в минуту, текст достаточно длинный, чтобы индекс получил много точек входа
+        for batch_start in range(1, 3001, 100):
+            memory.save_messages(1, [
+                (i, 111, f"Сообщение {i} " + "x" * 200, self.start + timedelta(minutes=i))
+                for i in range(batch_start, batch_start + 100)
+            ])
+        return memory
+    
+    def test_range_and_cursor(self):
+        """Период и курсор по ID работают во всех форматах, в том числе с холодными сегментами"""
+        variants = [
+            ("markdown", {}),
+            ("segments", {}),
+            ("segments", {"segment_max_bytes": 64 * 1024, "segment_tail_keep": 50}),
+        ]
+        for storage_format, kwargs in variants:
+            with self.subTest(storage_format=storage_format, **kwargs):
+                memory = self._memory(storage_format, **kwargs)
+                
+                day = list(memory.load_chat_range(1, self.start + timedelta(minutes=1500), self.start + timedelta(minutes=1510)))
+                self.assertEqual([m[0] for m in day], list(range(1500, 1511)))
+                self.assertEqual(day[0][2], "Сообщение 1500 " + "x" * 200)
+                
+                after = memory.iter_messages(1, after_message_id=2990)
+                self.assertEqual([m[0] for m in after], list(range(2991, 3001)))
+                self.assertEqual(len(list(memory.iter_messages(1))), 3000)
+                self.assertEqual(list(memory.load_chat_range(2, self.start, self.start + timedelta(days=1))), [])
+                memory.close()
+    
+    def test_seek_skips_beginning(self):
+        """Чтение начинается с точки индекса, а не с начала файла"""
+        memory = self._memory("segments")
+        segment_log = memory._get_segment_log(1)
+        self.assertGreater(len(segment_log.sparse.entries()), 5)
+        
+        offset = segment_log.sparse.floor(1, 2900)
+        self.assertGreater(offset, segment_log.size() // 2)
+        with open(segment_log.log_path, "rb") as log_file:
+            first = next(segment_log.iter_file(log_file, offset))
+        self.assertLess(first[0], 2900)
+        self.assertGreater(first[0], 2500)
+        memory.close()
+    
+    def test_sparse_index_rebuilt_when_missing(self):
+        """Индекс строится заново для файлов, записанных без него, и после очистки по лимитам"""
+        memory = self._memory("markdown")
+        memory.close()
+        sparse_path = Path(memory._chat_path(1, ".md.sparse"))
+        sparse_path.unlink()
+        
+        reopened = AgentMemory(memory_dir=str(memory.memory_dir))
+        self.assertEqual([m[0] for m in reopened.iter_messages(1, after_message_id=2998)], [2999, 3000])
+        self.assertTrue(sparse_path.exists())
+        
+        reopened.apply_retention(1, max_messages=1000)
+        self.assertEqual([m[0] for m in reopened.iter_messages(1, after_message_id=1500)], list(range(2001, 3001)))
+        reopened.close()
+    
+    def test_rotation_during_iteration(self):
+        """Ротация посреди чтения не дает ни пропусков, ни повторов"""
+        memory = self._memory("segments", segment_max_bytes=64 * 1024, segment_tail_keep=50)
+        iterator = memory.iter_messages(1, after_message_id=2950)
+        self.assertEqual(next(iterator)[0], 2951)
+        for i in range(3001, 3400):
+            memory.save_message(1, i, 111, "y" * 300, self.start + timedelta(minutes=i))
+        ids = [m[0] for m in iterator]
+        self.assertEqual(ids, list(range(2952, 2952 + len(ids))))
+        self.assertGreaterEqual(ids[-1], 3000)
+        memory.close()
+
+
 if __name__ == '__main__':
     unittest.main()
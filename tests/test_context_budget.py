@@ -0,0 +1,83 @@
+import unittest
+
+from src.services.context_budget import ContextAssembler, compress_text, compressed_message, estimate_tokens, truncate_tokens
+
+
+class TestCompressText(unittest.TestCase):
+    """Тесты сжатия текста сообщений"""
+
+    def test_collapses_repeated_lines(self):
+        self.assertEqual(compress_text("ERROR: timeout\nERROR: timeout\nERROR: timeout\nok"), "ERROR: timeout ×3\nok")
+        self.assertEqual(compress_text("а\nб\nа"), "а\nб\nа")
+
+    def test_shortens_urls(self):
+        url = "https://example.com/very/long/path/to/some/page?with=query&and=more"
+        self.assertEqual(compress_text(f"смотри {url} тут"), "смотри example.com/… тут")
+        self.assertEqual(compress_text("https://ya.ru/a"), "https://ya.ru/a")
+
+    def test_shortens_code_blocks(self):
+        code = "```\n" + "\n".join(f"line {i}" for i in range(10)) + "\n```"
+        compressed = compress_text(f"вот код:\n{code}")
+        self.assertIn("line 2", compressed)
+        self.assertNotIn("line 3", compressed)
+        self.assertIn("еще 7 строк кода", compressed)
+        self.assertEqual(compress_text("```\nx = 1\n```"), "```\nx = 1\n```")
+
+    def test_truncation_fits_estimate_with_ellipsis(self):
+        """Обрезанный текст вместе с «…» укладывается в лимит по той же оценке"""
+        for text in ("a" * 1000, "я" * 1000, "🙂" * 300):
+            for max_tokens in (1, 2, 7, 50):
+                truncated = truncate_tokens(text, max_tokens)
+                self.assertTrue(truncated.endswith("…"))
+                self.assertLessEqual(estimate_tokens(truncated), max_tokens)
+        self.assertEqual(truncate_tokens("коротко", 50), "коротко")
+
+    def test_estimates_are_cached(self):
+        text = "лог\n" * 500
+        compressed_message.cache_clear()
+        self.assertEqual(compressed_message(text), ("лог ×500\n", estimate_tokens("лог ×500\n")))
+        compressed_message(text)
+        self.assertEqual(compressed_message.cache_info().hits, 1)
+
+
+class TestContextAssembler(unittest.TestCase):
+    """Тесты сборки контекста в пределах бюджета токенов"""
+
+    def test_unlimited_budget_keeps_everything(self):
+        assembler = ContextAssembler(0)
+        recent = [(1, 10, "первое"), (2, 11, "второе")]
+        self.assertEqual(assembler.assemble(recent, 2, [(0, 12, "старое")]), [
+            "(раньше) User 12: старое", "User 10: первое", "User 11: второе",
+        ])
+        self.assertEqual(assembler.dropped_messages, 0)
+
+    def test_budget_keeps_newest_and_trigger(self):
+        """Триггер остается, даже если он самый старый; остальные — от свежих к старым"""
+        assembler = ContextAssembler(100)
+        recent = [(1, 1, "триггер")] + [(i, 2, "х" * 60) for i in range(2, 10)]
+        context = assembler.assemble(recent, 1, [(0, 3, "старое")])
+
+        self.assertEqual(context[0], "User 1: триггер")
+        # Сообщение больше четверти бюджета (25 токенов) обрезается вместе с «…» до 25 токенов
+        self.assertEqual(context[-1], "User 2: " + "х" * 48 + "…")
+        self.assertLess(len(context), len(recent))
+        self.assertNotIn("(раньше) User 3: старое", context)
+        stats = assembler.get_statistics()
+        self.assertLessEqual(stats["context_tokens"]["max"], 100)
+        self.assertGreater(stats["raw_tokens"]["max"], 100)
+        self.assertEqual(stats["dropped_messages"], len(recent) + 1 - len(context))
+
+    def test_long_messages_are_truncated(self):
+        """Один вставленный лог не съедает весь бюджет"""
+        assembler = ContextAssembler(200)
+        log = "\n".join(f"{i}: запрос обработан" for i in range(1000))
+        context = assembler.assemble([(1, 1, log), (2, 2, "и что это было?")], 2)
+
+        self.assertEqual(len(context), 2)
+        self.assertTrue(context[0].endswith("…"))
+        self.assertLessEqual(estimate_tokens(context[0]), 200 // 4 + 6)
+        self.assertEqual(assembler.get_statistics()["context_tokens"]["buckets"]["<=128"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,6 +15,7 @@ from src.bot.handlers import (
     reaction_handler,
     MEME_TRIGGERS
 )
+from src.services.llm import MemeBrain
 from aiogram.types import Message, Chat, User
 from src.services.history import HistoryManager
 
@@ -84,14 +85,14 @@ class TestE2EUserJourney:
         assert "Как пользоваться ботом" in help_msg.answer.call_args[0][0]
         
         # Шаг 3-4: Отправка сообщений и генерация мемов
-        with patch('src.bot.handlers.history_manager') as mock_hist, \
-             patch('src.bot.handlers.meme_brain') as mock_brain, \
+        with patch('src.bot.handlers.history_manager', spec=True) as mock_hist, \
+             patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
              patch('src.bot.handlers.image_searcher') as mock_search, \
              patch('src.bot.handlers.meme_generator') as mock_gen, \
              patch('src.bot.handlers.FSInputFile'):
             
             # Настройка моков
-            mock_hist.get_context.return_value = ["User: Привет, как дела?"]
+            mock_hist.get_context_async.return_value = ["User: Привет, как дела?"]
             mock_brain.generate_meme_idea.return_value = {
                 "is_memable": True,
                 "top_text": "КОГДА НАПИСАЛ В ЧАТ",
@@ -131,8 +132,8 @@ class TestE2EUserJourney:
         """
         chat_id = 99999
         
-        with patch('src.bot.handlers.history_manager') as mock_hist, \
-             patch('src.bot.handlers.meme_brain') as mock_brain, \
+        with patch('src.bot.handlers.history_manager', spec=True) as mock_hist, \
+             patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
              patch('src.bot.handlers.image_searcher') as mock_search, \
              patch('src.bot.handlers.meme_generator') as mock_gen, \
              patch('src.bot.handlers.FSInputFile'):
@@ -153,14 +154,14 @@ class TestE2EUserJourney:
                     chat_id=chat_id,
                     user_id=user_id,
                     chat_type='group',
-                    message_id=len(mock_hist.add_message.call_args_list) if mock_hist.add_message.called else 0
+                    message_id=len(mock_hist.add_message_async.call_args_list) if mock_hist.add_message_async.called else 0
                 )
                 await message_handler(msg)
                 # В группе мемы не генерируются автоматически
-                mock_hist.add_message.assert_called()
+                mock_hist.add_message_async.assert_awaited()
             
             # Шаг 2: Реакция на последнее сообщение
-            mock_hist.get_context.return_value = [
+            mock_hist.get_context_async.return_value = [
                 f"User {uid}: {txt}" for uid, txt in conversation
             ]
             mock_hist.get_message_text.return_value = conversation[-1][1]
@@ -220,7 +221,7 @@ class TestE2EConversationFlow:
         
         # Теперь симулируем реакцию и генерацию мема
         with patch('src.bot.handlers.history_manager', history), \
-             patch('src.bot.handlers.meme_brain') as mock_brain, \
+             patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
              patch('src.bot.handlers.image_searcher') as mock_search, \
              patch('src.bot.handlers.meme_generator') as mock_gen, \
              patch('src.bot.handlers.FSInputFile'):
@@ -254,13 +255,13 @@ class TestE2EErrorRecovery:
         chat_id = 55555
         user_id = 11111
         
-        with patch('src.bot.handlers.history_manager') as mock_hist, \
-             patch('src.bot.handlers.meme_brain') as mock_brain, \
+        with patch('src.bot.handlers.history_manager', spec=True) as mock_hist, \
+             patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
              patch('src.bot.handlers.image_searcher') as mock_search, \
              patch('src.bot.handlers.meme_generator') as mock_gen, \
              patch('src.bot.handlers.FSInputFile'):
             
-            mock_hist.get_context.return_value = ["User: Тестовое сообщение"]
+            mock_hist.get_context_async.return_value = ["User: Тестовое сообщение"]
             
             # Сценарий 1: LLM падает, потом восстанавливается
             mock_brain.generate_meme_idea.side_effect = [
@@ -294,13 +295,13 @@ class TestE2EMultiUserScenarios:
         """
         Тест одновременных запросов от разных пользователей
         """
-        with patch('src.bot.handlers.history_manager') as mock_hist, \
-             patch('src.bot.handlers.meme_brain') as mock_brain, \
+        with patch('src.bot.handlers.history_manager', spec=True) as mock_hist, \
+             patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
              patch('src.bot.handlers.image_searcher') as mock_search, \
              patch('src.bot.handlers.meme_generator') as mock_gen, \
              patch('src.bot.handlers.FSInputFile'):
             
-            mock_hist.get_context.return_value = ["User: Контекст"]
+            mock_hist.get_context_async.return_value = ["User: Контекст"]
             mock_brain.generate_meme_idea.return_value = {
                 "is_memable": True,
                 "top_text": "TOP",
@@ -379,13 +380,13 @@ class TestE2EAllEmojiWorkflow:
         """
         chat_id = 88888
         
-        with patch('src.bot.handlers.history_manager') as mock_hist, \
-             patch('src.bot.handlers.meme_brain') as mock_brain, \
+        with patch('src.bot.handlers.history_manager', spec=True) as mock_hist, \
+             patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
              patch('src.bot.handlers.image_searcher') as mock_search, \
              patch('src.bot.handlers.meme_generator') as mock_gen, \
              patch('src.bot.handlers.FSInputFile'):
             
-            mock_hist.get_context.return_value = ["User: Контекст"]
+            mock_hist.get_context_async.return_value = ["User: Контекст"]
             mock_hist.get_message_text.return_value = "Сообщение"
             mock_search.search_template.return_value = "http://img.jpg"
             mock_gen.create_meme.return_value = "output.jpg"
@@ -455,7 +456,7 @@ class TestE2ERealWorldScenarios:
         
         # Генерируем мем на одно из сообщений спора
         with patch('src.bot.handlers.history_manager', history), \
-             patch('src.bot.handlers.meme_brain') as mock_brain, \
+             patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
              patch('src.bot.handlers.image_searcher') as mock_search, \
              patch('src.bot.handlers.meme_generator') as mock_gen, \
              patch('src.bot.handlers.FSInputFile'):
@@ -489,15 +490,15 @@ class TestE2ERealWorldScenarios:
             (4, "Давай отметим!")
         ]
         
-        with patch('src.bot.handlers.history_manager') as mock_hist, \
-             patch('src.bot.handlers.meme_brain') as mock_brain, \
+        with patch('src.bot.handlers.history_manager', spec=True) as mock_hist, \
+             patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
              patch('src.bot.handlers.image_searcher') as mock_search, \
              patch('src.bot.handlers.meme_generator') as mock_gen, \
              patch('src.bot.handlers.FSInputFile'):
             
             # Формируем контекст празднования
             context = [f"User {uid}: {txt}" for uid, txt in celebration_messages]
-            mock_hist.get_context.return_value = context
+            mock_hist.get_context_async.return_value = context
             mock_hist.get_message_text.return_value = celebration_messages[0][1]
             
             mock_brain.generate_meme_idea.return_value = {
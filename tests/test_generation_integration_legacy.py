@@ -29,7 +29,7 @@ async def test_full_pipeline_mock():
     
     # 1. LLM Mock: Получение идеи
     meme_brain = MemeBrain()
-    meme_idea = meme_brain.generate_meme_idea(MOCK_CONTEXT, MOCK_TRIGGER_TEXT)
+    meme_idea = await meme_brain.generate_meme_idea(MOCK_CONTEXT, MOCK_TRIGGER_TEXT)
     
     if not meme_idea:
         print("Тест LLM: Провал. Идея не сгенерирована.")
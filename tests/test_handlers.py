@@ -1,6 +1,8 @@
 import pytest
+import threading
 from unittest.mock import patch, AsyncMock
 from src.bot.handlers import command_start_handler, reaction_handler
+from src.services.llm import MemeBrain
 from aiogram.types import Message, Chat, User, MessageReactionUpdated
 
 # Helper to create mock messages
@@ -36,14 +38,14 @@ async def test_reaction_handler_success():
     reaction.bot.send_message = AsyncMock()
 
     # Mock dependencies
-    with patch('src.bot.handlers.history_manager') as mock_hist, \
-         patch('src.bot.handlers.meme_brain') as mock_brain, \
+    with patch('src.bot.handlers.history_manager', spec=True) as mock_hist, \
+         patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
          patch('src.bot.handlers.image_searcher') as mock_search, \
          patch('src.bot.handlers.meme_generator') as mock_gen, \
          patch('src.bot.handlers.FSInputFile') as mock_fs:
 
         # Setup successful chain
-        mock_hist.get_context.return_value = ["User: Context"]
+        mock_hist.get_context_async.return_value = ["User: Context"]
         mock_hist.get_message_text.return_value = "Trigger Message"
         mock_brain.generate_meme_idea.return_value = {
             "top_text": "T", "bottom_text": "B", "search_query": "Q", "is_memable": True
@@ -57,15 +59,49 @@ async def test_reaction_handler_success():
 
 @pytest.mark.asyncio
 async def test_reaction_handler_no_history():
+    """Сообщения нет ни в буфере, ни в памяти — бот объясняет, почему не может сделать мем"""
     reaction = AsyncMock()
     reaction.chat.id = 123
     reaction.message_id = 100
     reaction.new_reaction = [AsyncMock(emoji="🔥")]
 
-    with patch('src.bot.handlers.history_manager') as mock_hist:
-        mock_hist.get_context.return_value = [] # Empty context
+    with patch('src.bot.handlers.history_manager', spec=True) as mock_hist, \
+         patch('src.bot.handlers.generate_and_send_meme', new=AsyncMock()) as mock_generate:
+        mock_hist.get_chat_async.return_value = None
+        mock_hist.get_deep_context.return_value = ("", [])
 
         await reaction_handler(reaction)
 
-        # Should just return without sending anything
+        mock_generate.assert_not_called()
+        mock_hist.get_context_async.assert_not_awaited()
+        assert "не вижу" in reaction.bot.send_message.call_args.args[1]
+
+@pytest.mark.asyncio
+async def test_reaction_handler_deep_history():
+    """Реакция на сообщение, вышедшее из буфера, берет окно из агентской памяти"""
+    reaction = AsyncMock()
+    reaction.chat.id = 123
+    reaction.message_id = 5
+    reaction.new_reaction = [AsyncMock(emoji="🔥")]
+
+    with patch('src.bot.handlers.history_manager', spec=True) as mock_hist, \
+         patch('src.bot.handlers.generate_and_send_meme', new=AsyncMock()) as mock_generate:
+        mock_hist.get_context_async.return_value = ["User 1: Свежее"]
+        mock_hist.get_message_text.return_value = ""
+        deep_threads = []
+
+        def deep_context(chat_id, message_id):
+            deep_threads.append(threading.current_thread())
+            return "Старое", ["User 1: До", "User 1: Старое"]
+        mock_hist.get_deep_context.side_effect = deep_context
+
+        await reaction_handler(reaction)
+
+        mock_hist.get_deep_context.assert_called_once_with(123, 5)
+        # Текст ищется в буфере до сборки контекста, а чтение памяти идет не в цикле событий
+        mock_hist.get_context_async.assert_not_awaited()
+        assert deep_threads[0] is not threading.main_thread()
+        kwargs = mock_generate.call_args.kwargs
+        assert kwargs["triggered_text"] == "Старое"
+        assert kwargs["context_messages"] == ["User 1: До", "User 1: Старое"]
         reaction.bot.send_message.assert_not_called()
@@ -1,10 +1,14 @@
+import gc
 import pytest
+import asyncio
 from unittest.mock import patch, AsyncMock, MagicMock
 from src.bot.handlers import (
     command_help_handler,
     message_handler,
-    generate_and_send_meme
+    generate_and_send_meme,
+    meme_jobs
 )
+from src.services.llm import MemeBrain
 from aiogram.types import Message, Chat, User
 
 
@@ -44,13 +48,13 @@ async def test_message_handler_private_chat():
     """Test message handler in private chat triggers meme generation"""
     msg = create_message(text="Test message", chat_type='private')
     
-    with patch('src.bot.handlers.history_manager') as mock_hist, \
-         patch('src.bot.handlers.meme_brain') as mock_brain, \
+    with patch('src.bot.handlers.history_manager', spec=True) as mock_hist, \
+         patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
          patch('src.bot.handlers.image_searcher') as mock_search, \
          patch('src.bot.handlers.meme_generator') as mock_gen, \
          patch('src.bot.handlers.FSInputFile'):
         
-        mock_hist.get_context.return_value = ["User: Test message"]
+        mock_hist.get_context_async.return_value = ["User: Test message"]
         mock_brain.generate_meme_idea.return_value = {
             "is_memable": True,
             "top_text": "TOP",
@@ -63,7 +67,7 @@ async def test_message_handler_private_chat():
         await message_handler(msg)
         
         # Should add to history
-        mock_hist.add_message.assert_called_once_with(msg)
+        mock_hist.add_message_async.assert_awaited_once_with(msg)
         # Should send photo in private chat
         msg.bot.send_photo.assert_called_once()
 
@@ -73,11 +77,11 @@ async def test_message_handler_group_chat():
     """Test message handler in group chat only saves to history"""
     msg = create_message(text="Group message", chat_type='group')
     
-    with patch('src.bot.handlers.history_manager') as mock_hist:
+    with patch('src.bot.handlers.history_manager', spec=True) as mock_hist:
         await message_handler(msg)
         
         # Should add to history
-        mock_hist.add_message.assert_called_once_with(msg)
+        mock_hist.add_message_async.assert_awaited_once_with(msg)
         # Should NOT send photo in group chat
         msg.bot.send_photo.assert_not_called()
 
@@ -87,11 +91,11 @@ async def test_message_handler_command_ignored():
     """Test that commands starting with / are ignored in private chat"""
     msg = create_message(text="/command", chat_type='private')
     
-    with patch('src.bot.handlers.history_manager') as mock_hist:
+    with patch('src.bot.handlers.history_manager', spec=True) as mock_hist:
         await message_handler(msg)
         
         # Should add to history
-        mock_hist.add_message.assert_called_once()
+        mock_hist.add_message_async.assert_awaited_once()
         # Should NOT generate meme for commands
         msg.bot.send_photo.assert_not_called()
 
@@ -101,7 +105,7 @@ async def test_generate_and_send_meme_llm_failure():
     """Test generate_and_send_meme when LLM returns None"""
     msg = create_message()
     
-    with patch('src.bot.handlers.meme_brain') as mock_brain:
+    with patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain:
         mock_brain.generate_meme_idea.return_value = None
         
         await generate_and_send_meme(
@@ -122,7 +126,7 @@ async def test_generate_and_send_meme_not_memable():
     """Test generate_and_send_meme when LLM says not memable"""
     msg = create_message()
     
-    with patch('src.bot.handlers.meme_brain') as mock_brain:
+    with patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain:
         mock_brain.generate_meme_idea.return_value = {
             "is_memable": False,
             "top_text": "",
@@ -148,7 +152,7 @@ async def test_generate_and_send_meme_search_failure():
     """Test generate_and_send_meme when search returns no results"""
     msg = create_message()
     
-    with patch('src.bot.handlers.meme_brain') as mock_brain, \
+    with patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
          patch('src.bot.handlers.image_searcher') as mock_search:
         
         mock_brain.generate_meme_idea.return_value = {
@@ -177,7 +181,7 @@ async def test_generate_and_send_meme_image_gen_failure():
     """Test generate_and_send_meme when image generation fails"""
     msg = create_message()
     
-    with patch('src.bot.handlers.meme_brain') as mock_brain, \
+    with patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
          patch('src.bot.handlers.image_searcher') as mock_search, \
          patch('src.bot.handlers.meme_generator') as mock_gen:
         
@@ -201,3 +205,101 @@ async def test_generate_and_send_meme_image_gen_failure():
         # Should send error message
         msg.bot.send_message.assert_called_once()
         assert "Не удалось создать картинку" in msg.bot.send_message.call_args[0][1]
+
+
+@pytest.mark.asyncio
+async def test_generate_and_send_meme_coalesces_duplicate_triggers():
+    """Одновременные одинаковые триггеры дают один мем, другой эмодзи — отдельный"""
+    msg = create_message()
+    llm_started = asyncio.Event()
+    release = asyncio.Event()
+
+    async def slow_idea(*args, **kwargs):
+        llm_started.set()
+        await release.wait()
+        return {"is_memable": True, "top_text": "TOP", "bottom_text": "BOTTOM", "search_query": "query"}
+
+    with patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
+         patch('src.bot.handlers.image_searcher') as mock_search, \
+         patch('src.bot.handlers.meme_generator') as mock_gen, \
+         patch('src.bot.handlers.FSInputFile'):
+        mock_brain.generate_meme_idea.side_effect = slow_idea
+        mock_search.search_template.return_value = "http://img.jpg"
+        mock_gen.create_meme.return_value = "output.jpg"
+        coalesced = meme_jobs.coalesced
+
+        def trigger(emoji):
+            return generate_and_send_meme(
+                chat_id=123, triggered_text="Пост", context_messages=["User: Пост"],
+                reply_to_message_id=7, bot_instance=msg.bot, trigger_emoji=emoji,
+            )
+
+        first = asyncio.create_task(trigger("🔥"))
+        await llm_started.wait()
+        duplicates = [asyncio.create_task(trigger("🔥")) for _ in range(9)]
+        other = asyncio.create_task(trigger("😁"))
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(first, other, *duplicates)
+
+        assert mock_brain.generate_meme_idea.call_count == 2
+        assert msg.bot.send_photo.call_count == 2
+        assert meme_jobs.coalesced - coalesced == 9
+        assert meme_jobs.get_statistics()["in_flight"] == 0
+
+
+async def run_with_early_search(msg, early_query, search_side_effect):
+    """Генерация, в которой LLM объявляет early_query до итоговой идеи с запросом "кот" """
+    async def streamed_idea(*args, on_search_query=None):
+        on_search_query(early_query)
+        await asyncio.sleep(0)
+        return {"is_memable": True, "top_text": "TOP", "bottom_text": "BOTTOM", "search_query": "кот"}
+
+    with patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
+         patch('src.bot.handlers.image_searcher') as mock_search, \
+         patch('src.bot.handlers.meme_generator') as mock_gen, \
+         patch('src.bot.handlers.FSInputFile'):
+        mock_brain.generate_meme_idea.side_effect = streamed_idea
+        mock_search.search_template.side_effect = search_side_effect
+        mock_gen.create_meme.return_value = "output.jpg"
+
+        await generate_and_send_meme(
+            chat_id=123, triggered_text="Пост", context_messages=["User: Пост"],
+            reply_to_message_id=8, bot_instance=msg.bot, trigger_emoji="🔥",
+        )
+        return mock_search, mock_gen
+
+
+@pytest.mark.asyncio
+async def test_early_search_is_reused():
+    """Поиск, начатый по search_query из потока, используется и скачивает шаблон заранее"""
+    msg = create_message()
+    mock_search, mock_gen = await run_with_early_search(msg, "кот", lambda query: "http://cat.jpg")
+
+    mock_search.search_template.assert_called_once_with("кот meme template")
+    mock_gen.prefetch_template.assert_called_once_with("http://cat.jpg")
+    assert mock_gen.create_meme.call_args.kwargs["image_url"] == "http://cat.jpg"
+    msg.bot.send_photo.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_early_search_for_other_query_is_discarded():
+    """Если итоговый запрос другой, ищется он, а ошибка раннего поиска забирается без предупреждения asyncio"""
+    msg = create_message()
+    loop = asyncio.get_running_loop()
+    unhandled = []
+    loop.set_exception_handler(lambda loop, context: unhandled.append(context))
+
+    def search(query):
+        if query.startswith("собака"):
+            raise RuntimeError("поиск упал")
+        return "http://cat.jpg"
+
+    mock_search, mock_gen = await run_with_early_search(msg, "собака", search)
+    await asyncio.sleep(0.05)
+    gc.collect()
+
+    assert [c.args[0] for c in mock_search.search_template.call_args_list] == ["собака meme template", "кот meme template"]
+    assert mock_gen.create_meme.call_args.kwargs["image_url"] == "http://cat.jpg"
+    msg.bot.send_photo.assert_called_once()
+    assert unhandled == []
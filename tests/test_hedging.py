@@ -0,0 +1,144 @@
+import asyncio
+import pytest
+
+from src.services.hedging import Hedger, LatencyTracker
+
+
+def make_hedger(**kwargs):
+    """Хеджер без замеров ждет max_delay, поэтому порог задается явно"""
+    return Hedger(min_samples=1000, max_delay=0.01, **kwargs)
+
+
+def test_latency_quantile():
+    tracker = LatencyTracker(window=10)
+    assert tracker.quantile(0.9) is None
+    for seconds in range(1, 21):
+        tracker.record(seconds)
+    # В окне только 10 последних замеров: 11..20
+    assert len(tracker) == 10
+    assert tracker.quantile(0.9) == 20
+    assert tracker.quantile(0.5) == 16
+
+
+def test_delay_adapts_to_primary_latency():
+    hedger = Hedger(quantile=0.9, min_samples=10, min_delay=0.5, max_delay=10.0)
+    assert hedger.delay() == 10.0  # замеров мало
+
+    for _ in range(9):
+        hedger.latencies.record(1.0)
+    hedger.latencies.record(3.0)
+    assert hedger.delay() == 3.0
+
+    for _ in range(100):
+        hedger.latencies.record(0.1)
+    assert hedger.delay() == 0.5  # не ниже min_delay
+
+
+@pytest.mark.asyncio
+async def test_fast_primary_is_not_hedged():
+    hedger = Hedger(min_samples=1000, max_delay=10.0)
+    fallback_calls = []
+
+    async def fallback():
+        fallback_calls.append(1)
+
+    async def primary():
+        return "primary"
+
+    assert await hedger.run(primary, fallback) == "primary"
+    assert fallback_calls == []
+    stats = hedger.get_statistics()
+    assert (stats["requests"], stats["hedged"], stats["samples"]) == (1, 0, 1)
+
+
+@pytest.mark.asyncio
+async def test_slow_primary_loses_to_fallback_and_is_cancelled():
+    hedger = make_hedger()
+    cancelled = asyncio.Event()
+
+    async def primary():
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    async def fallback():
+        return "fallback"
+
+    assert await hedger.run(primary, fallback) == "fallback"
+    await asyncio.wait_for(cancelled.wait(), 1)
+    stats = hedger.get_statistics()
+    assert (stats["hedged"], stats["fallback_wins"], stats["win_rate"]) == (1, 1, 1.0)
+    # Отмененный основной запрос тоже учтен как замер задержки
+    assert stats["samples"] == 1
+
+
+@pytest.mark.asyncio
+async def test_primary_wins_when_fallback_is_invalid():
+    """Невалидный ответ запасной модели не засчитывается, ждем основную"""
+    hedger = make_hedger()
+    release = asyncio.Event()
+
+    async def primary():
+        await release.wait()
+        return "primary"
+
+    async def fallback():
+        release.set()
+        return None
+
+    assert await hedger.run(primary, fallback) == "primary"
+    stats = hedger.get_statistics()
+    assert (stats["hedged"], stats["fallback_wins"], stats["win_rate"]) == (1, 0, 0.0)
+
+
+@pytest.mark.asyncio
+async def test_primary_wins_after_hedge_and_fallback_is_cancelled():
+    hedger = make_hedger()
+    release = asyncio.Event()
+    cancelled = asyncio.Event()
+
+    async def primary():
+        await release.wait()
+        return "primary"
+
+    async def fallback():
+        release.set()
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    assert await hedger.run(primary, fallback) == "primary"
+    await asyncio.wait_for(cancelled.wait(), 1)
+
+
+@pytest.mark.asyncio
+async def test_both_failed_raises_error():
+    hedger = make_hedger()
+    release = asyncio.Event()
+
+    async def primary():
+        await release.wait()
+        raise RuntimeError("primary down")
+
+    async def fallback():
+        release.set()
+        return None
+
+    with pytest.raises(RuntimeError, match="primary down"):
+        await hedger.run(primary, fallback)
+
+
+@pytest.mark.asyncio
+async def test_without_fallback_waits_for_primary():
+    hedger = make_hedger()
+
+    async def primary():
+        await asyncio.sleep(0.05)
+        return "primary"
+
+    assert await hedger.run(primary) == "primary"
+    assert hedger.get_statistics()["hedged"] == 0
@@ -7,7 +7,7 @@ os.environ["TAVILY_API_KEY"] = "dummy_key"
 os.environ["OPENROUTER_API_KEY"] = "dummy_openrouter"
 os.environ["MEMORY_ENABLED"] = "False"  # Disable memory for these tests
 
-from src.services.history import HistoryManager
+from src.services.history import ChatHistory, HistoryManager
 from aiogram.types import Message, Chat, User
 from datetime import datetime
 
@@ -17,11 +17,11 @@ class TestHistoryManager(unittest.TestCase):
         self.chat_id = 12345
         self.user_id = 111
 
-    def create_mock_message(self, message_id, text, is_forwarded=False):
+    def create_mock_message(self, message_id, text, is_forwarded=False, chat_id=None):
         message_data = {
             "message_id": message_id,
             "date": datetime.now(),
-            "chat": Chat(id=self.chat_id, type="private"),
+            "chat": Chat(id=chat_id or self.chat_id, type="private"),
             "from_user": User(id=self.user_id, is_bot=False, first_name="Test"),
             "text": text
         }
@@ -56,3 +56,358 @@ class TestHistoryManager(unittest.TestCase):
         self.assertEqual(len(self.manager.history[self.chat_id]), 5)
         self.assertEqual(self.manager.get_message_text(self.chat_id, 101), "")
         self.assertEqual(self.manager.get_message_text(self.chat_id, 106), "Msg 6")
+
+    def test_warm_chat(self):
+        self.manager.warm_chat(self.chat_id, [(i, self.user_id, f"Msg {i}") for i in range(1, 9)])
+        self.assertEqual(len(self.manager.history[self.chat_id]), 5)
+        self.assertEqual(self.manager.get_message_text(self.chat_id, 8), "Msg 8")
+
+    def test_index_follows_eviction(self):
+        """Индекс по ID забывает вытесненные сообщения и переживает повтор ID"""
+        for i in range(1, 13):
+            self.manager.add_message(self.create_mock_message(100 + i % 7, f"Msg {i}"))
+        ids = [entry[0] for entry in self.manager.history[self.chat_id]]
+        self.assertEqual(ids, [101, 102, 103, 104, 105])
+        for message_id in ids:
+            self.assertTrue(self.manager.get_message_text(self.chat_id, message_id))
+        self.assertEqual(self.manager.get_message_text(self.chat_id, 105), "Msg 12")
+        self.assertEqual(self.manager.get_message_text(self.chat_id, 106), "")
+
+    def test_ring_matches_reference(self):
+        """Кольцевой буфер и его индекс совпадают с deque и поиском перебором"""
+        from collections import deque
+        import random
+        rng = random.Random(7)
+        for capacity in (1, 3, 8, 50):
+            ring = ChatHistory(capacity)
+            reference = deque(maxlen=capacity)
+            for i in range(600):
+                # Идущие подряд ID с пропусками и изредка повторами
+                message_id = i * 2 + rng.choice((0, 0, 0, 1)) - (capacity * 3 if rng.random() < 0.05 else 0)
+                ring.append(message_id, i % 5, f"text {i}")
+                reference.append((message_id, i % 5, f"text {i}"))
+                self.assertEqual(list(ring), list(reference))
+                for probe in (message_id, message_id - 1, message_id - 2 * capacity):
+                    expected = next((text for mid, _, text in reversed(reference) if mid == probe), None)
+                    self.assertEqual(ring.get_text(probe), expected)
+
+    def test_edit_message(self):
+        """Правка меняет текст на месте, сообщение вне истории не трогается"""
+        for i in range(1, 4):
+            self.manager.add_message(self.create_mock_message(100 + i, f"Msg {i}"))
+        self.assertTrue(self.manager.edit_message(self.create_mock_message(102, "Исправлено")))
+        self.assertFalse(self.manager.edit_message(self.create_mock_message(999, "Нет такого")))
+
+        self.assertEqual(self.manager.get_message_text(self.chat_id, 102), "Исправлено")
+        self.assertEqual(self.manager.get_context(self.chat_id, 103)[1], f"User {self.user_id}: Исправлено")
+
+    @patch('src.services.history.agent_memory')
+    def test_edit_is_not_persisted(self, mock_memory):
+        """Правка живет только в памяти процесса: память не трогается, перезагруженный чат видит исходный текст"""
+        mock_memory.load_chat_history.return_value = [(101, self.user_id, "Исходный")]
+        self.manager.memory_enabled = True
+        self.manager.async_writes = False
+        # Выгруженный чат ради правки не загружается
+        self.assertFalse(self.manager.edit_message(self.create_mock_message(101, "Исправлено")))
+        mock_memory.load_chat_history.assert_not_called()
+
+        self.assertEqual(self.manager.get_message_text(self.chat_id, 101), "Исходный")
+        self.assertTrue(self.manager.edit_message(self.create_mock_message(101, "Исправлено")))
+        self.assertEqual(self.manager.get_message_text(self.chat_id, 101), "Исправлено")
+        mock_memory.save_message.assert_not_called()
+        mock_memory.save_messages.assert_not_called()
+
+        self.manager.clear_chat(self.chat_id)
+        self.assertEqual(self.manager.get_message_text(self.chat_id, 101), "Исходный")
+
+    def test_text_byte_cap(self):
+        """Длинный текст обрезается по байтам UTF-8 целыми символами"""
+        manager = HistoryManager(max_size=5, max_text_bytes=7)
+        manager.add_message(self.create_mock_message(101, "Приветствие"))
+        self.assertEqual(manager.get_message_text(self.chat_id, 101), "При")
+
+    def test_clear_chat(self):
+        for i in range(1, 4):
+            self.manager.add_message(self.create_mock_message(100 + i, f"Msg {i}"))
+        self.assertEqual(self.manager.clear_chat(self.chat_id), 3)
+        self.assertEqual(self.manager.get_message_text(self.chat_id, 101), "")
+        self.assertEqual(self.manager.clear_chat(self.chat_id), 0)
+
+    @patch('src.services.history.agent_memory')
+    def test_budget_evicts_least_recent_chats(self, mock_memory):
+        """Сверх бюджета выгружаются давние чаты и прозрачно загружаются обратно"""
+        mock_memory.load_chat_history.side_effect = lambda chat_id, limit: [(1, 5, f"с диска {chat_id}")]
+        self.manager.memory_enabled = True
+        self.manager.warm_chat(1, [(i, 5, "x" * 100) for i in range(5)])
+        one_chat = self.manager._total_bytes
+        self.manager.memory_budget_bytes = int(one_chat * 2.5)
+
+        self.manager.warm_chat(2, [(i, 5, "x" * 100) for i in range(5)])
+        self.manager.get_message_text(1, 0)  # чат 1 становится свежим
+        self.manager.warm_chat(3, [(i, 5, "x" * 100) for i in range(5)])
+
+        self.assertEqual(list(self.manager.history), [1, 3])
+        self.assertEqual(self.manager.evicted_chats, 1)
+        self.assertLessEqual(self.manager._total_bytes, self.manager.memory_budget_bytes)
+
+        self.assertEqual(self.manager.get_message_text(2, 1), "с диска 2")
+        mock_memory.load_chat_history.assert_called_once_with(2, limit=5)
+        self.assertEqual(self.manager.reloaded_chats, 1)
+        mock_memory.get_statistics.return_value = {}
+        self.assertEqual(self.manager.get_memory_statistics()["history"]["chats"], 3)
+        self.assertEqual(self.manager._total_bytes, sum(chat.nbytes for chat in self.manager.history.values()))
+
+    @patch('src.services.history.agent_memory')
+    def test_idle_chats_evicted(self, mock_memory):
+        """Чаты, простаивающие дольше idle_ttl, выгружаются при следующем обращении к истории"""
+        mock_memory.load_chat_history.return_value = []
+        self.manager.memory_enabled = True
+        self.manager.idle_ttl = 60
+        self.manager.warm_chat(1, [(1, 5, "старое")])
+        self.manager.history[1].last_access -= 120
+
+        self.manager.add_message(self.create_mock_message(101, "Hello"))
+
+        self.assertEqual(list(self.manager.history), [self.chat_id])
+        self.assertEqual(self.manager.evicted_chats, 1)
+
+    @patch('src.services.history.agent_memory')
+    def test_lazy_hydration(self, mock_memory):
+        """История не читается при создании, а загружается при первом обращении к чату"""
+        mock_memory.load_chat_history.return_value = [(1, 5, "с диска")]
+        with patch('src.services.history.config.MEMORY_ENABLED', True):
+            manager = HistoryManager(max_size=5)
+        mock_memory.list_chats.assert_not_called()
+        mock_memory.load_chat_history.assert_not_called()
+
+        self.assertEqual(manager.get_message_text(7, 1), "с диска")
+        self.assertEqual(manager.get_message_text(7, 2), "")
+        mock_memory.load_chat_history.assert_called_once_with(7, limit=5)
+
+    def test_eviction_releases_memory_caches(self):
+        """Выгруженный чат отпускает сегменты, метаданные и поисковый индекс в agent_memory"""
+        import tempfile, shutil
+        from pathlib import Path
+        from src.services.agent_memory import AgentMemory
+        from src.services.memory_search import MemorySearchIndex
+        temp_dir = tempfile.mkdtemp()
+        try:
+            memory = AgentMemory(
+                memory_dir=temp_dir, storage_format="segments",
+                search_index=MemorySearchIndex(Path(temp_dir) / "search"),
+            )
+            self.manager.memory_enabled = True
+            self.manager.async_writes = False
+            self.manager.memory_budget_bytes = 1
+            with patch('src.services.history.agent_memory', memory):
+                for chat_id in range(1, 6):
+                    self.manager.add_message(self.create_mock_message(1, f"сообщение чата {chat_id}", chat_id=chat_id))
+
+            self.assertEqual(list(self.manager.history), [5])
+            self.assertEqual(set(memory._segment_logs), {5})
+            self.assertEqual(set(memory.search_index._chats), {5})
+            self.assertEqual(set(memory._metadata), {5})
+            memory.close()
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    @patch('src.services.history.agent_memory')
+    def test_empty_history_is_not_cached(self, mock_memory):
+        """Чат без сообщений не запоминается: история, импортированная позже, становится видна"""
+        mock_memory.load_chat_history.return_value = []
+        self.manager.memory_enabled = True
+
+        self.assertIsNone(self.manager.get_chat(7))
+        self.assertNotIn(7, self.manager.history)
+
+        mock_memory.load_chat_history.return_value = [(1, 5, "импорт")]
+        self.assertEqual(self.manager.get_message_text(7, 1), "импорт")
+
+    @patch('src.services.history.agent_memory')
+    def test_get_chat_async_does_not_block_loop(self, mock_memory):
+        """Выгруженный чат читается с диска в потоке, цикл событий тем временем работает"""
+        import asyncio
+        import time as time_module
+
+        def slow_load(chat_id, limit):
+            time_module.sleep(0.2)
+            return [(1, 5, "с диска")]
+
+        mock_memory.load_chat_history.side_effect = slow_load
+        self.manager.memory_enabled = True
+        self.manager.async_writes = False
+
+        async def scenario():
+            ticks = 0
+
+            async def ticker():
+                nonlocal ticks
+                while True:
+                    ticks += 1
+                    await asyncio.sleep(0.01)
+
+            ticker_task = asyncio.create_task(ticker())
+            chat = await self.manager.get_chat_async(7)
+            ticker_task.cancel()
+            return chat, ticks
+
+        chat, ticks = asyncio.run(scenario())
+        self.assertEqual(chat.get_text(1), "с диска")
+        self.assertGreater(ticks, 5)
+
+    def test_reload_includes_pending_writes(self):
+        """Чат, выгруженный до того, как писатель сохранил его сообщения, загружается без потерь"""
+        import threading
+        from src.services.memory_writer import MemoryWriter
+        memory = MagicMock()
+        memory.load_chat_history.return_value = [(1, self.user_id, "Msg 1")]
+        unblock = threading.Event()
+        memory.save_messages.side_effect = lambda chat_id, messages: unblock.wait(5)
+        writer = MemoryWriter(memory)
+        self.manager.memory_enabled = True
+        self.manager.async_writes = True
+        self.manager.memory_budget_bytes = 1
+
+        try:
+            with patch('src.services.history.agent_memory', memory), \
+                    patch('src.services.history.memory_writer', writer):
+                for i in (2, 3):
+                    self.manager.add_message(self.create_mock_message(i, f"Msg {i}"))
+                # Другой чат вытесняет этот, пока его сообщения еще не на диске
+                self.manager.warm_chat(1, [(1, 5, "другой чат")])
+                self.assertNotIn(self.chat_id, self.manager.history)
+
+                chat = self.manager.get_chat(self.chat_id)
+                self.assertEqual([m[0] for m in chat], [1, 2, 3])
+        finally:
+            unblock.set()
+            writer.stop()
+        # Выгрузка чата из памяти дождалась записи его сообщений
+        calls = [call[0] for call in memory.method_calls if call[1][:1] == (self.chat_id,)]
+        self.assertEqual(calls[-1], "release_chat")
+        self.assertIn("save_messages", calls)
+
+    def test_full_writer_queue_evict_then_reload(self):
+        """Заполненная очередь писателя не теряет сообщения: хендлер ждет места, а перезагрузка их видит"""
+        import asyncio
+        import threading
+        from src.services.memory_writer import MemoryWriter
+        memory = MagicMock()
+        memory.load_chat_history.return_value = [(1, self.user_id, "Msg 1")]
+        writing, unblock = threading.Event(), threading.Event()
+
+        def slow_save(chat_id, messages):
+            writing.set()
+            unblock.wait(5)
+
+        memory.save_messages.side_effect = slow_save
+        writer = MemoryWriter(memory, max_queue_size=1, put_timeout=5)
+        self.manager.memory_enabled = True
+        self.manager.async_writes = True
+        self.manager.memory_budget_bytes = 1
+
+        async def scenario():
+            await self.manager.add_message_async(self.create_mock_message(2, "Msg 2"))
+            await asyncio.to_thread(writing.wait, 5)  # писатель занят сообщением 2
+            await self.manager.add_message_async(self.create_mock_message(3, "Msg 3"))  # заняло очередь
+            self.assertTrue(writer.full())
+            # Сообщению 4 места нет: хендлер ждет его в потоке, цикл событий свободен
+            waiting = asyncio.create_task(self.manager.add_message_async(self.create_mock_message(4, "Msg 4")))
+            await asyncio.sleep(0.05)
+            self.assertFalse(waiting.done())
+
+            self.manager.warm_chat(1, [(1, 5, "другой чат")])
+            self.assertNotIn(self.chat_id, self.manager.history)
+            chat = await self.manager.get_chat_async(self.chat_id)
+            self.assertEqual([m[0] for m in chat], [1, 2, 3, 4])
+
+            unblock.set()
+            await waiting
+
+        try:
+            with patch('src.services.history.agent_memory', memory), \
+                    patch('src.services.history.memory_writer', writer):
+                asyncio.run(scenario())
+        finally:
+            unblock.set()
+            writer.stop()
+        written = [m[0] for call in memory.save_messages.call_args_list for m in call[0][1]]
+        self.assertEqual(written, [2, 3, 4])
+        self.assertEqual(writer.dropped, 0)
+
+    @patch('src.services.history.agent_memory')
+    def test_prewarm(self, mock_memory):
+        """Прогрев загружает недавние чаты, не трогая уже загруженные и не выталкивая их"""
+        import asyncio
+        mock_memory.recent_chats.return_value = [1, 2, 3]
+        mock_memory.load_chat_history.side_effect = lambda chat_id, limit: [(1, 5, f"чат {chat_id}")] if chat_id != 3 else []
+        self.manager.warm_chat(2, [(1, 5, "уже в памяти")])
+
+        self.assertEqual(asyncio.run(self.manager.prewarm(3)), 1)
+
+        mock_memory.recent_chats.assert_called_once_with(3)
+        self.assertEqual(list(self.manager.history), [1, 2])
+        self.assertEqual(self.manager.get_message_text(2, 1), "уже в памяти")
+
+    def test_deep_context(self):
+        """Сообщение вне буфера находится в памяти вместе с окном вокруг"""
+        import tempfile, shutil
+        from src.services.agent_memory import AgentMemory
+        temp_dir = tempfile.mkdtemp()
+        try:
+            memory = AgentMemory(memory_dir=temp_dir, storage_format="segments")
+            # Каждый третий ID — не текст и в память не попадает
+            memory.save_messages(self.chat_id, [
+                (i, 100 + i % 2, f"Msg {i}", datetime.now()) for i in range(1, 3001) if i % 3
+            ])
+            self.manager.memory_enabled = True
+            with patch('src.services.history.agent_memory', memory):
+                text, context = self.manager.get_deep_context(self.chat_id, 2000)
+                self.assertEqual(text, "Msg 2000")
+                self.assertEqual(context, [f"User {100 + i % 2}: Msg {i}" for i in (1994, 1996, 1997, 1999, 2000, 2002, 2003, 2005)])
+
+                self.assertEqual(self.manager.get_deep_context(self.chat_id, 1500), ("", []))
+                self.assertEqual(self.manager.get_deep_context(self.chat_id, 5000), ("", []))
+                self.assertEqual((self.manager.deep_lookups, self.manager.deep_hits), (3, 1))
+            memory.close()
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    @patch('src.services.history.agent_memory')
+    def test_deep_context_reads_bounded_window(self, mock_memory):
+        """Чтение начинается незадолго до сообщения, а не с начала истории"""
+        mock_memory.iter_messages.return_value = (m for m in [(999990, 1, "до"), (1000000, 2, "цель")])
+        self.manager.memory_enabled = True
+
+        self.assertEqual(self.manager.get_deep_context(self.chat_id, 1000000), ("цель", ["User 1: до", "User 2: цель"]))
+        mock_memory.iter_messages.assert_called_once_with(self.chat_id, after_message_id=1000000 - 4 * 5 - 1)
+
+    @patch('src.services.history.agent_memory')
+    def test_get_context_recalls_related(self, mock_memory):
+        """Похожие старые сообщения из поиска идут перед последними"""
+        mock_memory.search_messages.return_value = [(3, 222, "старое про пиццу")]
+        self.manager.memory_enabled = True
+        self.manager.search_top_k = 3
+        self.manager.warm_chat(self.chat_id, [(i, self.user_id, f"Msg {i}") for i in range(10, 15)])
+
+        context = self.manager.get_context(self.chat_id, 14)
+
+        self.assertEqual(context[0], "(раньше) User 222: старое про пиццу")
+        self.assertEqual(context[1:], [f"User {self.user_id}: Msg {i}" for i in range(10, 15)])
+        mock_memory.search_messages.assert_called_once_with(self.chat_id, "Msg 14", limit=3, before_message_id=10)
+
+    @patch('src.services.history.agent_memory')
+    def test_get_context_async_searches_in_thread(self, mock_memory):
+        """Поиск похожих сообщений (с догоном индекса и чтением диска) не выполняется в цикле событий"""
+        import asyncio
+        import threading
+        search_threads = []
+        mock_memory.search_messages.side_effect = lambda *args, **kwargs: search_threads.append(threading.current_thread()) or []
+        self.manager.memory_enabled = True
+        self.manager.search_top_k = 3
+        self.manager.warm_chat(self.chat_id, [(i, self.user_id, f"Msg {i}") for i in range(10, 15)])
+
+        context = asyncio.run(self.manager.get_context_async(self.chat_id, 14))
+
+        self.assertEqual(context, self.manager.get_context(self.chat_id, 14))
+        self.assertIsNot(search_threads[0], threading.main_thread())
@@ -16,7 +16,7 @@ os.environ["MEMORY_DIR"] = test_memory_dir
 os.environ["MEMORY_ENABLED"] = "True"
 
 from src.services.agent_memory import AgentMemory
-from src.services.history import HistoryManager
+from src.services.history import HistoryManager, agent_memory, memory_writer
 from aiogram.types import Message, User, Chat
 
 
@@ -34,6 +34,10 @@ class TestHistoryWithMemory(unittest.TestCase):
     def setUp(self):
         """Очищаем историю перед каждым тестом"""
         self.history_manager.history.clear()
+        # Выгруженный чат подгружается из памяти, поэтому чистим и ее
+        memory_writer.flush()
+        for chat_id in (99999, 99998, 99997):
+            agent_memory.clear_chat(chat_id)
     
     @classmethod
     def tearDownClass(cls):
@@ -0,0 +1,89 @@
+import asyncio
+import unittest
+import tempfile
+import shutil
+from pathlib import Path
+from unittest.mock import MagicMock
+
+from src.services.history import ChatHistory, HistoryManager
+from src.services.history_snapshot import decode_snapshot, encode_snapshot, restore_history, save_history
+
+
+class TestHistorySnapshot(unittest.TestCase):
+    """Тесты бинарного снимка истории"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = Path(self.temp_dir) / "history.snapshot"
+        self.manager = HistoryManager(max_size=5)
+        # Чат 1 прокрутился по кругу и содержит правку, чат 2 не заполнен
+        for i in range(1, 9):
+            self.manager.warm_chat(1, list(self.manager.history.get(1, [])) + [(i, 10 + i, f"Сообщение {i} ✨")])
+        self.manager.history[1].set_text(7, "исправлено")
+        self.manager.warm_chat(2, [(100, 5, "один"), (101, 6, "")])
+        self.manager.warm_chat(3, [])
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def memory_with(self, last_ids):
+        memory = MagicMock()
+        memory.chat_usage.return_value = {chat_id: {"last_message_id": mid} for chat_id, mid in last_ids.items()}
+        return memory
+
+    def test_roundtrip(self):
+        """Буферы, правки и индекс восстанавливаются без изменений"""
+        self.manager.history[1].append(9, 19, "после прокрутки")
+        chats = decode_snapshot(encode_snapshot(self.manager.history, 5), 5)
+
+        self.assertEqual(list(chats), [1, 2])
+        for chat_id in (1, 2):
+            self.assertEqual(list(chats[chat_id]), list(self.manager.history[chat_id]))
+        self.assertEqual(chats[1].get_text(7), "исправлено")
+        self.assertIsNone(chats[1].get_text(4))
+        # Буфер продолжает работать после восстановления
+        chats[1].append(10, 1, "новое")
+        self.assertEqual([m[0] for m in chats[1]], [6, 7, 8, 9, 10])
+
+    def test_rejects_corrupted_and_mismatched(self):
+        data = bytearray(encode_snapshot(self.manager.history, 5))
+        self.assertIsNone(decode_snapshot(bytes(data), 10))
+        data[-1] ^= 0xFF
+        self.assertIsNone(decode_snapshot(bytes(data), 5))
+        self.assertIsNone(decode_snapshot(b"MB", 5))
+
+    def test_restore_skips_stale_and_loaded_chats(self):
+        """Чат, ушедший в памяти дальше снимка, и уже загруженный чат не трогаются"""
+        asyncio.run(save_history(self.manager, self.path))
+
+        manager = HistoryManager(max_size=5)
+        manager.warm_chat(2, [(200, 1, "загружен обработчиком")])
+        memory = self.memory_with({1: 9, 2: 101})
+        self.assertEqual(asyncio.run(restore_history(manager, self.path, memory)), 0)
+        self.assertEqual(manager.get_message_text(2, 200), "загружен обработчиком")
+
+        manager = HistoryManager(max_size=5)
+        memory = self.memory_with({1: 8, 2: 102})
+        self.assertEqual(asyncio.run(restore_history(manager, self.path, memory)), 1)
+        self.assertEqual(list(manager.history), [1])
+        self.assertEqual(manager.get_message_text(1, 7), "исправлено")
+        self.assertEqual(manager._total_bytes, manager.history[1].nbytes)
+
+    def test_restore_without_snapshot(self):
+        memory = self.memory_with({})
+        self.assertEqual(asyncio.run(restore_history(self.manager, self.path, memory)), 0)
+        memory.chat_usage.assert_not_called()
+
+    def test_restore_falls_back_to_metadata(self):
+        """Без манифеста свежесть проверяется по метаданным чатов"""
+        asyncio.run(save_history(self.manager, self.path))
+        memory = MagicMock(spec=["get_metadata"])
+        memory.get_metadata.side_effect = lambda chat_id: {"last_message_id": {1: 8, 2: 101}[chat_id]}
+
+        manager = HistoryManager(max_size=5)
+        self.assertEqual(asyncio.run(restore_history(manager, self.path, memory)), 2)
+        self.assertEqual(list(manager.history), [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+
+from src.services.json_stream import JsonFieldExtractor
+
+
+def feed_all(extractor: JsonFieldExtractor, chunks):
+    """Скармливает куски по очереди и возвращает, в каком куске завершилось каждое поле."""
+    completed_at = {}
+    for i, chunk in enumerate(chunks):
+        for key in extractor.feed(chunk):
+            completed_at[key] = i
+    return completed_at
+
+
+class TestJsonFieldExtractor(unittest.TestCase):
+    """Тесты инкрементального разбора полей JSON"""
+
+    def test_field_split_across_chunks(self):
+        extractor = JsonFieldExtractor()
+        completed_at = feed_all(extractor, ['{"sea', 'rch_query": "зло', 'й кот"', ', "top_text": "ВЕРХ"}'])
+
+        self.assertEqual(completed_at, {"search_query": 2, "top_text": 3})
+        self.assertEqual(extractor.fields, {"search_query": "злой кот", "top_text": "ВЕРХ"})
+        self.assertTrue(extractor.done)
+
+    def test_search_query_before_other_fields(self):
+        """search_query отдается, пока тексты мема еще генерируются"""
+        extractor = JsonFieldExtractor()
+        self.assertEqual(extractor.feed('```json\n{"search_query": "человек орет", "top_'), {"search_query": "человек орет"})
+        self.assertEqual(extractor.feed('text": "КОГДА'), {})
+        self.assertFalse(extractor.done)
+
+    def test_escapes_in_strings(self):
+        extractor = JsonFieldExtractor()
+        chunks = ['{"top_text": "он сказал \\', '"нет\\"", "bottom_text": "a\\\\', '", "x": "\\u0416 }, ]"}']
+        feed_all(extractor, chunks)
+
+        self.assertEqual(extractor.fields, {"top_text": 'он сказал "нет"', "bottom_text": "a\\", "x": "Ж }, ]"})
+
+    def test_literals_and_nested_values(self):
+        extractor = JsonFieldExtractor()
+        completed_at = feed_all(extractor, ['{"is_memable": tr', 'ue, "n": -1.5e2', ' , "o": {"a": [1, "}"]}, "z": null}'])
+
+        self.assertEqual(extractor.fields, {"is_memable": True, "n": -150.0, "o": {"a": [1, "}"]}, "z": None})
+        # Литерал завершается только разделителем: "true" мог оказаться началом числа или слова
+        self.assertEqual(completed_at["is_memable"], 1)
+        self.assertEqual(completed_at["n"], 2)
+
+    def test_truncated_stream(self):
+        """Оборванный поток отдает только завершенные поля"""
+        extractor = JsonFieldExtractor()
+        feed_all(extractor, ['{"search_query": "кот", "is_memable": true, "top_text": "НЕДОПИС'])
+
+        self.assertEqual(extractor.fields, {"search_query": "кот", "is_memable": True})
+        self.assertFalse(extractor.done)
+
+    def test_malformed_values_are_none(self):
+        extractor = JsonFieldExtractor()
+        feed_all(extractor, ['{"n": 12abc, "search_query": "кот"}'])
+
+        self.assertEqual(extractor.fields, {"n": None, "search_query": "кот"})
+
+    def test_text_after_object_is_ignored(self):
+        extractor = JsonFieldExtractor()
+        self.assertEqual(extractor.feed('{"a": 1}\n```\n{"b": 2}'), {"a": 1})
+        self.assertEqual(extractor.feed('{"c": 3}'), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
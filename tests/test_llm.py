@@ -1,6 +1,8 @@
 import pytest
-from unittest.mock import patch, MagicMock
+import asyncio
+from unittest.mock import patch, AsyncMock, MagicMock
 from src.services.llm import MemeBrain
+from src.services.hedging import Hedger
 from src.services.config import config
 
 @pytest.fixture
@@ -14,7 +16,8 @@ def brain():
         brain_instance.mock_enabled = False
         yield brain_instance
 
-def test_generate_meme_idea_success(brain):
+@pytest.mark.asyncio
+async def test_generate_meme_idea_success(brain):
     mock_response = MagicMock()
     mock_response.choices = [
         MagicMock(message=MagicMock(content='```json\n{"is_memable": true, "top_text": "TOP", "bottom_text": "BOTTOM", "search_query": "QUERY"}\n```'))
@@ -22,35 +25,41 @@ def test_generate_meme_idea_success(brain):
 
     # Patch the OpenAI client create method
     brain.client = MagicMock()
+    brain.client.chat.completions.create = AsyncMock()
     brain.client.chat.completions.create.return_value = mock_response
 
     context = ["User: Hi"]
     trigger = "Hi"
-    result = brain.generate_meme_idea(context, trigger)
+    result = await brain.generate_meme_idea(context, trigger)
 
     assert result is not None
     assert result['top_text'] == "TOP"
     assert result['bottom_text'] == "BOTTOM"
 
-def test_generate_meme_idea_api_error(brain):
+@pytest.mark.asyncio
+async def test_generate_meme_idea_api_error(brain):
     brain.client = MagicMock()
+    brain.client.chat.completions.create = AsyncMock()
     brain.client.chat.completions.create.side_effect = Exception("API Fail")
 
-    result = brain.generate_meme_idea(["Hi"], "Hi")
+    result = await brain.generate_meme_idea(["Hi"], "Hi")
     assert result is None
 
-def test_generate_meme_idea_bad_json(brain):
+@pytest.mark.asyncio
+async def test_generate_meme_idea_bad_json(brain):
     mock_response = MagicMock()
     mock_response.choices = [
         MagicMock(message=MagicMock(content='Not JSON'))
     ]
     brain.client = MagicMock()
+    brain.client.chat.completions.create = AsyncMock()
     brain.client.chat.completions.create.return_value = mock_response
 
-    result = brain.generate_meme_idea(["Hi"], "Hi")
+    result = await brain.generate_meme_idea(["Hi"], "Hi")
     assert result is None
 
-def test_generate_meme_idea_with_template_query(brain):
+@pytest.mark.asyncio
+async def test_generate_meme_idea_with_template_query(brain):
     """Test that template_query field is normalized to search_query"""
     mock_response = MagicMock()
     # OpenRouter может вернуть template_query вместо search_query
@@ -59,11 +68,12 @@ def test_generate_meme_idea_with_template_query(brain):
     ]
 
     brain.client = MagicMock()
+    brain.client.chat.completions.create = AsyncMock()
     brain.client.chat.completions.create.return_value = mock_response
 
     context = ["User: Hi"]
     trigger = "Hi"
-    result = brain.generate_meme_idea(context, trigger)
+    result = await brain.generate_meme_idea(context, trigger)
 
     assert result is not None
     assert result['top_text'] == "TOP"
@@ -71,3 +81,100 @@ def test_generate_meme_idea_with_template_query(brain):
     # Проверяем, что template_query был нормализован в search_query
     assert result['search_query'] == "QUERY"
     assert 'template_query' in result  # Оригинальное поле также должно остаться
+
+@pytest.mark.asyncio
+async def test_generate_meme_idea(brain):
+    """Асинхронный путь разбирает ответ так же и передает таймаут запроса"""
+    mock_response = MagicMock()
+    mock_response.choices = [
+        MagicMock(message=MagicMock(content='{"is_memable": true, "top_text": "TOP", "bottom_text": "BOTTOM", "search_query": "QUERY"}'))
+    ]
+    brain.client = MagicMock()
+    brain.client.chat.completions.create = AsyncMock(return_value=mock_response)
+
+    result = await brain.generate_meme_idea(["User: Hi"], "Hi")
+
+    assert result['search_query'] == "QUERY"
+    kwargs = brain.client.chat.completions.create.call_args.kwargs
+    assert kwargs['timeout'].read == config.LLM_TIMEOUT
+    assert "Hi" in kwargs['messages'][1]['content']
+
+@pytest.mark.asyncio
+async def test_generate_meme_idea_api_error(brain):
+    brain.client = MagicMock()
+    brain.client.chat.completions.create = AsyncMock(side_effect=Exception("API Fail"))
+
+    assert await brain.generate_meme_idea(["Hi"], "Hi") is None
+
+def make_stream(*deltas):
+    """Асинхронный поток кусков ответа, как у chat.completions.create(stream=True)"""
+    async def stream():
+        for delta in deltas:
+            yield MagicMock(choices=[MagicMock(delta=MagicMock(content=delta))])
+    return stream()
+
+@pytest.mark.asyncio
+async def test_stream_idea_announces_search_query_early(brain):
+    """В потоковом режиме search_query отдается до того, как догенерировались тексты"""
+    seen = []
+    deltas = ['{"search_query": "злой', ' кот", "is_memable": true, ', '"top_text": "TOP", ', '"bottom_text": "BOTTOM"}']
+
+    async def create(**kwargs):
+        assert kwargs['stream'] is True
+        async def stream():
+            for i, delta in enumerate(deltas):
+                yield MagicMock(choices=[MagicMock(delta=MagicMock(content=delta))])
+                seen.append(("chunk", i))
+        return stream()
+
+    brain.streaming = True
+    brain.client = MagicMock()
+    brain.client.chat.completions.create = AsyncMock(side_effect=create)
+
+    result = await brain.generate_meme_idea(
+        ["User: Hi"], "Hi", on_search_query=lambda query: seen.append(("query", query)),
+    )
+
+    assert result == {"search_query": "злой кот", "is_memable": True, "top_text": "TOP", "bottom_text": "BOTTOM"}
+    # Запрос объявлен сразу после второго куска, раньше третьего
+    assert seen.index(("query", "злой кот")) < seen.index(("chunk", 2))
+    assert seen.count(("query", "злой кот")) == 1
+
+@pytest.mark.asyncio
+async def test_stream_idea_invalid_json(brain):
+    brain.streaming = True
+    brain.client = MagicMock()
+    brain.client.chat.completions.create = AsyncMock(return_value=make_stream('{"search_query": "кот", "top_'))
+    on_query = MagicMock()
+
+    assert await brain.generate_meme_idea(["Hi"], "Hi", on_search_query=on_query) is None
+    on_query.assert_called_once_with("кот")
+
+@pytest.mark.asyncio
+async def test_slow_primary_model_is_hedged_with_fallback(brain):
+    """Основная модель не уложилась в порог — идея берется у запасной, основной запрос отменяется"""
+    cancelled = []
+
+    async def create(**kwargs):
+        if kwargs['model'] == brain.model:
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                cancelled.append(kwargs['model'])
+                raise
+        response = MagicMock()
+        response.choices = [MagicMock(message=MagicMock(content='{"is_memable": true, "top_text": "T", "bottom_text": "B", "search_query": "Q"}'))]
+        return response
+
+    brain.fallback_model = "fallback/model"
+    brain.hedger = Hedger(min_samples=1000, max_delay=0.01)
+    brain.client = MagicMock()
+    brain.client.chat.completions.create = AsyncMock(side_effect=create)
+
+    result = await brain.generate_meme_idea(["User 1: Hi"], "Hi")
+
+    assert result["top_text"] == "T"
+    await asyncio.sleep(0)  # даем отмене дойти до основного запроса
+    assert cancelled == [brain.model]
+    hedging = brain.get_statistics()["hedging"]
+    assert (hedging["hedged"], hedging["fallback_wins"]) == (1, 1)
@@ -0,0 +1,66 @@
+import pytest
+import time
+from unittest.mock import patch, MagicMock
+from src.services.llm import MemeBrain
+from src.services.llm_cache import MemeIdeaCache, prompt_fingerprint
+from src.services.config import config
+
+IDEA = {"is_memable": True, "top_text": "TOP", "bottom_text": "BOTTOM", "search_query": "QUERY"}
+
+
+def test_fingerprint_normalizes_whitespace():
+    key = prompt_fingerprint("model", ["User 1: привет  мир"], "привет мир", None)
+    assert key == prompt_fingerprint("model", ["User 1: привет мир "], " привет\nмир", "")
+    assert key != prompt_fingerprint("other-model", ["User 1: привет мир"], "привет мир", None)
+    assert key != prompt_fingerprint("model", ["User 1: привет мир"], "привет мир", "Смешно")
+
+
+def test_cache_bounds_and_ttl():
+    cache = MemeIdeaCache(max_entries=2, ttl=60)
+    cache.put("a", IDEA)
+    cache.put("b", IDEA)
+    assert cache.get("a") == IDEA
+    cache.put("c", IDEA)  # вытесняет "b" — к нему дольше всех не обращались
+    assert cache.get("b") is None
+    assert cache.get("c") == IDEA
+
+    with patch("src.services.llm_cache.time.time", return_value=time.time() + 61):
+        assert cache.get("a") is None
+    stats = cache.get_statistics()
+    assert (stats["hits"], stats["misses"], stats["expired"]) == (2, 2, 1)
+
+
+def test_cache_persists(tmp_path):
+    path = tmp_path / "llm_cache.json"
+    cache = MemeIdeaCache(max_entries=10, ttl=60, path=path)
+    cache.put("a", IDEA)
+    cache.put("b", {**IDEA, "top_text": "B"})
+    assert cache.save() == 2
+
+    restored = MemeIdeaCache(max_entries=1, ttl=60, path=path)
+    assert restored.load() == 1
+    # Остается самая свежая запись
+    assert restored.get("b")["top_text"] == "B"
+    assert MemeIdeaCache(path=tmp_path / "missing.json").load() == 0
+
+
+@pytest.mark.asyncio
+async def test_repeated_trigger_skips_llm():
+    """Повторный триггер с теми же входами берет идею из кеша, неудачи не кешируются"""
+    with patch.object(config, 'LLM_MOCK_ENABLED', False):
+        brain = MemeBrain()
+    response = MagicMock()
+    response.choices = [MagicMock(message=MagicMock(content='{"is_memable": true, "top_text": "TOP", "bottom_text": "BOTTOM", "search_query": "QUERY"}'))]
+    brain.client = MagicMock()
+    brain.client.chat.completions.create = MagicMock(side_effect=[Exception("API Fail")])
+
+    async def create(**kwargs):
+        return response
+
+    assert await brain.generate_meme_idea(["User 1: Hi"], "Hi") is None
+    brain.client.chat.completions.create = MagicMock(side_effect=create)
+    assert await brain.generate_meme_idea(["User 1: Hi"], "Hi") == IDEA
+    assert await brain.generate_meme_idea(["User 1:  Hi"], "Hi ") == IDEA
+
+    assert brain.client.chat.completions.create.call_count == 1
+    assert brain.get_statistics()["cache"]["hits"] == 1
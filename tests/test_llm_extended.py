@@ -1,5 +1,5 @@
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, AsyncMock, MagicMock
 from src.services.llm import MemeBrain
 from src.services.config import config
 
@@ -15,13 +15,14 @@ class TestMemeBrainExtended:
             brain_instance.mock_enabled = False
             yield brain_instance
     
-    def test_mock_mode_enabled(self):
+    @pytest.mark.asyncio
+    async def test_mock_mode_enabled(self):
         """Test that mock mode returns predefined response"""
         with patch.object(config, 'LLM_MOCK_ENABLED', True):
             brain = MemeBrain()
             brain.mock_enabled = True
             
-            result = brain.generate_meme_idea(
+            result = await brain.generate_meme_idea(
                 context_messages=["User: Test"],
                 triggered_text="Test",
                 reaction_context="Смех"
@@ -33,7 +34,8 @@ class TestMemeBrainExtended:
             assert 'bottom_text' in result
             assert 'search_query' in result
     
-    def test_generate_meme_idea_with_reaction_context(self, brain):
+    @pytest.mark.asyncio
+    async def test_generate_meme_idea_with_reaction_context(self, brain):
         """Test meme generation with reaction context"""
         mock_response = MagicMock()
         mock_response.choices = [
@@ -43,9 +45,10 @@ class TestMemeBrainExtended:
         ]
         
         brain.client = MagicMock()
+        brain.client.chat.completions.create = AsyncMock()
         brain.client.chat.completions.create.return_value = mock_response
         
-        result = brain.generate_meme_idea(
+        result = await brain.generate_meme_idea(
             context_messages=["User: This is bad"],
             triggered_text="This is bad",
             reaction_context="Злость, ярость"
@@ -59,7 +62,8 @@ class TestMemeBrainExtended:
         prompt = call_args[1]['messages'][1]['content']
         assert "Злость, ярость" in prompt
     
-    def test_generate_meme_idea_empty_context(self, brain):
+    @pytest.mark.asyncio
+    async def test_generate_meme_idea_empty_context(self, brain):
         """Test meme generation with empty context"""
         mock_response = MagicMock()
         mock_response.choices = [
@@ -69,9 +73,10 @@ class TestMemeBrainExtended:
         ]
         
         brain.client = MagicMock()
+        brain.client.chat.completions.create = AsyncMock()
         brain.client.chat.completions.create.return_value = mock_response
         
-        result = brain.generate_meme_idea(
+        result = await brain.generate_meme_idea(
             context_messages=[],
             triggered_text="Test",
             reaction_context=None
@@ -80,7 +85,8 @@ class TestMemeBrainExtended:
         # Should still work with empty context
         assert result is not None
     
-    def test_generate_meme_idea_is_memable_false(self, brain):
+    @pytest.mark.asyncio
+    async def test_generate_meme_idea_is_memable_false(self, brain):
         """Test when LLM returns is_memable: false"""
         mock_response = MagicMock()
         mock_response.choices = [
@@ -90,9 +96,10 @@ class TestMemeBrainExtended:
         ]
         
         brain.client = MagicMock()
+        brain.client.chat.completions.create = AsyncMock()
         brain.client.chat.completions.create.return_value = mock_response
         
-        result = brain.generate_meme_idea(
+        result = await brain.generate_meme_idea(
             context_messages=["User: boring"],
             triggered_text="boring"
         )
@@ -100,7 +107,8 @@ class TestMemeBrainExtended:
         # Should return None when not memable
         assert result is None
     
-    def test_generate_meme_idea_malformed_json(self, brain):
+    @pytest.mark.asyncio
+    async def test_generate_meme_idea_malformed_json(self, brain):
         """Test handling of malformed JSON response"""
         mock_response = MagicMock()
         mock_response.choices = [
@@ -110,36 +118,41 @@ class TestMemeBrainExtended:
         ]
         
         brain.client = MagicMock()
+        brain.client.chat.completions.create = AsyncMock()
         brain.client.chat.completions.create.return_value = mock_response
         
-        result = brain.generate_meme_idea(
+        result = await brain.generate_meme_idea(
             context_messages=["User: test"],
             triggered_text="test"
         )
         
         assert result is None
     
-    def test_generate_meme_idea_network_timeout(self, brain):
+    @pytest.mark.asyncio
+    async def test_generate_meme_idea_network_timeout(self, brain):
         """Test handling of network timeout"""
         brain.client = MagicMock()
+        brain.client.chat.completions.create = AsyncMock()
         brain.client.chat.completions.create.side_effect = TimeoutError("Request timeout")
         
-        result = brain.generate_meme_idea(
+        result = await brain.generate_meme_idea(
             context_messages=["User: test"],
             triggered_text="test"
         )
         
         assert result is None
     
-    def test_generate_meme_idea_empty_response(self, brain):
+    @pytest.mark.asyncio
+    async def test_generate_meme_idea_empty_response(self, brain):
         """Test handling of empty response from API"""
         mock_response = MagicMock()
         mock_response.choices = []
         
         brain.client = MagicMock()
+        brain.client.chat.completions.create = AsyncMock()
         brain.client.chat.completions.create.return_value = mock_response
         
-        result = brain.generate_meme_idea(
+        result = await brain.generate_meme_idea(
             context_messages=["User: test"],
             triggered_text="test"
         )
@@ -147,7 +160,8 @@ class TestMemeBrainExtended:
         # Should handle gracefully
         assert result is None
     
-    def test_generate_meme_idea_missing_required_fields(self, brain):
+    @pytest.mark.asyncio
+    async def test_generate_meme_idea_missing_required_fields(self, brain):
         """Test handling of response missing required fields"""
         mock_response = MagicMock()
         mock_response.choices = [
@@ -157,9 +171,10 @@ class TestMemeBrainExtended:
         ]
         
         brain.client = MagicMock()
+        brain.client.chat.completions.create = AsyncMock()
         brain.client.chat.completions.create.return_value = mock_response
         
-        result = brain.generate_meme_idea(
+        result = await brain.generate_meme_idea(
             context_messages=["User: test"],
             triggered_text="test"
         )
@@ -167,7 +182,8 @@ class TestMemeBrainExtended:
         # Should return None if required fields missing
         assert result is None
     
-    def test_generate_meme_idea_special_characters(self, brain):
+    @pytest.mark.asyncio
+    async def test_generate_meme_idea_special_characters(self, brain):
         """Test with special characters in text"""
         mock_response = MagicMock()
         mock_response.choices = [
@@ -177,9 +193,10 @@ class TestMemeBrainExtended:
         ]
         
         brain.client = MagicMock()
+        brain.client.chat.completions.create = AsyncMock()
         brain.client.chat.completions.create.return_value = mock_response
         
-        result = brain.generate_meme_idea(
+        result = await brain.generate_meme_idea(
             context_messages=["User: Test <html> & \"quotes\""],
             triggered_text="Test <html> & \"quotes\""
         )
@@ -0,0 +1,171 @@
+import unittest
+import tempfile
+import shutil
+import threading
+import multiprocessing
+from datetime import datetime
+from pathlib import Path
+from unittest.mock import patch
+
+from src.services import memory_daemon
+from src.services.agent_memory import AgentMemory
+from src.services.memory_daemon import MemoryDaemon, RemoteMemory
+
+
+def append_from_worker(socket_path: str, memory_dir: str, worker: int, count: int):
+    """Процесс бота: пишет свои сообщения через демона пачками по 10"""
+    remote = RemoteMemory(socket_path, reader=AgentMemory(memory_dir=memory_dir, storage_format="segments", read_only=True))
+    try:
+        for start in range(0, count, 10):
+            remote.save_messages(1, [
+                (worker * 100000 + i, worker, f"Процесс {worker}, сообщение {i}", datetime.now())
+                for i in range(start, min(start + 10, count))
+            ])
+    finally:
+        remote.close()
+
+
+class TestMemoryDaemon(unittest.TestCase):
+    """Тесты демона-писателя и памяти процессов бота"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.memory_dir = str(Path(self.temp_dir) / "memory")
+        self.socket_path = str(Path(self.temp_dir) / "writer.sock")
+        self.memory = AgentMemory(memory_dir=self.memory_dir, storage_format="segments", segment_max_bytes=4096, segment_tail_keep=5)
+        self.daemon = MemoryDaemon(self.memory, self.socket_path, batch_size=50)
+        self.daemon.start()
+        self.remote = self.make_remote()
+
+    def tearDown(self):
+        self.remote.close()
+        self.daemon.stop()
+        self.memory.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def make_remote(self) -> RemoteMemory:
+        reader = AgentMemory(memory_dir=self.memory_dir, storage_format="segments", read_only=True)
+        return RemoteMemory(self.socket_path, reader=reader)
+
+    def test_write_and_read(self):
+        """Запись уходит демону, история читается напрямую из файлов"""
+        self.remote.save_message(1, 1, 111, "Привет")
+        self.remote.save_messages(1, [(i, 111, f"msg {i}", datetime.now()) for i in range(2, 6)])
+        self.remote._request("flush")
+
+        self.assertEqual(self.remote.load_chat_history(1, limit=2), [(4, 111, "msg 4"), (5, 111, "msg 5")])
+        self.assertEqual(self.remote.get_metadata(1)["message_count"], 5)
+        self.assertEqual(self.remote.list_chats(), [1])
+        self.assertEqual(self.remote.get_statistics()["daemon_writer"]["messages_written"], 5)
+
+        self.remote.clear_chat(1)
+        self.assertEqual(self.remote.load_chat_history(1), [])
+        self.assertIsNone(self.remote.get_metadata(1))
+
+    def test_reader_sees_rotation(self):
+        """Читатель видит сообщения, которые демон успел сжать в холодные сегменты"""
+        for start in range(0, 300, 20):
+            self.remote.save_messages(2, [(i, 5, f"Сообщение номер {i} " * 3, datetime.now()) for i in range(start, start + 20)])
+            self.remote._request("flush")
+            self.assertEqual(len(self.remote.load_chat_history(2)), start + 20)
+
+        self.assertTrue(self.memory._cold_segments(2))
+        self.assertEqual([m[0] for m in self.remote.iter_messages(2, after_message_id=289)], list(range(290, 300)))
+
+    def test_reader_retries_read_torn_by_rotation(self):
+        """Ротация между чтением списка холодных сегментов и открытием горячего не теряет сообщения"""
+        self.memory.save_messages(6, [(i, 1, f"Сообщение {i}", datetime.now()) for i in range(1, 21)])
+        reader = self.remote.reader
+        cold_segments = reader._cold_segments
+        calls = []
+
+        def rotate_after_listing(chat_id):
+            stale = cold_segments(chat_id)
+            calls.append(stale)
+            if len(calls) == 1:
+                self.memory._rotate_segment(chat_id, self.memory._get_segment_log(chat_id))
+            return stale
+
+        with patch.object(reader, "_cold_segments", side_effect=rotate_after_listing):
+            messages = [m[0] for m in reader.iter_messages(6)]
+        self.assertEqual(calls[0], [])
+        self.assertEqual(messages, list(range(1, 21)))
+
+    def test_reader_waits_for_rewrite_in_progress(self):
+        """Пока писатель переписывает сегмент, читатель ждет, а не читает половину"""
+        self.memory.save_messages(7, [(i, 1, f"Сообщение {i}", datetime.now()) for i in range(1, 11)])
+        index_tmp = self.memory._chat_path(7, ".idx.tmp")
+        index_tmp.write_bytes(b"")
+
+        with patch("src.services.agent_memory.time.sleep", side_effect=lambda _: index_tmp.unlink()) as sleep:
+            self.assertEqual([m[0] for m in self.remote.load_chat_history(7, limit=3)], [8, 9, 10])
+        sleep.assert_called_once()
+
+    def test_reconnect_after_restart(self):
+        """После перезапуска демона процесс бота переподключается сам"""
+        self.remote.save_message(3, 1, 1, "до перезапуска")
+        self.daemon.stop()
+        self.daemon = MemoryDaemon(self.memory, self.socket_path)
+        self.daemon.start()
+
+        self.remote.save_message(3, 2, 1, "после перезапуска")
+        self.remote._request("flush")
+        self.assertEqual([m[0] for m in self.remote.load_chat_history(3)], [1, 2])
+
+    def test_lost_response_does_not_duplicate_append(self):
+        """Запрос дошел до демона, а ответ потерялся: append не повторяется, чтение — повторяется"""
+        recv_frame = memory_daemon._recv_frame
+        client = threading.current_thread()
+        calls = []
+
+        def drop_first_response(sock):
+            response = recv_frame(sock)
+            if threading.current_thread() is not client:
+                return response  # кадры, которые читает сам демон
+            calls.append(1)
+            if len(calls) == 1:
+                raise ConnectionResetError("обрыв до ответа")
+            return response
+
+        with patch.object(memory_daemon, "_recv_frame", side_effect=drop_first_response):
+            with self.assertRaises(ConnectionResetError):
+                self.remote.save_message(4, 1, 1, "одно сообщение")
+            self.assertEqual(self.remote.list_chats(), [4])
+        self.remote._request("flush")
+        self.assertEqual(self.remote.load_chat_history(4), [(1, 1, "одно сообщение")])
+
+        calls.clear()
+        with patch.object(memory_daemon, "_recv_frame", side_effect=drop_first_response):
+            self.assertEqual(self.remote.get_metadata(4)["message_count"], 1)
+        self.assertEqual(len(calls), 2)
+
+    def test_error_is_reported(self):
+        with self.assertRaises(RuntimeError):
+            self.remote._request("unknown")
+
+    def test_concurrent_processes(self):
+        """Несколько процессов пишут в один чат без потерь и повторов"""
+        context = multiprocessing.get_context("spawn")
+        workers = [
+            context.Process(target=append_from_worker, args=(self.socket_path, self.memory_dir, worker, 200))
+            for worker in range(1, 4)
+        ]
+        for process in workers:
+            process.start()
+        for process in workers:
+            process.join(60)
+            self.assertEqual(process.exitcode, 0)
+        self.remote._request("flush")
+
+        messages = self.remote.load_chat_history(1)
+        self.assertEqual(len(messages), 600)
+        self.assertEqual(len({m[0] for m in messages}), 600)
+        self.assertEqual(self.remote.get_metadata(1)["message_count"], 600)
+        # Порядок внутри каждого процесса сохраняется
+        for worker in range(1, 4):
+            own = [m[0] for m in messages if m[1] == worker]
+            self.assertEqual(own, sorted(own))
+
+
+if __name__ == '__main__':
+    unittest.main()
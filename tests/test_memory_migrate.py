@@ -0,0 +1,133 @@
+import unittest
+import tempfile
+import shutil
+import json
+from datetime import datetime
+from pathlib import Path
+
+from src.services.agent_memory import AgentMemory, iter_markdown_messages
+from src.services.memory_sqlite import SQLiteMemory
+from src.services.memory_migrate import migrate_memory
+
+
+class TestMarkdownStreamingParser(unittest.TestCase):
+    """Тесты построчного разбора markdown истории"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.memory = AgentMemory(memory_dir=self.temp_dir)
+
+    def tearDown(self):
+        self.memory.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_roundtrip(self):
+        """Текст, пользователь и время восстанавливаются без потерь"""
+        timestamp = datetime(2026, 1, 9, 15, 30, 0)
+        texts = ["Обычный текст", "Многострочный\n\nс пустой строкой", "С `кавычками` и ```блоком```", "### Сообщение #999 внутри текста"]
+        for i, text in enumerate(texts, start=1):
+            self.memory.save_message(1, i, 100 + i, text, timestamp)
+
+        parsed = list(iter_markdown_messages(self.memory._get_chat_file_path(1)))
+        self.assertEqual([(m[0], m[1], m[3]) for m in parsed], [(i, 100 + i, text) for i, text in enumerate(texts, start=1)])
+        self.assertEqual(parsed[0][2], timestamp)
+
+    def test_skips_broken_blocks(self):
+        """Битые блоки пропускаются, остальные читаются"""
+        self.memory.save_message(1, 1, 111, "первое")
+        with open(self.memory._get_chat_file_path(1), 'a', encoding='utf-8') as f:
+            f.write("### Сообщение #abc\n**Пользователь:** User 1\n\n```\nбитое\n```\n\n")
+            f.write("### Сообщение #3\n**Пользователь:** User x\n\n```\nбез пользователя\n```\n\n")
+        self.memory.save_message(1, 4, 111, "последнее")
+
+        self.assertEqual(self.memory.load_chat_history(1), [(1, 111, "первое"), (4, 111, "последнее")])
+
+    def test_limit_keeps_tail(self):
+        """С лимитом возвращаются последние сообщения"""
+        for i in range(1, 21):
+            self.memory.save_message(1, i, 111, f"msg {i}")
+        self.assertEqual([m[0] for m in self.memory.load_chat_history(1, limit=3)], [18, 19, 20])
+
+
+class TestMemoryMigration(unittest.TestCase):
+    """Тесты потоковой миграции markdown истории"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.source_dir = str(Path(self.temp_dir) / "memory")
+        source = AgentMemory(memory_dir=self.source_dir)
+        for chat_id in range(1, 6):
+            for i in range(1, 26):
+                source.save_message(chat_id, i, 100 + chat_id, f"Чат {chat_id}, сообщение {i}")
+        source.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_migrate_to_segments(self):
+        """Миграция в сегменты переносит все чаты и строит манифест"""
+        output = str(Path(self.temp_dir) / "segments")
+        stats = migrate_memory(self.source_dir, "segments", output, workers=2, batch_size=10)
+
+        self.assertEqual(stats["chats"], 5)
+        self.assertEqual(stats["messages"], 125)
+        self.assertGreater(stats["messages_per_second"], 0)
+
+        target = AgentMemory(memory_dir=output, storage_format="segments")
+        self.assertEqual(target.list_chats(), [1, 2, 3, 4, 5])
+        self.assertEqual(target.get_statistics()["total_messages"], 125)
+        self.assertEqual(target.load_chat_history(3, limit=1), [(25, 103, "Чат 3, сообщение 25")])
+        self.assertFalse(Path(output + ".checkpoint").exists())
+
+    def test_migrate_to_sqlite(self):
+        """Миграция в SQLite из нескольких процессов"""
+        db_path = str(Path(self.temp_dir) / "memory.db")
+        migrate_memory(self.source_dir, "sqlite", db_path, workers=2)
+
+        target = SQLiteMemory(db_path=db_path)
+        self.assertEqual(target.get_statistics()["total_messages"], 125)
+        self.assertEqual(len(target.load_chat_history(5)), 25)
+        target.close()
+
+    def test_export_jsonl(self):
+        """Экспорт в JSONL пишет по файлу на чат"""
+        output = Path(self.temp_dir) / "jsonl"
+        migrate_memory(self.source_dir, "jsonl", str(output), workers=1)
+
+        lines = (output / "chat_2.jsonl").read_text(encoding='utf-8').splitlines()
+        self.assertEqual(len(lines), 25)
+        record = json.loads(lines[0])
+        self.assertEqual((record["chat_id"], record["message_id"], record["text"]), (2, 1, "Чат 2, сообщение 1"))
+
+    def test_resume_from_checkpoint(self):
+        """Чаты из контрольной точки пропускаются, недоперенесенный чат переносится заново"""
+        output = str(Path(self.temp_dir) / "segments")
+        checkpoint = Path(output + ".checkpoint")
+        checkpoint.write_text("1\n2\n", encoding='utf-8')
+        # Чат 3 успел перенестись наполовину до прерывания
+        partial = AgentMemory(memory_dir=output, storage_format="segments")
+        partial.save_messages(3, [(1, 103, "Чат 3, сообщение 1", datetime.now())])
+        partial.close()
+
+        stats = migrate_memory(self.source_dir, "segments", output, workers=2)
+
+        self.assertEqual(stats["skipped_chats"], 2)
+        self.assertEqual(stats["chats"], 3)
+        target = AgentMemory(memory_dir=output, storage_format="segments")
+        self.assertEqual(target.list_chats(), [3, 4, 5])
+        self.assertEqual(len(target.load_chat_history(3)), 25)
+
+    def test_same_directory_rejected(self):
+        with self.assertRaises(ValueError):
+            migrate_memory(self.source_dir, "segments", self.source_dir)
+
+    def test_cli(self):
+        """Команда migrate печатает прогресс и итог"""
+        from src.services.memory_cli import main
+        output = str(Path(self.temp_dir) / "cli")
+        self.assertEqual(main(["--memory-dir", self.source_dir, "migrate", "--to", "jsonl", "--output", output, "--workers", "1"]), 0)
+        self.assertEqual(len(list(Path(output).glob("chat_*.jsonl"))), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+import unittest
+import tempfile
+import shutil
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from src.services.agent_memory import AgentMemory
+from src.services.memory_retention import RetentionSweeper
+
+
+class TestAgentMemoryRetention(unittest.TestCase):
+    """Тесты лимитов хранения и учета места на диске"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def _memory(self, **kwargs):
+        return AgentMemory(memory_dir=self.temp_dir, **kwargs)
+
+    def test_bytes_tracked_as_running_total(self):
+        """Счетчик байт совпадает с размером файлов без пересканирования"""
+        for storage_format in ("markdown", "segments"):
+            with self.subTest(storage_format=storage_format):
+                memory = AgentMemory(memory_dir=tempfile.mkdtemp(dir=self.temp_dir), storage_format=storage_format)
+                for i in range(1, 21):
+                    memory.save_message(1, i, 111, f"Сообщение {i}")
+                memory.save_message(2, 1, 111, "Другой чат")
+
+                on_disk = sum(path.stat().st_size for path in Path(memory.memory_dir).iterdir()
+                              if path.suffix in (".md", ".log", ".idx"))
+                self.assertEqual(memory.get_statistics()["total_bytes"], on_disk)
+                self.assertEqual(memory.get_metadata(1)["bytes"], memory._measure_chat_bytes(1))
+                memory.close()
+
+    def test_bytes_survive_restart(self):
+        """Итоги по диску сохраняются в манифесте"""
+        memory = self._memory(storage_format="segments")
+        for i in range(1, 11):
+            memory.save_message(1, i, 111, f"msg {i}")
+        total = memory.get_statistics()["total_bytes"]
+        memory.close()
+
+        self.assertEqual(self._memory(storage_format="segments").get_statistics()["total_bytes"], total)
+
+    def test_max_messages_segments(self):
+        """Лимит сообщений оставляет только последние, включая холодные сегменты"""
+        memory = self._memory(storage_format="segments", segment_max_bytes=1024, segment_tail_keep=5)
+        for i in range(1, 101):
+            memory.save_message(1, i, 111, f"Сообщение номер {i} с длинным текстом")
+        bytes_before = memory.get_metadata(1)["bytes"]
+
+        result = memory.apply_retention(1, max_messages=30)
+
+        self.assertEqual(result["messages"], 70)
+        self.assertEqual([m[0] for m in memory.load_chat_history(1)], list(range(71, 101)))
+        metadata = memory.get_metadata(1)
+        self.assertEqual(metadata["message_count"], 30)
+        self.assertEqual(result["bytes"], bytes_before - metadata["bytes"])
+        self.assertEqual(metadata["bytes"], memory._measure_chat_bytes(1, metadata))
+        self.assertEqual(memory.get_statistics()["total_messages"], 30)
+        memory.close()
+
+    def test_max_messages_markdown(self):
+        """Лимит сообщений работает и для markdown файлов"""
+        memory = self._memory()
+        for i in range(1, 11):
+            memory.save_message(1, i, 111, f"msg {i}")
+
+        self.assertEqual(memory.apply_retention(1, max_messages=3)["messages"], 7)
+        self.assertEqual(memory.load_chat_history(1), [(8, 111, "msg 8"), (9, 111, "msg 9"), (10, 111, "msg 10")])
+        memory.save_message(1, 11, 111, "msg 11")
+        self.assertEqual(len(memory.load_chat_history(1)), 4)
+        memory.close()
+
+    def test_max_age(self):
+        """Сообщения старше лимита удаляются"""
+        memory = self._memory(storage_format="segments")
+        now = datetime.now()
+        memory.save_messages(1, [(i, 111, f"old {i}", now - timedelta(days=10)) for i in range(1, 6)])
+        memory.save_messages(1, [(i, 111, f"new {i}", now) for i in range(6, 9)])
+
+        self.assertEqual(memory.apply_retention(1, max_age=86400)["messages"], 5)
+        self.assertEqual([m[0] for m in memory.load_chat_history(1)], [6, 7, 8])
+        # Повторный проход отсеивается по метаданным
+        self.assertEqual(memory.apply_retention(1, max_age=86400)["messages"], 0)
+        memory.close()
+
+    def test_max_bytes(self):
+        """Лимит байт на чат соблюдается"""
+        memory = self._memory(storage_format="segments")
+        for i in range(1, 51):
+            memory.save_message(1, i, 111, "x" * 100)
+
+        memory.apply_retention(1, max_bytes=1000)
+        self.assertLessEqual(memory.get_metadata(1)["bytes"], 1000)
+        self.assertGreater(len(memory.load_chat_history(1)), 0)
+        memory.close()
+
+    def test_everything_expired_clears_chat(self):
+        """Если не осталось ни одного сообщения, чат удаляется целиком"""
+        memory = self._memory(storage_format="segments")
+        memory.save_message(1, 1, 111, "old", datetime.now() - timedelta(days=30))
+
+        result = memory.apply_retention(1, max_age=86400)
+        self.assertEqual(result["messages"], 1)
+        self.assertNotIn(1, memory.list_chats())
+        self.assertEqual(memory.get_statistics()["total_bytes"], 0)
+        memory.close()
+
+
+class TestRetentionSweeper(unittest.TestCase):
+    """Тесты фоновой очистки памяти"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.memory = AgentMemory(memory_dir=self.temp_dir, storage_format="segments")
+
+    def tearDown(self):
+        self.memory.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_disabled_without_limits(self):
+        """Без лимитов очистка ничего не делает"""
+        sweeper = RetentionSweeper(self.memory)
+        self.assertFalse(sweeper.enabled)
+        self.assertEqual(sweeper.sweep_step(), {"messages": 0, "bytes": 0})
+
+    def test_incremental_round_robin(self):
+        """За шаг проверяется только пачка чатов, обход идет по кругу"""
+        for chat_id in range(1, 6):
+            for i in range(1, 11):
+                self.memory.save_message(chat_id, i, 111, f"msg {i}")
+
+        sweeper = RetentionSweeper(self.memory, max_messages=4, batch_size=2)
+        sweeper.sweep_step()
+        self.assertEqual(sweeper.chats_trimmed, 2)
+        sweeper.sweep_step()
+        sweeper.sweep_step()
+
+        for chat_id in range(1, 6):
+            self.assertEqual(len(self.memory.load_chat_history(chat_id)), 4)
+        self.assertEqual(sweeper.reclaimed_messages, 30)
+        self.assertGreater(sweeper.get_statistics()["reclaimed_bytes"], 0)
+
+    def test_global_limit_trims_idle_chats_first(self):
+        """Общий лимит освобождает место за счет давно не обновлявшихся чатов"""
+        old = datetime.now() - timedelta(days=5)
+        self.memory.save_messages(1, [(i, 111, f"idle {i}", old) for i in range(1, 11)])
+        self.memory.save_messages(2, [(i, 111, f"active {i}", datetime.now()) for i in range(1, 11)])
+
+        sweeper = RetentionSweeper(self.memory, global_max_messages=15)
+        sweeper.sweep_step()
+
+        self.assertEqual(len(self.memory.load_chat_history(1)), 5)
+        self.assertEqual(len(self.memory.load_chat_history(2)), 10)
+        self.assertEqual(self.memory.get_statistics()["total_messages"], 15)
+
+    def test_global_limit_drops_whole_chat(self):
+        """Если превышение больше чата, чат удаляется целиком"""
+        old = datetime.now() - timedelta(days=5)
+        self.memory.save_messages(1, [(i, 111, f"idle {i}", old) for i in range(1, 4)])
+        self.memory.save_messages(2, [(i, 111, f"active {i}", datetime.now()) for i in range(1, 11)])
+
+        sweeper = RetentionSweeper(self.memory, global_max_messages=8)
+        sweeper.sweep_step()
+
+        self.assertEqual(self.memory.list_chats(), [2])
+        self.assertEqual(self.memory.get_statistics()["total_messages"], 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
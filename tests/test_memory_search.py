@@ -0,0 +1,159 @@
+import time
+import unittest
+import tempfile
+import shutil
+import threading
+from datetime import datetime
+from pathlib import Path
+
+from src.services.agent_memory import AgentMemory
+from src.services.memory_search import MemorySearchIndex, tokenize
+
+
+class TestMemorySearchIndex(unittest.TestCase):
+    """Тесты инвертированного индекса по истории"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.index = MemorySearchIndex(self.temp_dir, flush_messages=10, max_segments=3)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_tokenize(self):
+        """Стоп-слова и короткие слова отбрасываются, словоформы сводятся к основе"""
+        self.assertEqual(tokenize("Это был Кот, котлеты и 2026"), {"кот", "котлет"})
+        self.assertEqual(tokenize("программисты"), tokenize("программистов"))
+
+    def test_search_across_segments_and_buffer(self):
+        """Поиск видит и сброшенные сегменты, и буфер; слияние не теряет постинги"""
+        for i in range(1, 96):
+            topic = "пицца" if i % 10 == 0 else "погода"
+            self.index.add(1, [(i, f"сообщение {i} про {topic}")])
+
+        self.assertLessEqual(len(self.index._chats[1].segments), 3)
+        self.assertEqual(self.index.search(1, "хочу пиццу", limit=20), [90, 80, 70, 60, 50, 40, 30, 20, 10])
+        self.assertEqual(self.index.search(1, "пицца", limit=2, before_message_id=50), [40, 30])
+        self.assertEqual(self.index.search(1, "бананы"), [])
+        self.assertEqual(self.index.search(2, "пицца"), [])
+
+    def test_rare_terms_rank_higher(self):
+        """Редкий терм весит больше частого"""
+        self.index.add(1, [(i, "обычная болтовня") for i in range(1, 30)])
+        self.index.add(1, [(30, "болтовня про дирижабль"), (31, "обычная болтовня")])
+        self.assertEqual(self.index.search(1, "болтовня про дирижабль", limit=1), [30])
+
+    def test_persistence(self):
+        """Сброшенный индекс переживает перезапуск, буфер сбрасывается при закрытии"""
+        self.index.add(1, [(i, f"слово{i % 3} текст") for i in range(1, 16)])
+        self.index.close()
+
+        reopened = MemorySearchIndex(self.temp_dir)
+        self.assertEqual(reopened.indexed_through(1), 15)
+        self.assertEqual(len(reopened.search(1, "слово1", limit=10)), 5)
+        reopened.drop_chat(1)
+        self.assertEqual(list(Path(self.temp_dir).glob("1.*")), [])
+        self.assertEqual(reopened.indexed_through(1), 0)
+
+    def test_open_chats_are_bounded(self):
+        """Давно не использованные чаты сбрасываются на диск и закрываются"""
+        index = MemorySearchIndex(Path(self.temp_dir) / "bounded", flush_messages=10, max_open_chats=2)
+        for chat_id in (1, 2, 3):
+            index.add(chat_id, [(1, f"чат{chat_id} абракадабра")])
+        self.assertEqual(list(index._chats), [2, 3])
+
+        # Выгруженный чат подгружается с диска без потерь
+        self.assertEqual(index.search(1, "абракадабра"), [1])
+        self.assertEqual(list(index._chats), [3, 1])
+        index.close()
+
+
+class TestAgentMemorySearch(unittest.TestCase):
+    """Тесты поиска по истории через AgentMemory"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def _memory(self, **kwargs):
+        index = MemorySearchIndex(Path(self.temp_dir) / "search", flush_messages=50)
+        return AgentMemory(memory_dir=self.temp_dir, search_index=index, **kwargs)
+
+    def test_search_messages(self):
+        """Найденные сообщения возвращаются с текстом, замеряется время запроса"""
+        for storage_format in ("markdown", "segments"):
+            with self.subTest(storage_format=storage_format):
+                memory = self._memory(storage_format=storage_format)
+                memory.clear_chat(1)
+                for i in range(1, 201):
+                    text = "Вспомним тот случай с дирижаблем" if i in (17, 120) else f"Обычное сообщение {i}"
+                    memory.save_message(1, i, 100 + i, text)
+
+                found = memory.search_messages(1, "опять дирижабль?", limit=5, before_message_id=190)
+                self.assertEqual(found, [(17, 117, "Вспомним тот случай с дирижаблем"), (120, 220, "Вспомним тот случай с дирижаблем")])
+                self.assertEqual(memory.search_messages(1, "дирижабль", before_message_id=100), [found[0]])
+                stats = memory.get_statistics()["search"]
+                self.assertEqual(stats["queries"], 2)
+                self.assertGreater(stats["p95_ms"], 0)
+                memory.close()
+
+    def test_catch_up_after_crash(self):
+        """Сообщения, не попавшие в индекс (буфер потерян или поиск включен позже), доиндексируются"""
+        plain = AgentMemory(memory_dir=self.temp_dir, storage_format="segments")
+        plain.save_messages(1, [(i, 111, f"сообщение {i}", datetime.now()) for i in range(1, 100)])
+        plain.save_message(1, 100, 111, "редкое слово абракадабра")
+        plain.close()
+
+        memory = self._memory(storage_format="segments")
+        self.assertEqual(memory.search_messages(1, "абракадабра"), [(100, 111, "редкое слово абракадабра")])
+        memory.save_message(1, 101, 111, "снова абракадабра")
+        self.assertEqual([m[0] for m in memory.search_messages(1, "абракадабра")], [100, 101])
+        memory.close()
+
+    def test_writer_during_catch_up_loses_nothing(self):
+        """Сообщение писателя, пришедшее посреди догона индекса, не отменяет оставшиеся пачки догона"""
+        plain = AgentMemory(memory_dir=self.temp_dir, storage_format="segments")
+        plain.save_messages(1, [
+            (i, 111, "редкое слово абракадабра" if i == 75 else f"сообщение {i}", datetime.now()) for i in range(1, 101)
+        ])
+        plain.close()
+
+        memory = self._memory(storage_format="segments")
+        paused, resume = threading.Event(), threading.Event()
+        original_iter = memory.iter_messages
+
+        def paused_iter(chat_id, after_message_id=0):
+            for message in original_iter(chat_id, after_message_id):
+                # Первая пачка догона (50 сообщений) уже в индексе
+                if message[0] == 60 and not paused.is_set():
+                    paused.set()
+                    resume.wait(5)
+                yield message
+
+        memory.iter_messages = paused_iter
+        searcher = threading.Thread(target=memory.search_messages, args=(1, "абракадабра"))
+        searcher.start()
+        self.assertTrue(paused.wait(5))
+        writer = threading.Thread(target=memory.save_message, args=(1, 101, 111, "снова абракадабра"))
+        writer.start()
+        time.sleep(0.1)
+        resume.set()
+        searcher.join(5)
+        writer.join(5)
+
+        self.assertEqual([m[0] for m in memory.search_messages(1, "абракадабра")], [75, 101])
+        memory.close()
+
+    def test_clear_chat_drops_index(self):
+        memory = self._memory()
+        memory.save_message(1, 1, 111, "абракадабра")
+        memory.clear_chat(1)
+        self.assertEqual(memory.search_messages(1, "абракадабра"), [])
+        memory.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
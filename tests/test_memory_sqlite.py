@@ -0,0 +1,121 @@
+import unittest
+import tempfile
+import shutil
+import os
+import sqlite3
+from datetime import datetime
+from unittest.mock import patch
+
+from src.services.memory_sqlite import SQLiteMemory
+from src.services.agent_memory import AgentMemory, create_agent_memory
+
+
+class TestSQLiteMemory(unittest.TestCase):
+    """Тесты SQLite бэкенда агентской памяти"""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.memory = SQLiteMemory(db_path=os.path.join(self.temp_dir, "memory.db"))
+    
+    def tearDown(self):
+        self.memory.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def test_wal_mode(self):
+        """База открывается в режиме WAL"""
+        conn = sqlite3.connect(self.memory.db_path)
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        conn.close()
+    
+    def test_save_and_load(self):
+        """Сообщения сохраняются и читаются в хронологическом порядке"""
+        for i in range(1, 6):
+            self.memory.save_message(1, i, 100 + i, f"Сообщение {i}")
+        
+        self.assertEqual(self.memory.load_chat_history(1)[0], (1, 101, "Сообщение 1"))
+        self.assertEqual([m[0] for m in self.memory.load_chat_history(1, limit=2)], [4, 5])
+        self.assertEqual(self.memory.load_chat_history(999), [])
+    
+    def test_range_and_cursor(self):
+        """Выборка по периоду и по ID сообщения"""
+        start = datetime(2026, 3, 1)
+        self.memory.save_messages(1, [(i, 111, f"msg {i}", start.replace(hour=i)) for i in range(1, 11)])
+        
+        self.assertEqual([m[0] for m in self.memory.load_chat_range(1, start.replace(hour=3), start.replace(hour=5))], [3, 4, 5])
+        self.assertEqual(list(self.memory.iter_messages(1, after_message_id=8)), [(9, 111, "msg 9"), (10, 111, "msg 10")])
+    
+    def test_batch_insert_and_metadata(self):
+        """Пачка пишется одной транзакцией и обновляет метаданные"""
+        timestamp = datetime(2026, 1, 9, 15, 30, 0)
+        self.memory.save_messages(1, [(i, 111, f"msg {i}", timestamp) for i in range(1, 101)])
+        self.memory.save_message(1, 101, 111, "last", timestamp)
+        
+        metadata = self.memory.get_metadata(1)
+        self.assertEqual(metadata['chat_id'], 1)
+        self.assertEqual(metadata['message_count'], 101)
+        self.assertEqual(metadata['last_message_id'], 101)
+        self.assertEqual(metadata['last_update'], timestamp.isoformat())
+        self.assertIsNone(self.memory.get_metadata(2))
+    
+    def test_list_clear_and_statistics(self):
+        """Список чатов, очистка и статистика"""
+        self.memory.save_message(111, 1, 999, "a")
+        self.memory.save_message(111, 2, 999, "b")
+        self.memory.save_message(222, 1, 999, "c")
+        
+        self.assertEqual(self.memory.list_chats(), [111, 222])
+        stats = self.memory.get_statistics()
+        self.assertEqual(stats['total_chats'], 2)
+        self.assertEqual(stats['total_messages'], 3)
+        
+        self.assertEqual(self.memory.recent_chats(1), [222])
+        
+        self.memory.clear_chat(111)
+        self.assertEqual(self.memory.list_chats(), [222])
+        self.assertEqual(self.memory.load_chat_history(111), [])
+    
+    def test_special_text(self):
+        """Мультистрочный текст и обратные кавычки сохраняются как есть"""
+        text = "строка 1\n```код```\nстрока 3"
+        self.memory.save_message(1, 1, 111, text)
+        self.assertEqual(self.memory.load_chat_history(1)[0][2], text)
+
+
+class TestCreateAgentMemory(unittest.TestCase):
+    """Тесты выбора бэкенда по MEMORY_BACKEND"""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def test_backend_selection(self):
+        with patch('src.services.agent_memory.config') as mock_config:
+            mock_config.MEMORY_DIR = self.temp_dir
+            mock_config.MEMORY_FORMAT = "markdown"
+            mock_config.MEMORY_MARKDOWN_EXPORT = False
+            mock_config.MEMORY_META_FLUSH_INTERVAL = 5.0
+            mock_config.MEMORY_MAX_OPEN_FILES = 16
+            mock_config.MEMORY_LAYOUT = "flat"
+            mock_config.MEMORY_SEGMENT_MAX_BYTES = 0
+            mock_config.MEMORY_SEGMENT_MAX_AGE_HOURS = 0
+            mock_config.MEMORY_SEGMENT_TAIL_KEEP = 100
+            mock_config.MEMORY_SEARCH_ENABLED = False
+            mock_config.MEMORY_DAEMON_SOCKET = ""
+            
+            mock_config.MEMORY_BACKEND = "sqlite"
+            memory = create_agent_memory()
+            self.assertIsInstance(memory, SQLiteMemory)
+            memory.close()
+            
+            mock_config.MEMORY_BACKEND = "files"
+            self.assertIsInstance(create_agent_memory(), AgentMemory)
+            
+            mock_config.MEMORY_BACKEND = "redis"
+            with self.assertRaises(ValueError):
+                create_agent_memory()
+
+
+if __name__ == '__main__':
+    unittest.main()
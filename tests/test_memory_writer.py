@@ -0,0 +1,94 @@
+import unittest
+import tempfile
+import shutil
+import time
+from datetime import datetime
+from unittest.mock import MagicMock
+
+from src.services.agent_memory import AgentMemory
+from src.services.memory_writer import MemoryWriter
+
+
+class TestMemoryWriter(unittest.TestCase):
+    """Тесты фонового писателя агентской памяти"""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.agent_memory = AgentMemory(memory_dir=self.temp_dir, storage_format="segments")
+    
+    def tearDown(self):
+        self.agent_memory.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def test_submit_and_stop_persists_everything(self):
+        """stop() дописывает всю очередь перед остановкой"""
+        writer = MemoryWriter(self.agent_memory)
+        for i in range(1, 201):
+            self.assertTrue(writer.submit(i % 3, i, 111, f"msg {i}"))
+        writer.stop()
+        
+        self.assertFalse(writer.running)
+        total = sum(len(self.agent_memory.load_chat_history(chat_id)) for chat_id in range(3))
+        self.assertEqual(total, 200)
+        self.assertEqual(writer.messages_written, 200)
+        # Порядок внутри чата сохраняется
+        ids = [m[0] for m in self.agent_memory.load_chat_history(1)]
+        self.assertEqual(ids, sorted(ids))
+    
+    def test_group_commit_per_chat(self):
+        """Сообщения одного чата из пачки уходят одним вызовом save_messages"""
+        memory = MagicMock()
+        writer = MemoryWriter(memory)
+        timestamp = datetime(2026, 1, 1)
+        batch = [
+            (1, 10, 111, "a", timestamp),
+            (2, 11, 111, "b", timestamp),
+            (1, 12, 111, "c", timestamp),
+        ]
+        writer._write_batch(batch)
+        
+        self.assertEqual(memory.save_messages.call_count, 2)
+        memory.save_messages.assert_any_call(1, [(10, 111, "a", timestamp), (12, 111, "c", timestamp)])
+        memory.save_messages.assert_any_call(2, [(11, 111, "b", timestamp)])
+        self.assertEqual(writer.get_statistics()['batches_written'], 1)
+    
+    def test_queue_overflow_drops(self):
+        """С нулевым таймаутом переполненная очередь не блокирует, а отбрасывает сообщение"""
+        writer = MemoryWriter(MagicMock(), max_queue_size=1, put_timeout=0)
+        writer.start = MagicMock()  # поток не запускаем, чтобы очередь не разгребалась
+        writer._thread = MagicMock(is_alive=MagicMock(return_value=True))
+        
+        self.assertTrue(writer.submit(1, 1, 111, "a"))
+        self.assertFalse(writer.submit(1, 2, 111, "b"))
+        stats = writer.get_statistics()
+        self.assertEqual(stats['queue_depth'], 1)
+        self.assertEqual(stats['dropped'], 1)
+    
+    def test_full_queue_applies_backpressure(self):
+        """Если писатель не успевает, submit ждет места в очереди, и ничего не теряется"""
+        memory = MagicMock()
+        memory.save_messages.side_effect = lambda chat_id, messages: time.sleep(0.02)
+        writer = MemoryWriter(memory, max_queue_size=1, put_timeout=5)
+        for i in range(1, 11):
+            self.assertTrue(writer.submit(1, i, 111, f"msg {i}"))
+        writer.stop()
+
+        written = [m[0] for call in memory.save_messages.call_args_list for m in call[0][1]]
+        self.assertEqual(written, list(range(1, 11)))
+        stats = writer.get_statistics()
+        self.assertEqual(stats['dropped'], 0)
+        self.assertGreater(stats['waits'], 0)
+
+    def test_write_errors_are_counted(self):
+        """Ошибка записи одного чата не роняет поток"""
+        memory = MagicMock()
+        memory.save_messages.side_effect = OSError("disk full")
+        writer = MemoryWriter(memory)
+        writer.submit(1, 1, 111, "a")
+        writer.stop()
+        self.assertEqual(writer.errors, 1)
+        self.assertGreaterEqual(writer.get_statistics()['max_flush_ms'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -102,13 +102,13 @@ class TestAllEmojiTriggers:
     @pytest.mark.asyncio
     async def test_all_emoji_triggers(self):
         """Проверка всех триггерных эмодзи"""
-        with patch('src.bot.handlers.history_manager') as mock_hist, \
-             patch('src.bot.handlers.meme_brain') as mock_brain, \
+        with patch('src.bot.handlers.history_manager', spec=True) as mock_hist, \
+             patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
              patch('src.bot.handlers.image_searcher') as mock_search, \
              patch('src.bot.handlers.meme_generator') as mock_gen, \
              patch('src.bot.handlers.FSInputFile'):
             
-            mock_hist.get_context.return_value = ["User 1: Тестовое сообщение"]
+            mock_hist.get_context_async.return_value = ["User 1: Тестовое сообщение"]
             mock_hist.get_message_text.return_value = "Триггер"
             mock_brain.generate_meme_idea.return_value = {
                 "is_memable": True,
@@ -164,6 +164,45 @@ class TestHistoryStress:
             context = history.get_context(chat_id, 9)
             assert len(context) == 5  # max_size
     
+    def test_memory_per_message(self):
+        """Кольцевые буферы занимают заметно меньше памяти, чем deque кортежей"""
+        import tracemalloc
+        from collections import deque
+        from src.services.history import ChatHistory
+
+        chats, per_chat = 500, 50
+        # Тексты создаем заранее: их размер одинаков в обоих вариантах
+        texts = [f"Сообщение {i}" for i in range(per_chat)]
+
+        def bytes_per_message(build) -> float:
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            history = build()
+            used = tracemalloc.get_traced_memory()[0] - before
+            tracemalloc.stop()
+            assert len(history) == chats
+            return used / (chats * per_chat)
+
+        def build_deques():
+            history = {}
+            for chat_id in range(chats):
+                messages = history[-1000000 - chat_id] = deque(maxlen=per_chat)
+                for i in range(per_chat):
+                    messages.append((100000 + i, 5000000 + i % 7, texts[i]))
+            return history
+
+        def build_rings():
+            history = {}
+            for chat_id in range(chats):
+                ring = history[-1000000 - chat_id] = ChatHistory(per_chat)
+                for i in range(per_chat):
+                    ring.append(100000 + i, 5000000 + i % 7, texts[i])
+            return history
+
+        before = bytes_per_message(build_deques)
+        after = bytes_per_message(build_rings)
+        assert after < before / 2, f"История в памяти: {before:.1f} → {after:.1f} байт на сообщение (без текста)"
+
     def test_empty_context_handling(self):
         """Тест обработки пустого контекста"""
         history = HistoryManager()
@@ -182,13 +221,13 @@ class TestFullPipelineStress:
         """Тест успешного прохождения всей цепочки"""
         msg = create_message(text="Тестовое сообщение", chat_type='private')
         
-        with patch('src.bot.handlers.history_manager') as mock_hist, \
-             patch('src.bot.handlers.meme_brain') as mock_brain, \
+        with patch('src.bot.handlers.history_manager', spec=True) as mock_hist, \
+             patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
              patch('src.bot.handlers.image_searcher') as mock_search, \
              patch('src.bot.handlers.meme_generator') as mock_gen, \
              patch('src.bot.handlers.FSInputFile'):
             
-            mock_hist.get_context.return_value = ["User: Тестовое сообщение"]
+            mock_hist.get_context_async.return_value = ["User: Тестовое сообщение"]
             mock_brain.generate_meme_idea.return_value = {
                 "is_memable": True,
                 "top_text": "КОГДА ТЕСТИРУЕШЬ",
@@ -201,8 +240,8 @@ class TestFullPipelineStress:
             await message_handler(msg)
             
             # Проверяем, что все компоненты были вызваны
-            mock_hist.add_message.assert_called_once()
-            mock_hist.get_context.assert_called_once()
+            mock_hist.add_message_async.assert_awaited_once()
+            mock_hist.get_context_async.assert_awaited_once()
             mock_brain.generate_meme_idea.assert_called_once()
             mock_search.search_template.assert_called_once()
             mock_gen.create_meme.assert_called_once()
@@ -213,10 +252,10 @@ class TestFullPipelineStress:
         """Тест обработки ошибки LLM"""
         msg = create_message(text="Тест", chat_type='private')
         
-        with patch('src.bot.handlers.history_manager') as mock_hist, \
-             patch('src.bot.handlers.meme_brain') as mock_brain:
+        with patch('src.bot.handlers.history_manager', spec=True) as mock_hist, \
+             patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain:
             
-            mock_hist.get_context.return_value = ["User: Тест"]
+            mock_hist.get_context_async.return_value = ["User: Тест"]
             mock_brain.generate_meme_idea.return_value = None
             
             await message_handler(msg)
@@ -230,11 +269,11 @@ class TestFullPipelineStress:
         """Тест обработки ошибки поиска"""
         msg = create_message(text="Тест", chat_type='private')
         
-        with patch('src.bot.handlers.history_manager') as mock_hist, \
-             patch('src.bot.handlers.meme_brain') as mock_brain, \
+        with patch('src.bot.handlers.history_manager', spec=True) as mock_hist, \
+             patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
              patch('src.bot.handlers.image_searcher') as mock_search:
             
-            mock_hist.get_context.return_value = ["User: Тест"]
+            mock_hist.get_context_async.return_value = ["User: Тест"]
             mock_brain.generate_meme_idea.return_value = {
                 "is_memable": True,
                 "top_text": "TOP",
@@ -254,12 +293,12 @@ class TestFullPipelineStress:
         """Тест обработки ошибки генерации изображения"""
         msg = create_message(text="Тест", chat_type='private')
         
-        with patch('src.bot.handlers.history_manager') as mock_hist, \
-             patch('src.bot.handlers.meme_brain') as mock_brain, \
+        with patch('src.bot.handlers.history_manager', spec=True) as mock_hist, \
+             patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
              patch('src.bot.handlers.image_searcher') as mock_search, \
              patch('src.bot.handlers.meme_generator') as mock_gen:
             
-            mock_hist.get_context.return_value = ["User: Тест"]
+            mock_hist.get_context_async.return_value = ["User: Тест"]
             mock_brain.generate_meme_idea.return_value = {
                 "is_memable": True,
                 "top_text": "TOP",
@@ -282,13 +321,13 @@ class TestConcurrentRequests:
     @pytest.mark.asyncio
     async def test_concurrent_meme_generation(self):
         """Тест параллельной генерации мемов"""
-        with patch('src.bot.handlers.history_manager') as mock_hist, \
-             patch('src.bot.handlers.meme_brain') as mock_brain, \
+        with patch('src.bot.handlers.history_manager', spec=True) as mock_hist, \
+             patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
              patch('src.bot.handlers.image_searcher') as mock_search, \
              patch('src.bot.handlers.meme_generator') as mock_gen, \
              patch('src.bot.handlers.FSInputFile'):
             
-            mock_hist.get_context.return_value = ["User: Контекст"]
+            mock_hist.get_context_async.return_value = ["User: Контекст"]
             mock_brain.generate_meme_idea.return_value = {
                 "is_memable": True,
                 "top_text": "TOP",
@@ -318,13 +357,13 @@ class TestConcurrentRequests:
     @pytest.mark.asyncio
     async def test_concurrent_reactions(self):
         """Тест параллельных реакций"""
-        with patch('src.bot.handlers.history_manager') as mock_hist, \
-             patch('src.bot.handlers.meme_brain') as mock_brain, \
+        with patch('src.bot.handlers.history_manager', spec=True) as mock_hist, \
+             patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
              patch('src.bot.handlers.image_searcher') as mock_search, \
              patch('src.bot.handlers.meme_generator') as mock_gen, \
              patch('src.bot.handlers.FSInputFile'):
             
-            mock_hist.get_context.return_value = ["User: Контекст"]
+            mock_hist.get_context_async.return_value = ["User: Контекст"]
             mock_hist.get_message_text.return_value = "Сообщение"
             mock_brain.generate_meme_idea.return_value = {
                 "is_memable": True,
@@ -355,10 +394,10 @@ class TestEdgeCases:
         """Тест пустого сообщения"""
         msg = create_message(text="", chat_type='private')
         
-        with patch('src.bot.handlers.history_manager') as mock_hist:
+        with patch('src.bot.handlers.history_manager', spec=True) as mock_hist:
             await message_handler(msg)
             # Пустые сообщения не должны обрабатываться
-            mock_hist.add_message.assert_not_called()
+            mock_hist.add_message_async.assert_not_awaited()
     
     @pytest.mark.asyncio
     async def test_very_long_message(self):
@@ -366,13 +405,13 @@ class TestEdgeCases:
         long_text = "Слово " * 1000  # 5000+ символов
         msg = create_message(text=long_text, chat_type='private')
         
-        with patch('src.bot.handlers.history_manager') as mock_hist, \
-             patch('src.bot.handlers.meme_brain') as mock_brain, \
+        with patch('src.bot.handlers.history_manager', spec=True) as mock_hist, \
+             patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
              patch('src.bot.handlers.image_searcher') as mock_search, \
              patch('src.bot.handlers.meme_generator') as mock_gen, \
              patch('src.bot.handlers.FSInputFile'):
             
-            mock_hist.get_context.return_value = [f"User: {long_text}"]
+            mock_hist.get_context_async.return_value = [f"User: {long_text}"]
             mock_brain.generate_meme_idea.return_value = {
                 "is_memable": True,
                 "top_text": "ДЛИННЫЙ ТЕКСТ",
@@ -393,13 +432,13 @@ class TestEdgeCases:
         special_text = "Тест <>&\"'`\\n\\t\\r %$#@!"
         msg = create_message(text=special_text, chat_type='private')
         
-        with patch('src.bot.handlers.history_manager') as mock_hist, \
-             patch('src.bot.handlers.meme_brain') as mock_brain, \
+        with patch('src.bot.handlers.history_manager', spec=True) as mock_hist, \
+             patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
              patch('src.bot.handlers.image_searcher') as mock_search, \
              patch('src.bot.handlers.meme_generator') as mock_gen, \
              patch('src.bot.handlers.FSInputFile'):
             
-            mock_hist.get_context.return_value = [f"User: {special_text}"]
+            mock_hist.get_context_async.return_value = [f"User: {special_text}"]
             mock_brain.generate_meme_idea.return_value = {
                 "is_memable": True,
                 "top_text": "СПЕЦСИМВОЛЫ",
@@ -419,10 +458,10 @@ class TestEdgeCases:
         """Тест когда LLM решает, что мем не нужен"""
         msg = create_message(text="Привет", chat_type='private')
         
-        with patch('src.bot.handlers.history_manager') as mock_hist, \
-             patch('src.bot.handlers.meme_brain') as mock_brain:
+        with patch('src.bot.handlers.history_manager', spec=True) as mock_hist, \
+             patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain:
             
-            mock_hist.get_context.return_value = ["User: Привет"]
+            mock_hist.get_context_async.return_value = ["User: Привет"]
             mock_brain.generate_meme_idea.return_value = {
                 "is_memable": False,
                 "top_text": "",
@@ -441,8 +480,8 @@ class TestEdgeCases:
         """Тест реакции на отсутствующее сообщение"""
         reaction = create_reaction(emoji="🔥", message_id=999)
         
-        with patch('src.bot.handlers.history_manager') as mock_hist:
-            mock_hist.get_context.return_value = []
+        with patch('src.bot.handlers.history_manager', spec=True) as mock_hist:
+            mock_hist.get_context_async.return_value = []
             
             await reaction_handler(reaction)
             
@@ -455,12 +494,12 @@ class TestEdgeCases:
         msg = create_message(text="Пересланное", chat_type='group')
         msg.forward_from = AsyncMock()
         
-        with patch('src.bot.handlers.history_manager') as mock_hist:
+        with patch('src.bot.handlers.history_manager', spec=True) as mock_hist:
             await message_handler(msg)
             
             # Пересланное сообщение должно быть добавлено в историю
             # (логика фильтрации в HistoryManager.add_message)
-            mock_hist.add_message.assert_called_once_with(msg)
+            mock_hist.add_message_async.assert_awaited_once_with(msg)
 
 
 class TestInputValidation:
@@ -526,7 +565,8 @@ class TestRealServicesIntegration:
         text = history.get_message_text(123, 9)
         assert text == "Message 9"
     
-    def test_llm_mock_mode(self):
+    @pytest.mark.asyncio
+    async def test_llm_mock_mode(self):
         """Тест LLM в мок-режиме"""
         with patch('src.services.config.config') as mock_config:
             mock_config.LLM_MOCK_ENABLED = True
@@ -537,7 +577,7 @@ class TestRealServicesIntegration:
             brain = MemeBrain()
             brain.mock_enabled = True
             
-            result = brain.generate_meme_idea(
+            result = await brain.generate_meme_idea(
                 ["User: Тест"],
                 "Тест",
                 "Одобрение"
@@ -0,0 +1,170 @@
+import unittest
+import tempfile
+import shutil
+import json
+from pathlib import Path
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+
+from src.services.agent_memory import AgentMemory
+from src.services.telegram_import import TelegramExportReader, bot_api_chat_id, import_telegram_export
+
+
+def make_export(path: Path, count: int = 50, chat_type: str = "private_supergroup"):
+    """Пишет экспорт в формате Telegram Desktop с отступами, как настоящий result.json"""
+    messages = [
+        {"id": 1, "type": "service", "date": "2026-01-01T10:00:00", "actor": "Admin", "action": "create_group", "text": ""},
+    ]
+    for i in range(2, count + 2):
+        messages.append({
+            "id": i,
+            "type": "message",
+            "date": "2026-01-01T10:00:00",
+            "date_unixtime": str(1767261600 + i),
+            "from": "Вася",
+            "from_id": f"user{1000 + i % 3}",
+            "text": f"Сообщение {i} с \"кавычками\" и ] скобкой",
+        })
+    messages.append({
+        "id": count + 2, "type": "message", "date": "2026-01-01T11:00:00", "from": "Петя", "from_id": "user7",
+        "text": ["Жирный ", {"type": "bold", "text": "текст"}, " и ссылка"],
+    })
+    messages.append({
+        "id": count + 3, "type": "message", "date": "2026-01-01T11:00:00", "from_id": "user7",
+        "forwarded_from": "Канал", "text": "репост",
+    })
+    export = {"name": "Чат \"messages\": [", "type": chat_type, "id": 1234567890, "messages": messages}
+    path.write_text(json.dumps(export, ensure_ascii=False, indent=1), encoding='utf-8')
+
+
+class TestTelegramExportReader(unittest.TestCase):
+    """Тесты потокового чтения result.json"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = Path(self.temp_dir) / "result.json"
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_small_chunks(self):
+        """Сообщения собираются из кусков меньше одного сообщения"""
+        make_export(self.path, count=20)
+        with TelegramExportReader(self.path, chunk_size=17) as reader:
+            self.assertEqual(reader.header, {"name": "Чат \"messages\": [", "type": "private_supergroup", "id": 1234567890})
+            items = list(reader)
+        self.assertEqual([item["id"] for item in items], list(range(1, 24)))
+
+    def test_not_an_export(self):
+        self.path.write_text('{"foo": 1}', encoding='utf-8')
+        with self.assertRaises(ValueError):
+            TelegramExportReader(self.path)
+
+    def test_truncated_export(self):
+        make_export(self.path, count=5)
+        self.path.write_text(self.path.read_text(encoding='utf-8')[:-200], encoding='utf-8')
+        with TelegramExportReader(self.path, chunk_size=64) as reader:
+            with self.assertRaises(ValueError):
+                list(reader)
+
+    def test_bot_api_chat_id(self):
+        self.assertEqual(bot_api_chat_id(1234567890, "private_supergroup"), -1001234567890)
+        self.assertEqual(bot_api_chat_id(42, "private_group"), -42)
+        self.assertEqual(bot_api_chat_id(42, "personal_chat"), 42)
+
+
+class TestTelegramImport(unittest.TestCase):
+    """Тесты импорта экспорта Telegram в агентскую память"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = Path(self.temp_dir) / "result.json"
+        self.memory = AgentMemory(memory_dir=str(Path(self.temp_dir) / "memory"), storage_format="segments")
+        make_export(self.path, count=50)
+
+    def tearDown(self):
+        self.memory.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_import(self):
+        """Текстовые сообщения пишутся пачками, служебные и репосты пропускаются"""
+        history = MagicMock()
+        history.max_size = 5
+        self.memory.save_messages = MagicMock(wraps=self.memory.save_messages)
+
+        stats = import_telegram_export(str(self.path), self.memory, batch_size=20, history=history)
+
+        chat_id = -1001234567890
+        self.assertEqual(stats["chat_id"], chat_id)
+        self.assertEqual(stats["messages"], 51)
+        self.assertEqual(stats["skipped"], 2)
+        self.assertEqual(self.memory.save_messages.call_count, 3)
+
+        messages = self.memory.load_chat_history(chat_id)
+        self.assertEqual(len(messages), 51)
+        self.assertEqual(messages[0], (2, 1002, "Сообщение 2 с \"кавычками\" и ] скобкой"))
+        self.assertEqual(messages[-1], (52, 7, "Жирный текст и ссылка"))
+        self.assertEqual(self.memory.get_metadata(chat_id)["message_count"], 51)
+
+        # HistoryManager прогрет последними сообщениями
+        warmed_chat_id, warmed = history.warm_chat.call_args[0]
+        self.assertEqual(warmed_chat_id, chat_id)
+        self.assertEqual([m[0] for m in warmed], [48, 49, 50, 51, 52])
+
+    def test_existing_chat_requires_replace(self):
+        """Существующий чат не перезаписывается без replace"""
+        import_telegram_export(str(self.path), self.memory, chat_id=7)
+        with self.assertRaises(ValueError):
+            import_telegram_export(str(self.path), self.memory, chat_id=7)
+
+        import_telegram_export(str(self.path), self.memory, chat_id=7, replace=True)
+        self.assertEqual(len(self.memory.load_chat_history(7)), 51)
+
+    def test_cli(self):
+        """Команда import-telegram пишет в директорию памяти"""
+        from src.services.memory_cli import main
+        memory_dir = str(Path(self.temp_dir) / "cli")
+        self.assertEqual(main(["--memory-dir", memory_dir, "import-telegram", str(self.path), "--chat-id", "5"]), 0)
+        self.assertEqual(len(AgentMemory(memory_dir=memory_dir).load_chat_history(5)), 51)
+        self.assertEqual(main(["--memory-dir", memory_dir, "import-telegram", str(self.path), "--chat-id", "5"]), 1)
+
+    def test_running_bot_keeps_externally_imported_chats(self):
+        """Живой процесс при сбросе манифеста не затирает чат, импортированный другим процессом"""
+        self.memory.save_message(1, 1, 111, "бот уже работает")
+        self.memory.flush_metadata()
+
+        cli_memory = AgentMemory(memory_dir=str(self.memory.memory_dir), storage_format="segments")
+        import_telegram_export(str(self.path), cli_memory, chat_id=5)
+        cli_memory.close()
+
+        self.memory.save_messages(1, [(2, 111, "и пишет дальше", datetime.now())])
+        self.memory.flush_metadata()
+
+        self.assertEqual(self.memory.list_chats(), [1, 5])
+        reopened = AgentMemory(memory_dir=str(self.memory.memory_dir), storage_format="segments")
+        self.assertEqual(reopened.list_chats(), [1, 5])
+        self.assertEqual(reopened.get_statistics()["total_messages"], 53)
+        reopened.close()
+
+    def test_cli_imports_through_daemon(self):
+        """При запущенном демоне памяти CLI передает импорт ему, а не пишет в директорию сам"""
+        from src.services.memory_cli import main
+        from src.services.memory_daemon import MemoryDaemon
+        socket_path = str(Path(self.temp_dir) / "writer.sock")
+        daemon = MemoryDaemon(self.memory, socket_path)
+        daemon.start()
+        try:
+            with patch("src.services.memory_cli.config.MEMORY_DAEMON_SOCKET", socket_path), \
+                    patch("src.services.memory_cli.config.MEMORY_DIR", str(self.memory.memory_dir)), \
+                    patch("src.services.memory_cli.config.MEMORY_FORMAT", "segments"), \
+                    patch("src.services.memory_cli.import_telegram_export") as local_import:
+                self.assertEqual(main(["import-telegram", str(self.path), "--chat-id", "5"]), 0)
+                self.assertEqual(main(["import-telegram", str(self.path), "--chat-id", "5"]), 1)
+            local_import.assert_not_called()
+        finally:
+            daemon.stop()
+        self.assertEqual(len(self.memory.load_chat_history(5)), 51)
+
+
+if __name__ == '__main__':
+    unittest.main()
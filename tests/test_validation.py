@@ -1,6 +1,7 @@
 import pytest
 from unittest.mock import patch, AsyncMock
 from src.bot.handlers import generate_and_send_meme
+from src.services.llm import MemeBrain
 from aiogram.types import Message, Chat
 
 
@@ -78,7 +79,7 @@ async def test_generate_and_send_meme_send_photo_exception():
     bot.send_photo = AsyncMock(side_effect=Exception("Network error"))
     bot.send_message = AsyncMock()
     
-    with patch('src.bot.handlers.meme_brain') as mock_brain, \
+    with patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
          patch('src.bot.handlers.image_searcher') as mock_search, \
          patch('src.bot.handlers.meme_generator') as mock_gen, \
          patch('src.bot.handlers.FSInputFile'), \
@@ -118,7 +119,7 @@ async def test_generate_and_send_meme_cleanup_on_error():
     bot.send_photo = AsyncMock(side_effect=Exception("Error"))
     bot.send_message = AsyncMock()
     
-    with patch('src.bot.handlers.meme_brain') as mock_brain, \
+    with patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
          patch('src.bot.handlers.image_searcher') as mock_search, \
          patch('src.bot.handlers.meme_generator') as mock_gen, \
          patch('src.bot.handlers.FSInputFile'), \
@@ -152,7 +153,7 @@ async def test_generate_and_send_meme_cleanup_exception():
     bot.send_chat_action = AsyncMock()
     bot.send_photo = AsyncMock()
     
-    with patch('src.bot.handlers.meme_brain') as mock_brain, \
+    with patch('src.bot.handlers.meme_brain', spec=MemeBrain) as mock_brain, \
          patch('src.bot.handlers.image_searcher') as mock_search, \
          patch('src.bot.handlers.meme_generator') as mock_gen, \
          patch('src.bot.handlers.FSInputFile'), \